@@ -0,0 +1,287 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Micro-benchmarks de las etapas por ventana de Discord Whisper Overlay.
+
+Mide por separado el trabajo que rodea a la inferencia en cada ventana
+(escritura de la captura, drenado del planificador, conversión a float,
+comprobación de nivel, filtros de repeticiones y alucinaciones, confianza,
+contexto del decoder y las etapas opcionales de preprocesado, eco y
+hablantes), además de process_window() completo con un modelo simulado que
+devuelve resultados enlatados. Para cada etapa se informa del tiempo por
+llamada (media, p50, p95) y de la memoria reservada con tracemalloc, de modo
+que se puedan comparar refactorizaciones del coste por ventana.
+
+No abre dispositivos de audio ni usa la GPU: solo importa la aplicación (que
+necesita sus dependencias instaladas) y trabaja con audio sintético o con
+un WAV indicado con --wav.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import math
+import time
+import tracemalloc
+
+import numpy as np
+
+import discord_whisper_complete as app
+from rtp_packet_generator import load_wav_mono
+
+RATE = app.RATE
+WINDOW = int(RATE * app.BUFFER_SECONDS)
+
+# Textos realistas que devuelve el modelo simulado (incluye bucles típicos de alucinación)
+CANNED_TEXTS = [
+    " Bueno, entonces quedamos a las nueve para la partida de esta noche.",
+    " ¿Alguien me escucha? Creo que se me ha cortado el micrófono un momento.",
+    " eh eh eh eh eh eh vale",
+    " Sí, sí, sí, sí, sí, sí, claro que sí, ya lo tengo.",
+    " Gracias por ver el vídeo. Gracias por ver el vídeo. Gracias por ver el vídeo.",
+    " umm",
+    " Vamos por la izquierda que por la derecha hay dos enemigos esperando.",
+]
+
+class StubModel:
+    """Sustituto del modelo de Whisper con resultados enlatados.
+
+    transcribe() devuelve los textos de CANNED_TEXTS en orden, con segmentos
+    de tres segundos. La log-probabilidad baja con el nivel RMS de la ventana
+    (por debajo de 0,05) como aproximación a lo que ocurre con hablantes de
+    volumen bajo, para que el efecto del preprocesado sea visible.
+    """
+
+    is_multilingual = True
+
+    def __init__(self):
+        self.calls = 0
+
+    def transcribe(self, audio, **kwargs):
+        text = CANNED_TEXTS[self.calls % len(CANNED_TEXTS)]
+        self.calls += 1
+        rms = float(np.sqrt(np.mean(audio * audio))) if len(audio) else 0.0
+        logprob = -0.3 + min(0.0, math.log10(max(rms, 1e-6) / 0.05))
+        duration = len(audio) / RATE
+        half = duration / 2
+        return {'text': text, 'language': 'es', 'segments': [
+            {'start': 0.0, 'end': half, 'text': text[:len(text) // 2], 'avg_logprob': logprob,
+             'no_speech_prob': 0.05, 'temperature': 0.0, 'compression_ratio': 1.2},
+            {'start': half, 'end': duration, 'text': text[len(text) // 2:], 'avg_logprob': logprob,
+             'no_speech_prob': 0.05, 'temperature': 0.0, 'compression_ratio': 1.2},
+        ]}
+
+def synthetic_voice(seconds, f0=140, formants=(700, 1200, 2600), level=0.3, seed=0):
+    """Voz sintética: armónicos de f0 con envolvente de formantes y modulación silábica."""
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(seconds * RATE)) / RATE
+    harmonics = np.arange(1, 40)[:, None]
+    weights = sum(np.exp(-((f0 * harmonics - f) / 150) ** 2) for f in formants)
+    signal = (weights * np.sin(2 * np.pi * f0 * harmonics * t)).sum(axis=0)
+    signal *= 0.6 + 0.4 * np.sin(2 * np.pi * 4 * t)
+    signal = signal / np.max(np.abs(signal)) * level
+    return (signal + 0.002 * rng.standard_normal(len(t))).astype(np.float32)
+
+def background_hum(seconds, level=0.01, seed=1):
+    """Zumbido de red y ruido de ventilador."""
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(seconds * RATE)) / RATE
+    return (level * np.sin(2 * np.pi * 50 * t) + level * 0.5 * rng.standard_normal(len(t))).astype(np.float32)
+
+def to_int16(audio):
+    return (np.clip(audio, -1, 1) * 32767).astype(np.int16)
+
+def measure(name, function, repeat, allocation_repeat):
+    """Tiempo por llamada y memoria reservada por llamada de una etapa."""
+    for _ in range(3):
+        function()  # Calentamiento (cachés de NumPy, regex compiladas)
+    timings = np.empty(repeat)
+    for i in range(repeat):
+        start = time.perf_counter_ns()
+        function()
+        timings[i] = time.perf_counter_ns() - start
+
+    tracemalloc.start()
+    peaks = []
+    baseline = tracemalloc.get_traced_memory()[0]
+    for _ in range(allocation_repeat):
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        function()
+        peaks.append(tracemalloc.get_traced_memory()[1] - before)
+    retained = tracemalloc.get_traced_memory()[0] - baseline
+    tracemalloc.stop()
+
+    return {
+        'stage': name,
+        'mean_us': float(timings.mean() / 1000),
+        'p50_us': float(np.percentile(timings, 50) / 1000),
+        'p95_us': float(np.percentile(timings, 95) / 1000),
+        'peak_kb': float(np.mean(peaks) / 1024),
+        'retained_kb': retained / 1024 / allocation_repeat,
+    }
+
+def build_stages(voice):
+    """Prepara las entradas de cada etapa y devuelve (nombre, función) por etapa."""
+    window = to_int16(voice[:WINDOW])
+    audio_np = window.astype(np.float32) / 32768.0
+    chunk_bytes = to_int16(voice[:app.CHUNK]).tobytes()
+    texts = [text.strip() for text in CANNED_TEXTS]
+    results = [StubModel().transcribe(audio_np) for _ in range(len(CANNED_TEXTS))]
+    stages = []
+
+    # Captura: bytes del dispositivo -> vista int16 -> anillo del buffer
+    capture_buffer = app.AudioBuffer('bench')
+    writer = app.CaptureWriter([(0, capture_buffer)])
+    def capture():
+        writer.write(chunk_bytes)
+        capture_buffer.read_pos = capture_buffer.write_pos  # Sin consumidor: vaciar sin copiar
+    stages.append(("captura (chunk de CHUNK muestras)", capture))
+
+    # Drenado del planificador: ventana completa del buffer -> segmento pendiente
+    scheduler = app.InferenceScheduler()
+    drain_buffer = app.AudioBuffer('bench')
+    entry = scheduler.add_source(app.SourceState('bench'), drain_buffer)
+    drain_buffer.listener = None
+    def drain():
+        drain_buffer.write(window)
+        scheduler._drain(entry)
+        entry.pending.clear()
+    stages.append(("drenado del planificador", drain))
+
+    stages.append(("conversión a float32", lambda: window.astype(np.float32) / 32768.0))
+    stages.append(("comprobación de nivel", lambda: np.max(np.abs(audio_np))))
+
+    def repetitions():
+        for text in texts:
+            app.filter_repetitions(text)
+    stages.append((f"filtro de repeticiones ({len(texts)} textos)", repetitions))
+
+    def hallucinations():
+        for text in texts:
+            app.is_too_short_text(app.filter_hallucinated_words(text))
+    stages.append((f"filtro de alucinaciones ({len(texts)} textos)", hallucinations))
+
+    def confidence():
+        for result in results:
+            np.exp(app.average_logprob(result['segments']))
+    stages.append((f"confianza ({len(results)} resultados)", confidence))
+
+    tokenizer = app.model_tokenizer(StubModel())
+    context = app.PromptContext()
+    position = [0]
+    def prompt_context():
+        text = texts[position[0] % len(texts)]
+        position[0] += 1
+        context.add(tokenizer, text, position[0] * app.BUFFER_SECONDS)
+        context.prompt_tokens()
+    stages.append(("contexto del decoder", prompt_context))
+
+    preprocessor = app.AudioPreprocessor('bench')
+    preprocessor.learn_noise(background_hum(app.BUFFER_SECONDS))
+    stages.append(("preprocesado (ruido y ganancia)", lambda: preprocessor.process(audio_np)))
+
+    reference_buffer = app.AudioBuffer('reference')
+    reference_start = time.monotonic()
+    reference_buffer.write(to_int16(voice[:WINDOW * 2]), capture_time=reference_start)
+    echo = app.EchoSuppressor(reference_buffer)
+    stages.append(("detección de eco", lambda: echo.is_echo(audio_np, reference_start + 1.0, 'bench')))
+
+    speakers = app.SpeakerTracker('bench')
+    segments = results[0]['segments']
+    stages.append(("cambio de hablante", lambda: speakers.split(audio_np, segments)))
+
+    # process_window completo con el modelo simulado (sin GPU ni dispositivos)
+    model = StubModel()
+    state = app.SourceState('bench')
+    clock = [time.monotonic()]
+    def full_window():
+        clock[0] += app.BUFFER_SECONDS
+        with contextlib.redirect_stdout(io.StringIO()):
+            app.process_window(state, model, window, None, start_time=clock[0])
+    stages.append(("process_window completo (modelo simulado)", full_window))
+    return stages
+
+def compare_preprocessing(voice, windows):
+    """Ventanas de un hablante con volumen bajo y zumbido, con y sin preprocesado.
+
+    Devuelve para cada configuración las inferencias, transcripciones y
+    descartes por motivo del modelo simulado.
+    """
+    quiet = synthetic_voice(windows * app.BUFFER_SECONDS, level=0.03, seed=3)
+    hum = background_hum(windows * app.BUFFER_SECONDS)
+    # Una de cada cuatro ventanas solo tiene el zumbido (sirve para aprender el perfil de ruido)
+    mask = np.repeat((np.arange(windows) % 4 != 0).astype(np.float32), WINDOW)
+    signal = to_int16(quiet * mask + hum)
+    comparison = {}
+    for enabled in (False, True):
+        app.PREPROCESS_ENABLED = enabled
+        label = f"bench_pre_{'on' if enabled else 'off'}"
+        model = StubModel()
+        state = app.SourceState(label)
+        clock = time.monotonic()
+        with contextlib.redirect_stdout(io.StringIO()):
+            for index in range(windows):
+                app.process_window(state, model, signal[index * WINDOW:(index + 1) * WINDOW], None,
+                                   start_time=clock + index * app.BUFFER_SECONDS)
+        comparison['preprocesado' if enabled else 'sin preprocesado'] = {
+            'inferencias': model.calls,
+            'transcripciones': app.metrics.value('whisper_transcriptions', source=label),
+            'descartes': {reason: app.metrics.value('whisper_filter_rejections', source=label, reason=reason)
+                          for reason in ("silence", "too_short", "low_confidence", "filtered_empty")},
+        }
+    app.PREPROCESS_ENABLED = False
+    return comparison
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro-benchmarks de las etapas por ventana (sin audio ni GPU)")
+    parser.add_argument('--repeat', type=int, default=200, help="Llamadas cronometradas por etapa")
+    parser.add_argument('--alloc-repeat', type=int, default=20, help="Llamadas medidas con tracemalloc por etapa")
+    parser.add_argument('--stage', help="Ejecutar solo las etapas cuyo nombre contenga este texto")
+    parser.add_argument('--wav', help="WAV de 16 bits con voz real en lugar de voz sintética")
+    parser.add_argument('--compare-windows', type=int, default=40,
+                        help="Ventanas de la comparación con y sin preprocesado (0 = omitir)")
+    parser.add_argument('--json', help="Guardar los resultados en este archivo JSON")
+    args = parser.parse_args()
+
+    # Sin consola de depuración, logs ni exportadores durante la medición
+    app.DEBUG_MODE = False
+    app.LOG_TRANSCRIPTIONS = False
+    app.DECODE_MODE = "transcribe"  # El modelo simulado implementa transcribe()
+
+    if args.wav:
+        voice = load_wav_mono(args.wav, RATE).astype(np.float32) / 32768.0
+        if len(voice) < WINDOW * 2:
+            voice = np.tile(voice, WINDOW * 2 // max(len(voice), 1) + 1)
+    else:
+        voice = synthetic_voice(app.BUFFER_SECONDS * 2)
+
+    results = []
+    print(f"{'Etapa':<48}{'media µs':>11}{'p50 µs':>11}{'p95 µs':>11}{'pico KB':>10}{'retenido KB':>13}")
+    for name, function in build_stages(voice):
+        if args.stage and args.stage.lower() not in name.lower():
+            continue
+        result = measure(name, function, args.repeat, args.alloc_repeat)
+        results.append(result)
+        print(f"{name:<48}{result['mean_us']:>11.1f}{result['p50_us']:>11.1f}{result['p95_us']:>11.1f}"
+              f"{result['peak_kb']:>10.1f}{result['retained_kb']:>13.2f}")
+
+    comparison = None
+    if args.compare_windows and not args.stage:
+        comparison = compare_preprocessing(voice, args.compare_windows)
+        print(f"\nHablante con volumen bajo y zumbido ({args.compare_windows} ventanas, modelo simulado):")
+        for label, values in comparison.items():
+            rejections = ", ".join(f"{reason}: {count}" for reason, count in values['descartes'].items())
+            print(f"- {label}: {values['inferencias']} inferencias, {values['transcripciones']} transcripciones "
+                  f"({rejections})")
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'window_seconds': app.BUFFER_SECONDS, 'stages': results,
+                       'preprocessing': comparison}, f, ensure_ascii=False, indent=2)
+        print(f"\nResultados guardados en {args.json}")
+
+if __name__ == "__main__":
+    main()
@@ -24,15 +24,44 @@ import traceback
 import logging
 from datetime import datetime
 from collections import deque
+from contextlib import nullcontext
+from bisect import bisect_right
 import random
 import torch
 import re
+import math
+import signal
+import socket
+import struct
+import json
+import zlib
+import argparse
+import http.client
+import asyncio
+import base64
+import hashlib
+import wave
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 import numpy as np
 import pyaudio
 import whisper
 from PyQt5 import QtWidgets, QtCore, QtGui
 
+# soundfile es opcional: solo se necesita para leer archivos FLAC/OGG
+try:
+    import soundfile
+    SOUNDFILE_AVAILABLE = True
+except ImportError:
+    SOUNDFILE_AVAILABLE = False
+
+# opuslib es opcional: solo se necesita para recibir audio Opus por RTP
+try:
+    import opuslib
+    OPUS_AVAILABLE = True
+except Exception:  # También falla si falta la biblioteca nativa libopus
+    OPUS_AVAILABLE = False
+
 # Intentar importar psutil para estadísticas del sistema
 try:
     import psutil
@@ -60,6 +89,78 @@ LOG_TO_CONSOLE = True       # Mostrar logs en consola además de archivo
 LOG_TRANSCRIPTIONS = True   # Registrar todas las transcripciones en el log
 LOG_PERFORMANCE = True      # Registrar estadísticas de rendimiento
 
+# CONFIGURACIÓN DE MÉTRICAS
+METRICS_SAMPLE_INTERVAL = 1.0   # Segundos entre muestras de las series temporales
+METRICS_HISTORY_SIZE = 3600     # Muestras que guarda cada serie (buffer circular de tamaño fijo)
+METRICS_HTTP_ENABLED = False    # Exponer métricas en formato OpenMetrics por HTTP local
+METRICS_HTTP_HOST = "127.0.0.1" # Solo accesible desde este equipo
+METRICS_HTTP_PORT = 9464        # Puerto local del endpoint /metrics
+METRICS_CSV_EXPORT = True       # Exportar las series a CSV al cerrar la aplicación
+METRICS_CSV_FILE = "metrics"    # Nombre base del CSV (se guarda en LOG_FOLDER)
+
+# CONFIGURACIÓN DEL SERVIDOR DE INFERENCIA COMPARTIDO
+# Varias instancias del overlay pueden usar un único modelo cargado: se arranca una con
+# "python discord_whisper_complete.py --server" y las demás con INFERENCE_MODE = "client".
+INFERENCE_MODE = "local"          # "local": cargar el modelo en este proceso; "client": usar el servidor
+INFERENCE_SERVER_HOST = "127.0.0.1"
+INFERENCE_SERVER_PORT = 9466
+INFERENCE_SERVER_MAX_BATCH = 8      # Ventanas máximas por lote en el servidor
+INFERENCE_SERVER_BATCH_WAIT = 0.02  # Segundos que el servidor espera a completar un lote
+INFERENCE_CLIENT_CONNECTIONS = 2    # Conexiones persistentes (y peticiones en vuelo) por cliente
+INFERENCE_CLIENT_TIMEOUT = 15.0     # Segundos máximos de espera por respuesta
+INFERENCE_CLIENT_FALLBACK = True    # Si el servidor no responde, cargar y usar un modelo local
+INFERENCE_SERVER_RETRY = 30.0       # Segundos antes de volver a probar el servidor tras un fallo
+
+# CONFIGURACIÓN DE LA DIFUSIÓN WEB
+# Servidor local que envía los mensajes por WebSocket y sirve una página HTML
+# para usarla como fuente de navegador en OBS o en un segundo monitor.
+BROADCAST_ENABLED = False       # Activar la difusión WebSocket/HTTP
+BROADCAST_HOST = "127.0.0.1"    # Solo accesible desde este equipo
+BROADCAST_PORT = 9465           # Página en http://127.0.0.1:9465/ y WebSocket en /ws
+BROADCAST_CLIENT_QUEUE = 256    # Frames pendientes por cliente; si se llena, el cliente se desconecta
+BROADCAST_MAX_CLIENT_FRAME = 65536  # Tamaño máximo de un frame recibido de un cliente
+
+# CONFIGURACIÓN DE SUBTÍTULOS
+# Los cues se añaden al final de los archivos a medida que se cierran los mensajes,
+# así que OBS o un grabador pueden leerlos en vivo durante la sesión.
+SUBTITLE_EXPORT = False         # Escribir subtítulos en streaming
+SUBTITLE_FORMATS = ["srt", "vtt"]  # Formatos a generar: "srt" y/o "vtt" (WebVTT)
+SUBTITLE_FOLDER = "subtitles"   # Carpeta de salida
+SUBTITLE_FILE = "subtitulos"    # Nombre base (se añade fecha y hora de inicio)
+SUBTITLE_MIN_CUE_SECONDS = 1.0  # Duración mínima en pantalla de cada cue
+
+# CONFIGURACIÓN DEL ARCHIVO DE AUDIO
+# Guarda el PCM capturado de cada fuente en un anillo de tamaño fijo en disco (memory-mapped)
+# para poder revisar o volver a transcribir un tramo: python discord_whisper_complete.py
+# --export mic --start 14:05:00 --end 14:07:30 --output tramo.wav
+ARCHIVE_ENABLED = False     # Activar el archivo de audio
+ARCHIVE_FOLDER = "archivo"  # Carpeta con un .pcm (anillo) y un .json (índice) por fuente
+ARCHIVE_MINUTES = 60        # Minutos que conserva cada fuente (~1,9 MB por minuto a 16 kHz)
+ARCHIVE_SOURCES = None      # Fuentes archivadas (None = todas)
+ARCHIVE_SYNC_SECONDS = 5.0  # Cada cuánto se guarda el índice y se vuelcan las páginas a disco
+
+# CONFIGURACIÓN DE LA CACHÉ DE TRANSCRIPCIONES
+# Al reprocesar una sesión grabada (fuente 'file' con 'realtime': False) con los mismos ajustes
+# de decodificación, el resultado de Whisper de cada ventana sale de disco y solo se repiten los
+# filtros posteriores, así que ajustar umbrales lleva segundos en lugar de horas.
+CACHE_ENABLED = False       # Guardar y reutilizar el resultado de Whisper de cada ventana
+CACHE_FOLDER = "cache"      # Carpeta con un JSON por ventana
+CACHE_MAX_MB = 200          # Tamaño máximo; se eliminan primero las entradas usadas hace más tiempo
+# El prompt (texto anterior aceptado) depende de lo que dejaron pasar los filtros, así que no forma
+# parte de la clave: con False se reutiliza el resultado aunque el prompt haya cambiado (repetición
+# sin prompt, para ajustar filtros); con True solo si coincide con el guardado, y si no se re-decodifica
+CACHE_MATCH_PROMPT = False
+
+# CONFIGURACIÓN DEL PERFILADOR DE MUESTREO
+# Se activa/desactiva en vivo con PROFILER_HOTKEY (si la ventana tiene el foco),
+# con SIGUSR1 en Linux/macOS o con Ctrl+Break en la consola de Windows.
+PROFILER_SAMPLE_HZ = 100         # Muestras por segundo de las pilas de todos los hilos
+PROFILER_WINDOW_SECONDS = 30     # Duración máxima de cada captura antes de escribir el resultado
+PROFILER_THREADS = None          # Lista de nombres de hilos a perfilar (None = todos)
+PROFILER_HOTKEY = "Ctrl+Alt+P"   # Atajo de teclado para activar/desactivar el perfilador
+PROFILER_OUTPUT_PREFIX = "profile"  # Nombre base del archivo .folded (se guarda en LOG_FOLDER)
+PROFILER_START_ON_LAUNCH = False # Iniciar una captura automáticamente al arrancar
+
 # CONFIGURACIÓN DE HARDWARE
 USE_GPU = True           # Usar GPU para aceleración si está disponible
 DEVICE = "cuda" if USE_GPU and torch.cuda.is_available() else "cpu"
@@ -76,22 +177,75 @@ CHANNELS = 1
 RATE = 16000
 BUFFER_SECONDS = 3  # Aumentado de 2 a 3 segundos para capturar más contexto
 OVERLAP_SECONDS = 1.5  # Superposición entre segmentos de audio para mantener contexto
+QUEUE_MAX_SECONDS = 64  # Capacidad del buffer de cada fuente; si se llena se descarta el audio más antiguo
+CAPTURE_MODE = "callback"  # "callback": PortAudio escribe directamente en el buffer; "blocking": stream.read()
+CAPTURE_RETRY_INITIAL = 0.5  # Segundos de espera antes del primer reintento al fallar el dispositivo
+CAPTURE_RETRY_MAX = 30.0     # Espera máxima entre reintentos (el backoff se duplica hasta este valor)
+CAPTURE_WATCHDOG_INTERVAL = 2.0  # Segundos sin audio del callback antes de reabrir el dispositivo
+CAPTURE_NATIVE_RATE = True  # Capturar a la frecuencia nativa del dispositivo (defaultSampleRate) y remuestrear a RATE
+RESAMPLER_TAPS_PER_PHASE = 32  # Coeficientes por fase del filtro polifásico (más = mejor calidad, más CPU)
+RESAMPLER_KAISER_BETA = 8.0    # Parámetro de la ventana Kaiser del filtro anti-aliasing
+RESAMPLER_ROLLOFF = 0.92       # Frecuencia de corte relativa a la Nyquist de salida
+AUDIO_CLOCK_RESYNC = 0.25      # Si el reloj de muestras se retrasa más que esto respecto al real, hubo un hueco en la captura y se reajusta
 
 # Dispositivos: nombres o índices (ajustar al entorno del usuario)
 MIC_DEVICE = 1       # Microfono - Focusrite USB (Focusrite USB Audio)
 DISCORD_DEVICE = None   # Desactivamos temporalmente la captura de Discord para estabilidad
 
+# Fuentes de audio: cada una alimenta su propio buffer y su propio hilo de transcripción.
+# El nombre ('name') es la clave usada en SPEAKERS y COLORS ('label' y 'color' los definen).
+# Tipos disponibles:
+#   {'name': 'mic', 'type': 'device', 'device': 1}                          # Dispositivo PyAudio
+#   {'name': 'discord', 'type': 'file', 'path': 'sesion.wav', 'realtime': True}  # WAV (FLAC/OGG con soundfile)
+#   {'name': 'discord', 'type': 'pipe', 'path': '-', 'rate': 48000, 'channels': 2}  # PCM s16le por stdin o FIFO
+#   {'name': 'discord', 'type': 'tcp', 'port': 5600, 'rate': 48000, 'channels': 2}  # PCM s16le por TCP local
+#   {'name': 'discord', 'type': 'udp', 'port': 5600, 'rate': 48000, 'channels': 2}  # PCM s16le por UDP local
+#   {'name': 'discord', 'type': 'none'}                                     # Sin audio (fuente aparcada)
+# Un dispositivo multicanal (interfaz o mezclador loopback) puede alimentar varias fuentes
+# con un único stream; 'channels' asigna cada fuente a su canal:
+#   {'name': 'interfaz', 'type': 'multichannel', 'device': 3, 'channels': {'mic': 0, 'discord': 1}}
+AUDIO_SOURCES = [
+    {'name': 'mic', 'type': 'device', 'device': MIC_DEVICE},
+    {'name': 'discord', 'type': 'device', 'device': DISCORD_DEVICE} if DISCORD_DEVICE is not None
+    else {'name': 'discord', 'type': 'none'},
+]
+SOURCE_BIND_HOST = "127.0.0.1"  # Las fuentes TCP/UDP solo aceptan conexiones locales
+
+# Recepción de Discord por hablante: un bot de recepción de voz reenvía los paquetes
+# RTP/Opus (ya descifrados) a este puerto local y cada SSRC se transcribe por separado.
+# Para asignar nombres, enviar al mismo puerto un datagrama JSON {"ssrc": 1234, "name": "Ana"}.
+RTP_ENABLED = False           # Activar la recepción RTP por hablante
+RTP_PORT = 5004               # Puerto UDP local donde llegan los paquetes
+RTP_OPUS_CHANNELS = 2         # Canales del Opus recibido (Discord envía estéreo a 48 kHz)
+RTP_PCM_PAYLOAD_TYPE = 96     # Tipo de payload tratado como PCM L16 big-endian (generador de pruebas sin Opus)
+RTP_PCM_RATE = 16000          # Frecuencia del payload PCM L16
+RTP_SSRC_NAMES = {}           # Nombres fijos por SSRC, p. ej. {1234: 'Ana'}
+RTP_IDLE_FLUSH_SECONDS = 0.8  # Sin paquetes durante este tiempo, se transcribe la ventana parcial pendiente
+RTP_MAX_GAP_SECONDS = 1.0     # Huecos de timestamp menores que esto se rellenan con silencio
+RTP_MAX_STREAMS = 32          # Máximo de SSRC simultáneos (los nuevos se ignoran al superarlo)
+RTP_SPEAKER_COLORS = ['#55AAFF', '#55DD88', '#FFAA33', '#CC77FF', '#FF77AA', '#33DDDD', '#DDDD55', '#AA8866']
+
 # Configuración de debug y transcripción
 MIN_AUDIO_LEVEL = 0.015  # Aumentado de 0.01 a 0.015 para evitar ruido de fondo
 SILENCE_SKIP = True    # Saltar audio silencioso para evitar errores
 DEBUG_MODE = True      # Activa mensajes de depuración detallados
 LANGUAGE = "es"        # Idioma para la transcripción: "es" para español
+# Detección de idioma por fuente (servidores multilingües)
+LANGUAGE_DETECT = False            # Detectar el idioma de cada fuente en lugar de usar siempre LANGUAGE
+LANGUAGE_CANDIDATES = ("es", "en")  # Idiomas posibles (None = todos los de Whisper)
+LANGUAGE_DETECT_UTTERANCES = 3     # Frases aceptadas que se promedian antes de fijar el idioma
+LANGUAGE_MIN_CONFIDENCE = 0.7      # Probabilidad media mínima del idioma ganador para fijarlo
+LANGUAGE_RECHECK_SECONDS = 300     # Volver a comprobar el idioma de una fuente cada este tiempo
+LANGUAGE_RECHECK_REJECTIONS = 3    # ...o tras este número de descartes seguidos por baja confianza
 SHOW_TIMESTAMPS = True  # Mostrar marcas de tiempo en los mensajes
-SILENCE_TIMEOUT = 2.0   # Segundos de silencio antes de considerar que el hablante terminó
+SILENCE_TIMEOUT = 2.0   # Segundos de silencio (en el audio) antes de considerar que el hablante terminó
+TIMELINE_HISTORY = 200  # Mensajes que conserva la línea de tiempo (el chat muestra los últimos MAX_CHAT_MESSAGES)
+TIMELINE_FINAL_DELAY = 4.0  # Espera extra (además de SILENCE_TIMEOUT) a transcripciones tardías antes de cerrar un mensaje
+TIMELINE_FINALIZE_INTERVAL = 0.5  # Segundos entre comprobaciones de mensajes listos para cerrarse
 MAX_REPETITIONS = 3    # Máximo número de repeticiones permitidas en una transcripción
 DETECT_REPETITIONS = True  # Activar detección de repeticiones
 USE_PREVIOUS_TEXT = True  # Usar texto anterior como contexto para mejorar coherencia
-CONTEXT_SENTENCES = 2   # Número de oraciones anteriores para usar como contexto
+PROMPT_MAX_TOKENS = 64  # Tokens de contexto (texto anterior) que se pasan al decoder como prompt
 USE_BEAM_SEARCH = True  # Usar búsqueda en haz para mejorar la calidad de transcripción
 MODEL_SIZE = "base"     # Cambiar de "tiny" a "base" para mejor calidad (opciones: tiny, base, small, medium)
 MIN_TEXT_LENGTH = 1     # Modificado: ahora acepta palabras individuales (antes 3)
@@ -100,6 +254,55 @@ FILTER_SHORT_PHRASES = False  # Nueva opción para desactivar el filtrado por lo
 HALLUCINATION_PATTERNS = [
     "¿eh?", "eh", "umm", "hmm", "uh", "ah", "oh", "este", "em", "mm"
 ]  # Patrones típicos de alucinaciones a filtrar
+# Decodificación con presupuesto de latencia por ventana
+DECODE_MODE = "budgeted"          # "budgeted": presupuesto y fallback acotado; "transcribe": model.transcribe() sin límite
+DECODE_LATENCY_BUDGET = 1.5       # Segundos máximos de inferencia por ventana (si se supera, no se publica nada)
+DECODE_TEMPERATURES = (0.0, 0.2, 0.4)  # Temperaturas a probar (como máximo len - 1 reintentos)
+DECODE_COMPRESSION_RATIO_THRESHOLD = 2.4  # Compresión mayor = texto repetitivo, se reintenta
+DECODE_LOGPROB_THRESHOLD = -1.0   # Logprob medio menor = baja confianza, se reintenta
+DECODE_NO_SPEECH_THRESHOLD = 0.6  # Con logprob bajo y esta probabilidad de "sin voz" la ventana se da por vacía
+# Doble salida: transcripción y traducción al inglés a partir de la misma pasada del encoder
+DUAL_OUTPUT = False       # Mostrar también la traducción al inglés (requiere DECODE_MODE = "budgeted" y un modelo multilingüe)
+TRANSLATION_COLOR = '#BBBBBB'  # Color de la línea traducida en el chat
+# Cascada de filtros: nivel de audio -> compuerta de voz con un modelo pequeño -> modelo principal
+GATE_ENABLED = False             # Activar la compuerta de voz antes del modelo principal
+GATE_MODEL_SIZE = "tiny"         # Modelo de la compuerta (igual a MODEL_SIZE = reutilizar el principal)
+GATE_NO_SPEECH_THRESHOLD = 0.6   # Probabilidad de "sin voz" a partir de la cual la ventana se descarta
+# Supresión de eco: con altavoces, el micrófono recoge el audio de Discord y se transcribiría dos veces
+ECHO_SUPPRESSION = False         # Descartar las ventanas del micrófono dominadas por el audio de Discord
+ECHO_SOURCE = 'mic'              # Fuente que puede contener el eco
+ECHO_REFERENCE = 'discord'       # Fuente cuyo audio se busca en ECHO_SOURCE
+ECHO_MAX_LAG_SECONDS = 0.5       # Retardo máximo entre la reproducción y su captura por el micrófono
+ECHO_CORRELATION_THRESHOLD = 0.75  # Correlación normalizada a partir de la cual la ventana se considera eco (> 0,71: ver EchoSuppressor)
+# Preprocesado antes del modelo: supresión de ruido por compuerta espectral y normalización de ganancia
+PREPROCESS_ENABLED = False       # Acondicionar el audio de cada ventana antes de la inferencia
+PREPROCESS_FRAME = 512           # Muestras por trama de la STFT (32 ms a 16 kHz, salto de media trama)
+PREPROCESS_GATE_DB = 6.0         # DB por encima del perfil de ruido para que un bin se conserve
+PREPROCESS_REDUCTION_DB = 18.0   # Atenuación de los bins considerados ruido
+PREPROCESS_NOISE_ADAPT = 0.1     # Velocidad de adaptación del perfil de ruido (0-1)
+PREPROCESS_TARGET_RMS = 0.1      # Nivel RMS de la voz tras la normalización (-20 dBFS)
+PREPROCESS_MAX_GAIN_DB = 20.0    # Ganancia máxima para hablantes con volumen bajo
+PREPROCESS_BUDGET_SECONDS = 0.02  # CPU máxima por ventana; si se supera solo se aplica la ganancia
+PREPROCESS_RETRY_WINDOWS = 20    # Ventanas sin supresión antes de volver a intentarla
+# Cambios de hablante dentro de una fuente mezclada (p. ej. toda la llamada de Discord en un canal)
+DIARIZATION_ENABLED = False        # Separar los mensajes por hablante con etiquetas "Discord 1", "Discord 2"...
+DIARIZATION_SOURCES = ('discord',)  # Fuentes mezcladas en las que se buscan cambios de hablante
+DIARIZATION_THRESHOLD_DB = 4.0     # Distancia espectral media (dB) a partir de la cual la voz es de otro hablante
+DIARIZATION_MIN_SECONDS = 0.8      # Segmentos más cortos se asignan al hablante anterior (huella poco fiable)
+DIARIZATION_MAX_SPEAKERS = 8       # Máximo de hablantes por fuente; después se asigna el más parecido
+# Refinado en segundo plano: las ventanas publicadas se vuelven a transcribir con un modelo
+# mayor cuando el modelo en vivo está libre, y el texto mejorado sustituye al original
+REFINE_ENABLED = False      # Activar la segunda pasada (carga un segundo modelo si REFINE_MODEL_SIZE != MODEL_SIZE)
+REFINE_MODEL_SIZE = "small" # Modelo de refinado (igual a MODEL_SIZE = mismo modelo con búsqueda en haz)
+REFINE_BEAM_SIZE = 5        # Búsqueda en haz del refinado
+REFINE_MAX_PENDING = 20     # Ventanas guardadas para refinar; si se supera se descartan las más antiguas
+REFINE_HOLD_SECONDS = 10.0  # Tiempo máximo que un mensaje espera a su refinado antes de cerrarse
+# Planificador de inferencia: todas las fuentes comparten el modelo a través de una cola común
+SCHEDULER_POLICY = "mic_priority"  # "round_robin", "edf" (el audio más antiguo primero) o "mic_priority"
+SCHEDULER_LATENCY_BUDGET = 6.0     # Segundos máximos entre el fin de una ventana y el inicio de su inferencia
+SCHEDULER_STALE_ACTION = "downgrade"  # Ventanas fuera de presupuesto: "drop" (descartar) o "downgrade" (decodificación voraz)
+SCHEDULER_WORKERS = 1              # Hilos de inferencia que comparten el modelo
+SOURCE_PRIORITIES = {'mic': 1}     # Prioridad por fuente para "mic_priority" (mayor = antes; por defecto 0)
 RESET_CONTEXT_AFTER_SILENCE = True  # Reiniciar contexto después de un silencio prolongado
 MAX_SILENCE_BEFORE_RESET = 5.0  # Segundos de silencio antes de reiniciar el contexto
 
@@ -112,6 +315,8 @@ CHAT_WIDTH = 400     # Nuevo - Ancho de la ventana de chat en píxeles
 MAX_CHAT_MESSAGES = 8  # Reducido de 15 - Máximo número de mensajes en el historial de chat
 CHAT_MODE = True     # Activar el modo de chat vs. modo overlay tradicional
 POSITION_BOTTOM_RIGHT = True  # Posicionar en la esquina inferior derecha en lugar de ocupar todo el ancho
+SHOW_METRICS_HUD = False  # Mostrar una línea con métricas en vivo (RTF, cola, RAM, GPU) en el chat
+METRICS_HUD_INTERVAL = 1000  # Milisegundos entre actualizaciones del HUD
 
 # Colores para los diferentes hablantes
 COLORS = {
@@ -129,6 +334,14 @@ SPEAKERS = {
 
 # Variables globales para control de hilos
 running = True       # Controla si los hilos deben seguir ejecutándose
+shutdown_event = threading.Event()  # Despierta a los hilos aparcados cuando la aplicación se cierra
+audio_buffers = []   # Buffers de audio activos (se cierran al salir para liberar a sus consumidores)
+audio_sources = []   # Fuentes de audio activas (se detienen al salir)
+audio_archives = []  # Archivos de audio en disco activos (se sincronizan periódicamente y al salir)
+transcript_refiner = None  # TranscriptRefiner activo si REFINE_ENABLED
+speech_gate = None         # SpeechGate activa si GATE_ENABLED
+echo_suppressor = None     # EchoSuppressor activo si ECHO_SUPPRESSION
+transcription_cache = None  # TranscriptionCache activa si CACHE_ENABLED
 
 def setup_logging():
     """Configura el sistema de logs para registrar la actividad de la aplicación."""
@@ -194,60 +407,1081 @@ def clean_old_logs():
             except Exception as e:
                 print(f"Error al eliminar log antiguo {file_path}: {str(e)}")
 
-def log_stats(logger):
-    """Hilo que registra estadísticas periódicas de la aplicación."""
+class RingSeries:
+    """Serie temporal de tamaño fijo (buffer circular) sobre arrays de NumPy."""
+
+    def __init__(self, size):
+        self.size = size
+        self.times = np.zeros(size, dtype=np.float64)
+        self.values = np.zeros(size, dtype=np.float64)
+        self.count = 0  # Total de muestras escritas (la posición es count % size)
+
+    def append(self, timestamp, value):
+        index = self.count % self.size
+        self.times[index] = timestamp
+        self.values[index] = value
+        self.count += 1
+
+    def snapshot(self):
+        """Devuelve (tiempos, valores) en orden cronológico."""
+        if self.count <= self.size:
+            return self.times[:self.count].copy(), self.values[:self.count].copy()
+        start = self.count % self.size
+        return (np.concatenate((self.times[start:], self.times[:start])),
+                np.concatenate((self.values[start:], self.values[:start])))
+
+    def last(self):
+        if self.count == 0:
+            return None
+        return self.values[(self.count - 1) % self.size]
+
+class MetricsRegistry:
+    """Registro central de métricas (contadores, gauges e histogramas) con etiquetas.
+
+    Las actualizaciones desde los hilos de audio/transcripción son operaciones
+    O(1) protegidas por un único lock. El hilo de muestreo copia periódicamente
+    los valores a series circulares de tamaño fijo (METRICS_HISTORY_SIZE).
+    """
+
+    def __init__(self, history_size):
+        self.history_size = history_size
+        self.lock = threading.Lock()
+        self.families = {}   # nombre -> {'kind', 'help', 'buckets'}
+        self.values = {}     # (nombre, etiquetas) -> valor (contadores y gauges)
+        self.histograms = {}  # (nombre, etiquetas) -> [cuentas por bucket, suma, total]
+        self.callbacks = {}  # (nombre, etiquetas) -> función que devuelve el valor del gauge
+        self.series = {}     # (nombre, etiquetas) -> RingSeries
+        self.start_time = time.time()
+
+    @staticmethod
+    def _key(name, labels):
+        return (name, tuple(sorted(labels.items())))
+
+    def _declare(self, name, kind, help_text, buckets=None):
+        if name not in self.families:
+            self.families[name] = {'kind': kind, 'help': help_text, 'buckets': buckets}
+
+    def counter(self, name, help_text):
+        self._declare(name, 'counter', help_text)
+
+    def gauge(self, name, help_text):
+        self._declare(name, 'gauge', help_text)
+
+    def histogram(self, name, help_text, buckets):
+        self._declare(name, 'histogram', help_text, tuple(sorted(buckets)))
+
+    def inc(self, name, amount=1, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def set(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            self.values[key] = value
+
+    def set_callback(self, name, func, **labels):
+        """Registra un gauge cuyo valor se lee con func() en cada muestreo."""
+        key = self._key(name, labels)
+        with self.lock:
+            self.callbacks[key] = func
+
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        buckets = self.families[name]['buckets']
+        with self.lock:
+            hist = self.histograms.get(key)
+            if hist is None:
+                hist = self.histograms[key] = [[0] * (len(buckets) + 1), 0.0, 0]
+            # Buscar el primer bucket cuyo límite superior contenga el valor
+            index = len(buckets)
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    index = i
+                    break
+            hist[0][index] += 1
+            hist[1] += value
+            hist[2] += 1
+
+    def value(self, name, default=0, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            return self.values.get(key, default)
+
+    def histogram_mean(self, name, **labels):
+        """Media de un histograma (None si todavía no hay observaciones)."""
+        key = self._key(name, labels)
+        with self.lock:
+            hist = self.histograms.get(key)
+            return hist[1] / hist[2] if hist and hist[2] else None
+
+    def sum_by(self, name):
+        """Suma un contador para todas sus combinaciones de etiquetas."""
+        with self.lock:
+            return sum(v for (n, _), v in self.values.items() if n == name)
+
+    def sample(self, timestamp=None):
+        """Copia el valor actual de cada métrica a su serie circular."""
+        timestamp = time.time() if timestamp is None else timestamp
+        # Los callbacks se evalúan fuera del lock porque pueden ser lentos
+        with self.lock:
+            callbacks = list(self.callbacks.items())
+        callback_values = []
+        for key, func in callbacks:
+            try:
+                callback_values.append((key, float(func())))
+            except Exception:
+                continue
+
+        with self.lock:
+            for key, value in callback_values:
+                self.values[key] = value
+            points = list(self.values.items())
+            for (name, labels), hist in self.histograms.items():
+                points.append(((name + '_sum', labels), hist[1]))
+                points.append(((name + '_count', labels), hist[2]))
+            for key, value in points:
+                series = self.series.get(key)
+                if series is None:
+                    series = self.series[key] = RingSeries(self.history_size)
+                series.append(timestamp, value)
+
+    @staticmethod
+    def _format_labels(labels, extra=None):
+        items = list(labels) + (list(extra) if extra else [])
+        if not items:
+            return ""
+        escaped = []
+        for k, v in items:
+            v = str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+            escaped.append(f'{k}="{v}"')
+        return "{" + ",".join(escaped) + "}"
+
+    def to_openmetrics(self):
+        """Exporta el estado actual en formato de texto OpenMetrics."""
+        lines = []
+        with self.lock:
+            for name, family in sorted(self.families.items()):
+                kind = family['kind']
+                lines.append(f"# TYPE {name} {kind}")
+                lines.append(f"# HELP {name} {family['help']}")
+                if kind == 'histogram':
+                    for (n, labels), (counts, total_sum, total) in sorted(self.histograms.items()):
+                        if n != name:
+                            continue
+                        cumulative = 0
+                        for bound, count in zip(family['buckets'] + (float('inf'),), counts):
+                            cumulative += count
+                            le = "+Inf" if bound == float('inf') else repr(float(bound))
+                            lines.append(f"{name}_bucket{self._format_labels(labels, [('le', le)])} {cumulative}")
+                        lines.append(f"{name}_sum{self._format_labels(labels)} {total_sum}")
+                        lines.append(f"{name}_count{self._format_labels(labels)} {total}")
+                else:
+                    suffix = "_total" if kind == 'counter' else ""
+                    for (n, labels), value in sorted(self.values.items()):
+                        if n == name:
+                            lines.append(f"{name}{suffix}{self._format_labels(labels)} {value}")
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+    def to_csv(self):
+        """Exporta todas las series circulares en formato CSV largo."""
+        rows = ["timestamp,metric,labels,value"]
+        with self.lock:
+            series_items = sorted(self.series.items())
+        for (name, labels), series in series_items:
+            times, values = series.snapshot()
+            label_str = ";".join(f"{k}={v}" for k, v in labels)
+            for t, v in zip(times, values):
+                rows.append(f"{t:.3f},{name},{label_str},{v:g}")
+        return "\n".join(rows) + "\n"
+
+    def export_csv(self, path):
+        with open(path, 'w', encoding='utf-8', newline='') as f:
+            f.write(self.to_csv())
+
+metrics = MetricsRegistry(METRICS_HISTORY_SIZE)
+
+# Declaración de las métricas usadas por la aplicación
+metrics.gauge("whisper_queue_seconds", "Segundos de audio pendientes en el buffer de cada fuente")
+metrics.counter("whisper_dropped_samples", "Muestras descartadas por buffer lleno")
+metrics.counter("whisper_capture_overflows", "Desbordamientos de entrada reportados por PortAudio")
+metrics.counter("whisper_capture_underflows", "Subdesbordamientos de entrada reportados por PortAudio")
+metrics.counter("whisper_capture_errors", "Errores del dispositivo de captura que obligaron a reabrirlo")
+metrics.gauge("whisper_capture_input_latency_seconds", "Latencia de entrada informada por el stream al abrirlo")
+metrics.gauge("whisper_capture_latency_seconds", "Retardo entre el ADC y la entrega del audio al callback")
+metrics.histogram("whisper_resample_seconds", "Tiempo de CPU del remuestreo por chunk capturado",
+                  (0.0001, 0.0005, 0.001, 0.005, 0.01))
+metrics.counter("whisper_resample_cpu_seconds", "Tiempo de CPU acumulado en el remuestreo")
+metrics.counter("whisper_resample_audio_seconds", "Segundos de audio remuestreados")
+metrics.counter("whisper_rtp_packets", "Paquetes RTP recibidos por hablante")
+metrics.counter("whisper_rtp_lost_packets", "Paquetes RTP perdidos según el número de secuencia")
+metrics.counter("whisper_rtp_late_packets", "Paquetes RTP duplicados o fuera de orden descartados")
+metrics.gauge("whisper_rtp_streams", "Hablantes (SSRC) activos en la recepción RTP")
+metrics.histogram("whisper_capture_jitter_seconds", "Desviación del intervalo entre callbacks de captura",
+                  (0.001, 0.005, 0.01, 0.02, 0.05, 0.1))
+metrics.counter("whisper_transcriptions", "Transcripciones aceptadas y mostradas")
+metrics.counter("whisper_silence_periods", "Periodos de silencio detectados")
+metrics.counter("whisper_filter_rejections", "Ventanas descartadas por los filtros, por motivo")
+metrics.counter("whisper_transcription_errors", "Errores durante la transcripción")
+metrics.counter("whisper_language_detections", "Ventanas en las que se ejecutó la detección de idioma")
+metrics.counter("whisper_language_changes", "Cambios del idioma fijado de una fuente")
+metrics.gauge("whisper_language_confidence", "Probabilidad media del idioma fijado de cada fuente")
+metrics.histogram("whisper_queue_delay_seconds", "Espera de cada ventana en el planificador antes de su inferencia",
+                  (0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 5.0, 10.0))
+metrics.counter("whisper_scheduler_dropped", "Ventanas descartadas por superar el presupuesto de latencia")
+metrics.counter("whisper_scheduler_downgraded", "Ventanas decodificadas en modo rápido por ir con retraso")
+metrics.histogram("whisper_caption_latency_seconds", "Retardo entre el fin del habla (reloj de audio) y su publicación",
+                  (0.25, 0.5, 1.0, 2.0, 3.0, 5.0, 10.0))
+metrics.counter("whisper_subtitle_cues", "Cues de subtítulos escritos")
+metrics.counter("whisper_subtitle_bytes", "Bytes añadidos a los archivos de subtítulos")
+metrics.gauge("whisper_broadcast_clients", "Clientes WebSocket conectados")
+metrics.counter("whisper_broadcast_frames", "Frames WebSocket encolados a clientes")
+metrics.counter("whisper_broadcast_dropped_clients", "Clientes WebSocket desconectados por no leer a tiempo")
+metrics.counter("whisper_server_requests", "Peticiones recibidas por el servidor de inferencia")
+metrics.gauge("whisper_server_pending", "Peticiones esperando lote en el servidor de inferencia")
+metrics.histogram("whisper_server_batch_size", "Ventanas decodificadas juntas en cada lote del servidor",
+                  (1, 2, 3, 4, 6, 8, 16))
+metrics.counter("whisper_client_fallbacks", "Veces que el cliente pasó al modelo local por fallo del servidor")
+metrics.gauge("whisper_refine_pending", "Ventanas esperando el refinado")
+metrics.counter("whisper_refine_windows", "Ventanas re-transcritas por el refinado")
+metrics.counter("whisper_refine_changed", "Textos sustituidos por el refinado")
+metrics.counter("whisper_refine_rejected", "Refinados descartados por los filtros (se conserva el texto en vivo), por motivo")
+metrics.counter("whisper_refine_dropped", "Ventanas descartadas sin refinar por falta de tiempo libre")
+metrics.histogram("whisper_refine_seconds", "Tiempo de inferencia del refinado por ventana",
+                  (0.1, 0.25, 0.5, 1.0, 2.0, 5.0, 10.0))
+metrics.histogram("whisper_gate_seconds", "Coste de la compuerta de voz por ventana",
+                  (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5))
+metrics.counter("whisper_gate_saved_seconds", "Inferencia del modelo principal ahorrada por la compuerta (estimada)")
+metrics.histogram("whisper_echo_seconds", "Coste de la detección de eco por ventana",
+                  (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1))
+metrics.histogram("whisper_echo_correlation", "Correlación máxima entre la fuente y la referencia de eco",
+                  (0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9))
+metrics.counter("whisper_echo_saved_seconds", "Inferencia del modelo principal ahorrada por la supresión de eco (estimada)")
+metrics.histogram("whisper_preprocess_seconds", "Coste del preprocesado (supresión de ruido y ganancia) por ventana",
+                  (0.001, 0.0025, 0.005, 0.01, 0.02, 0.05, 0.1))
+metrics.gauge("whisper_preprocess_gain_db", "Ganancia aplicada por la normalización")
+metrics.counter("whisper_preprocess_bypassed", "Ventanas sin supresión de ruido por superar el presupuesto de CPU")
+metrics.histogram("whisper_diarization_rtf", "Coste de la detección de hablante respecto a la duración del audio",
+                  (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05))
+metrics.counter("whisper_speaker_changes", "Cambios de hablante detectados dentro de una fuente")
+metrics.gauge("whisper_speakers", "Hablantes distintos detectados en cada fuente")
+metrics.counter("whisper_diarization_rejected_turns", "Turnos de hablante descartados por los filtros, por motivo")
+metrics.counter("whisper_cache_hits", "Ventanas cuyo resultado de Whisper salió de la caché")
+metrics.counter("whisper_cache_misses", "Ventanas que no estaban en la caché")
+metrics.counter("whisper_cache_evictions", "Entradas eliminadas de la caché por tamaño")
+metrics.counter("whisper_cache_prompt_mismatches", "Entradas de la caché obtenidas con un prompt distinto del actual")
+metrics.gauge("whisper_cache_bytes", "Tamaño en disco de la caché de transcripciones")
+metrics.histogram("whisper_decode_attempt_seconds", "Duración de cada intento de decodificación, por modo",
+                  (0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 5.0))
+metrics.counter("whisper_decode_fallbacks", "Reintentos de decodificación a mayor temperatura")
+metrics.counter("whisper_decode_greedy_switches", "Decodificaciones que pasaron a voraz por falta de presupuesto")
+metrics.counter("whisper_decode_budget_overruns", "Ventanas abandonadas por superar el presupuesto de latencia")
+metrics.counter("whisper_prompt_rejected_texts", "Textos aceptados que no entran en el contexto por parecer alucinaciones")
+metrics.histogram("whisper_translate_seconds", "Coste añadido por la decodificación de la traducción",
+                  (0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.0))
+metrics.counter("whisper_translate_skipped", "Traducciones omitidas por falta de presupuesto de latencia")
+metrics.histogram("whisper_inference_seconds", "Tiempo de inferencia de Whisper por ventana",
+                  (0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 5.0))
+metrics.histogram("whisper_rtf", "Factor de tiempo real (inferencia / duración del audio)",
+                  (0.05, 0.1, 0.2, 0.33, 0.5, 1.0, 2.0))
+metrics.gauge("whisper_process_rss_bytes", "Memoria residente del proceso")
+metrics.gauge("whisper_process_cpu_percent", "Uso de CPU del proceso")
+metrics.gauge("whisper_gpu_memory_allocated_bytes", "Memoria de GPU asignada por PyTorch")
+metrics.gauge("whisper_gpu_memory_reserved_bytes", "Memoria de GPU reservada por PyTorch")
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    """Sirve /metrics (OpenMetrics) y /metrics.csv en el puerto local."""
+
+    def do_GET(self):
+        if self.path in ("/", "/metrics"):
+            body = metrics.to_openmetrics().encode('utf-8')
+            content_type = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+        elif self.path == "/metrics.csv":
+            body = metrics.to_csv().encode('utf-8')
+            content_type = "text/csv; charset=utf-8"
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # No llenar la consola con cada petición
+
+def start_metrics_server(logger=None):
+    """Arranca el servidor HTTP de métricas en localhost (hilo daemon)."""
+    try:
+        server = ThreadingHTTPServer((METRICS_HTTP_HOST, METRICS_HTTP_PORT), _MetricsRequestHandler)
+    except OSError as e:
+        print(f"No se pudo iniciar el servidor de métricas en el puerto {METRICS_HTTP_PORT}: {str(e)}")
+        if logger:
+            logger.warning(f"Servidor de métricas no disponible: {str(e)}")
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True, name="MetricsHTTPThread").start()
+    print(f"Métricas disponibles en http://{METRICS_HTTP_HOST}:{METRICS_HTTP_PORT}/metrics")
+    if logger:
+        logger.info(f"Servidor de métricas iniciado en {METRICS_HTTP_HOST}:{METRICS_HTTP_PORT}")
+    return server
+
+def sample_process_metrics(process):
+    """Actualiza los gauges de memoria, CPU y GPU del proceso."""
+    if process is not None:
+        try:
+            metrics.set("whisper_process_rss_bytes", process.memory_info().rss)
+            metrics.set("whisper_process_cpu_percent", process.cpu_percent())
+        except Exception:
+            pass
+    if torch.cuda.is_available() and USE_GPU:
+        try:
+            metrics.set("whisper_gpu_memory_allocated_bytes", torch.cuda.memory_allocated())
+            metrics.set("whisper_gpu_memory_reserved_bytes", torch.cuda.memory_reserved())
+        except Exception:
+            pass
+
+def metrics_sampler(logger):
+    """Hilo que muestrea las métricas en sus series y registra estadísticas periódicas."""
     global running
-    
-    if not logger or not LOG_PERFORMANCE:
-        return
-    
-    logger.info("Iniciando registro de estadísticas periódicas")
-    
+
+    # Un único objeto Process: cpu_percent() mide desde la llamada anterior
+    process = psutil.Process(os.getpid()) if PSUTIL_AVAILABLE else None
+    if process is not None:
+        process.cpu_percent()
+
+    if logger and LOG_PERFORMANCE:
+        logger.info("Iniciando registro de estadísticas periódicas")
+
     start_time = time.time()
     last_log_time = start_time
-    
+
     while running:
         current_time = time.time()
-        
+        sample_process_metrics(process)
+        metrics.sample(current_time)
+
         # Registrar estadísticas cada LOG_STATS_INTERVAL segundos
-        if current_time - last_log_time >= LOG_STATS_INTERVAL:
-            # Tiempo total de ejecución
+        if logger and LOG_PERFORMANCE and current_time - last_log_time >= LOG_STATS_INTERVAL:
             uptime = current_time - start_time
             hours, remainder = divmod(uptime, 3600)
             minutes, seconds = divmod(remainder, 60)
             uptime_str = f"{int(hours)}h {int(minutes)}m {int(seconds)}s"
-            
-            # Uso de memoria
-            process = psutil.Process(os.getpid()) if PSUTIL_AVAILABLE else None
-            memory_usage = f"{process.memory_info().rss / (1024 * 1024):.1f} MB" if process else "No disponible"
-            
-            # Uso de CPU
-            cpu_percent = f"{process.cpu_percent():.1f}%" if process else "No disponible"
-            
-            # Estadísticas de GPU si está disponible
+
+            memory_usage = f"{metrics.value('whisper_process_rss_bytes') / (1024 * 1024):.1f} MB" if process else "No disponible"
+            cpu_percent = f"{metrics.value('whisper_process_cpu_percent'):.1f}%" if process else "No disponible"
+
             gpu_stats = ""
             if torch.cuda.is_available() and USE_GPU:
-                try:
-                    gpu_memory_allocated = f"{torch.cuda.memory_allocated() / (1024**3):.2f} GB"
-                    gpu_memory_reserved = f"{torch.cuda.memory_reserved() / (1024**3):.2f} GB"
-                    gpu_stats = f", GPU: {gpu_memory_allocated} / {gpu_memory_reserved}"
-                except:
-                    gpu_stats = ", GPU: Error al obtener estadísticas"
-            
-            # Registrar estadísticas
-            logger.info(f"ESTADÍSTICAS - Tiempo activo: {uptime_str}, RAM: {memory_usage}, CPU: {cpu_percent}{gpu_stats}")
+                gpu_memory_allocated = f"{metrics.value('whisper_gpu_memory_allocated_bytes') / (1024**3):.2f} GB"
+                gpu_memory_reserved = f"{metrics.value('whisper_gpu_memory_reserved_bytes') / (1024**3):.2f} GB"
+                gpu_stats = f", GPU: {gpu_memory_allocated} / {gpu_memory_reserved}"
+
+            rejections = metrics.sum_by("whisper_filter_rejections")
+            dropped = metrics.sum_by("whisper_dropped_samples")
+            overflows = metrics.sum_by("whisper_capture_overflows")
+            logger.info(f"ESTADÍSTICAS - Tiempo activo: {uptime_str}, RAM: {memory_usage}, CPU: {cpu_percent}{gpu_stats}, "
+                        f"Descartes por filtros: {rejections}, Muestras perdidas: {dropped}, Desbordamientos: {overflows}")
             
+            # Coste del remuestreo por fuente (CPU / duración del audio procesado)
+            for key, value in list(metrics.values.items()):
+                if key[0] == "whisper_resample_audio_seconds" and value > 0:
+                    labels = dict(key[1])
+                    cpu_seconds = metrics.value("whisper_resample_cpu_seconds", **labels)
+                    logger.info(f"ESTADÍSTICAS - Remuestreo [{labels.get('source')}]: {cpu_seconds * 100 / value:.3f}% de tiempo real")
+
             last_log_time = current_time
-        
-        # Esperar un poco para no consumir CPU
-        time.sleep(5)
-    
-    logger.info("Finalizado registro de estadísticas periódicas")
+
+        shutdown_event.wait(METRICS_SAMPLE_INTERVAL)
+
+    if logger and LOG_PERFORMANCE:
+        logger.info("Finalizado registro de estadísticas periódicas")
+
+def export_metrics_csv(logger=None):
+    """Guarda las series de métricas en un CSV dentro de LOG_FOLDER."""
+    try:
+        if not os.path.exists(LOG_FOLDER):
+            os.makedirs(LOG_FOLDER)
+        filename = f"{METRICS_CSV_FILE}_{datetime.now().strftime('%Y-%m-%d_%H%M%S')}.csv"
+        path = os.path.join(LOG_FOLDER, filename)
+        metrics.export_csv(path)
+        print(f"Métricas exportadas a {path}")
+        if logger:
+            logger.info(f"Métricas exportadas a {path}")
+    except Exception as e:
+        print(f"Error al exportar métricas a CSV: {str(e)}")
+
+class SamplingProfiler:
+    """Perfilador de muestreo de todos los hilos, activable en tiempo de ejecución.
+
+    Mientras está apagado su hilo queda bloqueado en un Event, sin coste alguno.
+    Encendido, toma las pilas de todos los hilos con sys._current_frames() a
+    PROFILER_SAMPLE_HZ y al terminar la ventana escribe pilas colapsadas
+    ("hilo;func;func N"), el formato de entrada de flamegraph.pl y speedscope.
+    """
+
+    def __init__(self, sample_hz=PROFILER_SAMPLE_HZ, window_seconds=PROFILER_WINDOW_SECONDS,
+                 thread_names=PROFILER_THREADS, logger=None):
+        self.interval = 1.0 / sample_hz
+        self.window_seconds = window_seconds
+        self.thread_names = set(thread_names) if thread_names else None
+        self.logger = logger
+        self.active = threading.Event()
+        self.lock = threading.Lock()
+        self.counts = {}
+        self.samples = 0
+        self.deadline = 0
+        self.thread = threading.Thread(target=self._run, daemon=True, name="ProfilerThread")
+        self.thread.start()
+
+    def start(self, window_seconds=None):
+        """Inicia una captura (no hace nada si ya hay una en curso)."""
+        with self.lock:
+            if self.active.is_set():
+                return
+            self.counts = {}
+            self.samples = 0
+            self.deadline = time.time() + (window_seconds or self.window_seconds)
+            self.active.set()
+        print(f"Perfilador activado ({PROFILER_SAMPLE_HZ} Hz, máximo {window_seconds or self.window_seconds}s)")
+        if self.logger:
+            self.logger.info("Perfilador de muestreo activado")
+
+    def stop(self):
+        """Termina la captura en curso; el hilo del perfilador escribe el resultado."""
+        self.active.clear()
+
+    def toggle(self):
+        if self.active.is_set():
+            self.stop()
+        else:
+            self.start()
+
+    def _run(self):
+        while True:
+            self.active.wait()  # Apagado: el hilo queda aparcado aquí
+            while self.active.is_set() and running and time.time() < self.deadline:
+                self._sample()
+                time.sleep(self.interval)
+            self.active.clear()
+            if self.samples:
+                self._write()
+
+    @staticmethod
+    def _frame_label(frame):
+        code = frame.f_code
+        return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+    def _sample(self):
+        own_ident = threading.get_ident()
+        names = {t.ident: t.name for t in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == own_ident:
+                continue
+            name = names.get(ident, f"Thread-{ident}")
+            if self.thread_names is not None and name not in self.thread_names:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(self._frame_label(frame))
+                frame = frame.f_back
+            stack.append(name)
+            key = ";".join(reversed(stack))
+            self.counts[key] = self.counts.get(key, 0) + 1
+        self.samples += 1
+
+    def _write(self):
+        try:
+            if not os.path.exists(LOG_FOLDER):
+                os.makedirs(LOG_FOLDER)
+            filename = f"{PROFILER_OUTPUT_PREFIX}_{datetime.now().strftime('%Y-%m-%d_%H%M%S')}.folded"
+            path = os.path.join(LOG_FOLDER, filename)
+            with open(path, 'w', encoding='utf-8') as f:
+                for stack, count in sorted(self.counts.items()):
+                    f.write(f"{stack} {count}\n")
+
+            # Resumen de las funciones más calientes (hoja de la pila) por hilo
+            leaves = {}
+            for stack, count in self.counts.items():
+                parts = stack.split(";")
+                leaf = f"{parts[0]}: {parts[-1]}"
+                leaves[leaf] = leaves.get(leaf, 0) + count
+            top = sorted(leaves.items(), key=lambda item: item[1], reverse=True)[:5]
+            summary = ", ".join(f"{leaf} ({count * 100 / self.samples:.0f}%)" for leaf, count in top)
+
+            print(f"Perfil guardado en {path} ({self.samples} muestras)")
+            if self.logger:
+                self.logger.info(f"Perfil guardado en {path} ({self.samples} muestras). Más activos: {summary}")
+        except Exception as e:
+            print(f"Error al escribir el perfil: {str(e)}")
+
+def install_profiler_triggers(profiler, overlay):
+    """Conecta el perfilador al atajo de teclado y a la señal del sistema."""
+    shortcut = QtWidgets.QShortcut(QtGui.QKeySequence(PROFILER_HOTKEY), overlay)
+    shortcut.setContext(QtCore.Qt.ApplicationShortcut)
+    shortcut.activated.connect(profiler.toggle)
+
+    # SIGUSR1 (POSIX) o SIGBREAK (Ctrl+Break en la consola de Windows)
+    profiler_signal = getattr(signal, 'SIGUSR1', None) or getattr(signal, 'SIGBREAK', None)
+    if profiler_signal is not None:
+        signal.signal(profiler_signal, lambda signum, frame: profiler.toggle())
+    return shortcut
+
+# El reloj de audio es time.monotonic(); esta diferencia lo convierte a hora local para mostrarlo
+AUDIO_CLOCK_TO_WALL = time.time() - time.monotonic()
+
+def audio_clock_to_wall(capture_time):
+    """Convierte un instante del reloj de audio (monotónico) a segundos epoch."""
+    return capture_time + AUDIO_CLOCK_TO_WALL
+
+class MessageTimeline:
+    """Mensajes de todas las fuentes ordenados por el instante en que se habló.
+
+    Cada texto llega con el intervalo de audio (reloj de muestras) que lo produjo,
+    así que una fuente que se transcribe con retraso se inserta en su lugar y no
+    al final. Un texto continúa el mensaje anterior si es de la misma fuente, nadie
+    habló en medio, es del mismo hablante y el hueco de audio es menor que SILENCE_TIMEOUT.
+
+    Un mensaje se cierra ('final') cuando su audio terminó hace más de
+    SILENCE_TIMEOUT + TIMELINE_FINAL_DELAY (y no espera a ningún refinado): ya no
+    puede crecer y los exportadores pueden escribirlo una sola vez. El refinado
+    sustituye fragmentos con replace_part(), que avisa con 'replace'. Los oyentes reciben ('new' | 'append', mensaje)
+    desde el hilo que publica, con el bloqueo tomado (deben limitarse a copiar o
+    encolar), y ('final', copia del mensaje) desde el hilo del finalizador.
+    """
+
+    def __init__(self, history=TIMELINE_HISTORY):
+        self.history = history
+        self.messages = []  # Ordenados por 'start'
+        self.next_id = 1
+        self.listeners = []
+        self.lock = threading.Lock()
+
+    def add_listener(self, listener):
+        with self.lock:
+            self.listeners.append(listener)
+
+    def _notify(self, event, message):
+        for listener in self.listeners:
+            try:
+                listener(event, message)
+            except Exception as e:
+                print(f"Error en un oyente de la línea de tiempo: {str(e)}")
+
+    def add(self, source, text, start=None, end=None, translation=None, speaker=None, color=None):
+        """Publica un texto de `source` hablado entre start y end (reloj de audio; por defecto ahora).
+
+        speaker y color sustituyen a los de la fuente cuando se distinguen hablantes
+        dentro de ella; solo se continúa un mensaje del mismo hablante.
+        """
+        text = text.strip() if text else ""
+        if not text:
+            return None
+        speaker = speaker or SPEAKERS.get(source, source)
+        now = time.monotonic()
+        if start is None:
+            start = end = now
+        else:
+            metrics.observe("whisper_caption_latency_seconds", max(0.0, now - end), source=source)
+        with self.lock:
+            index = bisect_right([m['start'] for m in self.messages], start)
+            previous = self.messages[index - 1] if index > 0 else None
+            if (previous is not None and previous['source'] == source and previous['speaker'] == speaker
+                    and not previous['final'] and start - previous['end'] < SILENCE_TIMEOUT):
+                previous['text'] += f" {text}"
+                previous['end'] = max(previous['end'], end)
+                previous['parts'].append((start, end, text))
+                previous['translations'].append(translation)
+                if translation:
+                    previous['translation'] = f"{previous['translation']} {translation}".strip()
+                self._notify('append', previous)
+                return previous
+
+            message = {
+                'id': self.next_id,
+                'source': source,
+                'speaker': speaker,
+                'color': color or COLORS.get(source, '#FFFFFF'),
+                'text': text,
+                'start': start,
+                'end': end,
+                'timestamp': time.strftime("%H:%M:%S", time.localtime(audio_clock_to_wall(start))),
+                'parts': [(start, end, text)],  # Cada texto publicado con su intervalo de audio
+                'translation': translation or "",
+                'translations': [translation],  # Traducción de cada fragmento (None si no hay)
+                'final': False,
+                'refining': 0  # Fragmentos pendientes del refinado (retrasan el cierre)
+            }
+            self.next_id += 1
+            self.messages.insert(index, message)
+            if len(self.messages) > self.history:
+                del self.messages[:len(self.messages) - self.history]
+            self._notify('new', message)
+            return message
+
+    def finalize(self, now=None):
+        """Cierra los mensajes que ya no pueden crecer (now=inf los cierra todos)."""
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            due = [m for m in self.messages
+                   if not m['final'] and now - m['end'] >= SILENCE_TIMEOUT + TIMELINE_FINAL_DELAY
+                   and (not m['refining'] or now - m['end'] >= SILENCE_TIMEOUT + REFINE_HOLD_SECONDS)]
+            for message in due:
+                message['final'] = True
+            due = [dict(m, parts=list(m['parts']), translations=list(m['translations'])) for m in due]
+        for message in due:
+            self._notify('final', message)
+
+    def _find(self, message_id):
+        for message in reversed(self.messages):
+            if message['id'] == message_id:
+                return message
+        return None
+
+    def hold(self, message_id):
+        """Retrasa el cierre de un mensaje hasta que llegue su refinado."""
+        with self.lock:
+            message = self._find(message_id)
+            if message is not None:
+                message['refining'] += 1
+
+    def replace_part(self, message_id, index, text):
+        """Sustituye el texto de un fragmento (text=None solo libera la retención).
+
+        Devuelve True si el mensaje cambió.
+        """
+        with self.lock:
+            message = self._find(message_id)
+            if message is None:
+                return False
+            message['refining'] = max(0, message['refining'] - 1)
+            start, end, old_text = message['parts'][index]
+            if not text or text == old_text:
+                return False
+            message['parts'][index] = (start, end, text)
+            message['text'] = " ".join(part[2] for part in message['parts'])
+            self._notify('replace', message)
+            return True
+
+    def run_finalizer(self):
+        """Hilo que cierra periódicamente los mensajes vencidos."""
+        while not shutdown_event.wait(TIMELINE_FINALIZE_INTERVAL):
+            self.finalize()
+
+    def snapshot(self, limit=None):
+        """Copia de los últimos `limit` mensajes en orden de habla."""
+        with self.lock:
+            messages = self.messages[-limit:] if limit else self.messages
+            return [dict(m) for m in messages]
+
+timeline = MessageTimeline()
+
+def format_cue_time(seconds, separator):
+    """Formatea segundos como HH:MM:SS,mmm (SRT) o HH:MM:SS.mmm (WebVTT)."""
+    millis = int(round(max(0.0, seconds) * 1000))
+    hours, millis = divmod(millis, 3600000)
+    minutes, millis = divmod(millis, 60000)
+    secs, millis = divmod(millis, 1000)
+    return f"{hours:02d}:{minutes:02d}:{secs:02d}{separator}{millis:03d}"
+
+def escape_vtt(text):
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+class SubtitleWriter:
+    """Exporta los mensajes cerrados de la línea de tiempo como SRT y WebVTT.
+
+    Cada texto publicado es un cue con su intervalo de audio (segmentos de Whisper
+    sobre el reloj de muestras), relativo al arranque del escritor. Los archivos se
+    abren en modo append y cada cue se escribe una sola vez con un flush por
+    mensaje: el coste de escritura es proporcional al texto nuevo y no al tamaño
+    del archivo, aunque la sesión dure horas.
+    """
+
+    def __init__(self, formats=SUBTITLE_FORMATS, folder=SUBTITLE_FOLDER, logger=None):
+        self.origin = time.monotonic()  # Instante 00:00:00 de los subtítulos
+        self.logger = logger
+        self.cue_index = 0
+        self.last_start = 0.0
+        self.files = {}
+        self.lock = threading.Lock()
+
+        os.makedirs(folder, exist_ok=True)
+        stamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+        for subtitle_format in formats:
+            path = os.path.join(folder, f"{SUBTITLE_FILE}_{stamp}.{subtitle_format}")
+            subtitle_file = open(path, 'a', encoding='utf-8', newline='\n')
+            if subtitle_format == "vtt":
+                subtitle_file.write("WEBVTT\n\n")
+                subtitle_file.flush()
+            self.files[subtitle_format] = subtitle_file
+            print(f"Subtítulos en vivo: {path}")
+            if logger:
+                logger.info(f"Subtítulos en vivo: {path}")
+
+    def on_timeline_event(self, event, message):
+        if event != 'final' or message['source'] == 'system':
+            return
+        with self.lock:
+            if self.files:
+                self._write_message(message)
+
+    def _write_message(self, message):
+        speaker = message['speaker']
+        chunks = {subtitle_format: [] for subtitle_format in self.files}
+        for (start, end, text), translation in zip(message['parts'], message['translations']):
+            # Los cues se escriben en orden de inicio (WebVTT lo exige)
+            start = max(start - self.origin, self.last_start)
+            end = max(end - self.origin, start + SUBTITLE_MIN_CUE_SECONDS)
+            self.last_start = start
+            self.cue_index += 1
+            if "srt" in chunks:
+                chunks["srt"].append(f"{self.cue_index}\n{format_cue_time(start, ',')} --> {format_cue_time(end, ',')}\n"
+                                     f"{speaker}: {text}\n" + (f"{translation}\n" if translation else "") + "\n")
+            if "vtt" in chunks:
+                chunks["vtt"].append(f"{format_cue_time(start, '.')} --> {format_cue_time(end, '.')}\n"
+                                     f"<v {escape_vtt(speaker)}>{escape_vtt(text)}\n"
+                                     + (f"<i>{escape_vtt(translation)}</i>\n" if translation else "") + "\n")
+
+        written = 0
+        for subtitle_format, subtitle_file in self.files.items():
+            data = "".join(chunks[subtitle_format])
+            try:
+                subtitle_file.write(data)
+                subtitle_file.flush()
+                written += len(data.encode('utf-8'))
+            except OSError as e:
+                print(f"Error al escribir subtítulos ({subtitle_format}): {str(e)}")
+        metrics.inc("whisper_subtitle_cues", len(message['parts']))
+        metrics.inc("whisper_subtitle_bytes", written)
+
+    def close(self):
+        with self.lock:
+            for subtitle_file in self.files.values():
+                try:
+                    subtitle_file.close()
+                except OSError:
+                    pass
+            self.files = {}
+            if self.logger:
+                self.logger.info(f"Subtítulos cerrados: {self.cue_index} cues")
+
+WEBSOCKET_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+# Página mínima para una "fuente de navegador" de OBS: http://127.0.0.1:9465/?n=6
+BROADCAST_HTML = """<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>Discord Whisper Overlay</title>
+<style>
+body { margin: 0; background: transparent; font: 22px sans-serif; color: #fff; text-shadow: 0 0 4px #000, 0 0 2px #000; }
+#chat { position: fixed; left: 12px; right: 12px; bottom: 12px; }
+.msg { margin-top: 6px; }
+.partial { opacity: 0.75; }
+.spk { font-weight: bold; }
+.tr { font-style: italic; color: #ddd; font-size: 0.85em; }
+</style></head>
+<body><div id="chat"></div>
+<script>
+const limit = Number(new URLSearchParams(location.search).get("n")) || 6;
+const chat = document.getElementById("chat");
+const messages = new Map();
+
+function render(m) {
+  m.el.className = "msg" + (m.fin ? "" : " partial");
+  m.el.replaceChildren();
+  const spk = document.createElement("span");
+  spk.className = "spk";
+  spk.style.color = m.col;
+  spk.textContent = m.spk + ": ";
+  m.el.append(spk, document.createTextNode(m.txt));
+  if (m.tr) {
+    const tr = document.createElement("div");
+    tr.className = "tr";
+    tr.textContent = m.tr;
+    m.el.append(tr);
+  }
+}
+
+function apply(d) {
+  let m = messages.get(d.id);
+  if (d.t === "new") {
+    if (!m) {
+      m = { el: document.createElement("div") };
+      messages.set(d.id, m);
+      const after = [...messages.values()].find(o => o !== m && o.s > d.s);
+      chat.insertBefore(m.el, after ? after.el : null);
+    }
+    Object.assign(m, { s: d.s, spk: d.spk, col: d.col, txt: d.txt, tr: d.tr || "", n: d.n, fin: false });
+  } else if (!m) {
+    return;
+  } else if (d.t === "app") {
+    if (m.n !== d.n - 1) return;  // Delta repetido
+    m.txt += " " + d.txt;
+    if (d.tr) m.tr = (m.tr + " " + d.tr).trim();
+    m.n = d.n;
+  } else if (d.t === "rep") {
+    m.txt = d.txt;
+  } else if (d.t === "fin") {
+    m.fin = true;
+  }
+  render(m);
+  while (chat.children.length > limit) {
+    const first = chat.firstElementChild;
+    for (const [id, o] of messages) if (o.el === first) messages.delete(id);
+    first.remove();
+  }
+}
+
+function connect() {
+  const ws = new WebSocket("ws://" + location.host + "/ws");
+  ws.onmessage = e => apply(JSON.parse(e.data));
+  ws.onclose = () => setTimeout(connect, 1000);
+}
+connect();
+</script></body></html>
+"""
+
+def websocket_frame(payload, opcode=0x1):
+    """Codifica un frame WebSocket de servidor (sin máscara, RFC 6455)."""
+    header = bytearray([0x80 | opcode])
+    length = len(payload)
+    if length < 126:
+        header.append(length)
+    elif length < 65536:
+        header.append(126)
+        header += struct.pack('!H', length)
+    else:
+        header.append(127)
+        header += struct.pack('!Q', length)
+    return bytes(header) + payload
+
+async def read_websocket_frame(reader):
+    """Lee un frame del cliente y devuelve (opcode, payload) ya sin máscara."""
+    head = await reader.readexactly(2)
+    opcode = head[0] & 0x0F
+    length = head[1] & 0x7F
+    if length == 126:
+        length = struct.unpack('!H', await reader.readexactly(2))[0]
+    elif length == 127:
+        length = struct.unpack('!Q', await reader.readexactly(8))[0]
+    if length > BROADCAST_MAX_CLIENT_FRAME:
+        raise ValueError("frame del cliente demasiado grande")
+    mask = await reader.readexactly(4) if head[1] & 0x80 else None
+    payload = await reader.readexactly(length)
+    if mask:
+        payload = (np.frombuffer(payload, dtype=np.uint8) ^ np.resize(np.frombuffer(mask, dtype=np.uint8), length)).tobytes()
+    return opcode, payload
+
+class BroadcastClient:
+    """Suscriptor WebSocket con su propia cola acotada de frames pendientes."""
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.queue = asyncio.Queue(BROADCAST_CLIENT_QUEUE)
+        self.address = writer.get_extra_info('peername')
+
+class TranscriptBroadcaster:
+    """Servidor asyncio local que difunde la línea de tiempo por WebSocket.
+
+    Los hilos de inferencia solo serializan el delta y lo pasan al bucle con
+    call_soon_threadsafe; el frame se codifica una vez y se encola en cada
+    cliente. Un cliente que no lee y llena su cola se desconecta, de modo que
+    nunca frena al resto ni al pipeline. También sirve en / una página HTML
+    mínima para usarla como fuente de navegador en OBS.
+
+    Deltas JSON: {"t": "new", id, s, spk, col, txt, n, [tr]}, {"t": "app", id, txt, n, e, [tr]}
+    (n = número de fragmentos tras añadir), {"t": "rep", id, txt} y {"t": "fin", id}.
+    """
+
+    def __init__(self, host=BROADCAST_HOST, port=BROADCAST_PORT, logger=None):
+        self.host = host
+        self.port = port
+        self.logger = logger
+        self.loop = None
+        self.server = None
+        self.clients = set()
+        metrics.set_callback("whisper_broadcast_clients", lambda: len(self.clients))
+
+    def start(self):
+        """Arranca el bucle asyncio en un hilo daemon y espera a que el puerto esté abierto."""
+        ready = threading.Event()
+        threading.Thread(target=self._run, args=(ready,), daemon=True, name="BroadcastThread").start()
+        ready.wait(5)
+        return self.server is not None
+
+    def _run(self, ready):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            self.server = loop.run_until_complete(asyncio.start_server(self._handle_connection, self.host, self.port))
+        except OSError as e:
+            print(f"No se pudo iniciar la difusión WebSocket en el puerto {self.port}: {str(e)}")
+            if self.logger:
+                self.logger.warning(f"Difusión WebSocket no disponible: {str(e)}")
+            ready.set()
+            return
+        self.loop = loop
+        ready.set()
+        print(f"Overlay web disponible en http://{self.host}:{self.port}/ (WebSocket en /ws)")
+        if self.logger:
+            self.logger.info(f"Difusión WebSocket iniciada en {self.host}:{self.port}")
+        try:
+            loop.run_forever()
+        finally:
+            self.server.close()
+            loop.close()
+
+    def stop(self):
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+
+    @staticmethod
+    def _delta(event, message):
+        if event == 'new':
+            delta = {'t': 'new', 'id': message['id'], 's': round(audio_clock_to_wall(message['start']), 3),
+                     'spk': message['speaker'], 'col': message['color'],
+                     'txt': message['text'], 'n': len(message['parts'])}
+            if message['translation']:
+                delta['tr'] = message['translation']
+        elif event == 'append':
+            delta = {'t': 'app', 'id': message['id'], 'txt': message['parts'][-1][2], 'n': len(message['parts']),
+                     'e': round(audio_clock_to_wall(message['end']), 3)}
+            if message['translations'][-1]:
+                delta['tr'] = message['translations'][-1]
+        elif event == 'replace':
+            delta = {'t': 'rep', 'id': message['id'], 'txt': message['text']}
+        elif event == 'final':
+            delta = {'t': 'fin', 'id': message['id']}
+        else:
+            return None
+        return json.dumps(delta, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+    def on_timeline_event(self, event, message):
+        """Oyente de la línea de tiempo: O(1) en el hilo que publica."""
+        if self.loop is None or not self.clients:
+            return
+        payload = self._delta(event, message)
+        if payload is not None:
+            self.loop.call_soon_threadsafe(self._broadcast, websocket_frame(payload))
+
+    def _broadcast(self, frame):
+        for client in list(self.clients):
+            try:
+                client.queue.put_nowait(frame)
+            except asyncio.QueueFull:
+                self._drop(client)
+        metrics.inc("whisper_broadcast_frames", len(self.clients))
+
+    def _drop(self, client):
+        """Desconecta a un cliente lento en lugar de acumular frames para él."""
+        self.clients.discard(client)
+        metrics.inc("whisper_broadcast_dropped_clients")
+        print(f"[web] Cliente lento desconectado: {client.address}")
+        client.writer.transport.abort()
+
+    async def _handle_connection(self, reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), 10)
+            lines = request.decode('latin-1').split('\r\n')
+            method, path, _ = lines[0].split(' ', 2)
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError,
+                ConnectionError, ValueError):
+            writer.close()
+            return
+        headers = {}
+        for line in lines[1:]:
+            if ':' in line:
+                name, value = line.split(':', 1)
+                headers[name.strip().lower()] = value.strip()
+        path = path.split('?', 1)[0]
+
+        # Solo páginas servidas desde este equipo pueden suscribirse
+        origin = headers.get('origin', '')
+        if origin and not re.match(r'^https?://(127\.0\.0\.1|localhost|\[::1\])(:\d+)?$', origin):
+            self._send_http(writer, 403, "text/plain", b"Forbidden")
+        elif path == '/ws' and headers.get('upgrade', '').lower() == 'websocket' and 'sec-websocket-key' in headers:
+            await self._serve_websocket(reader, writer, headers['sec-websocket-key'])
+            return
+        elif method == 'GET' and path in ('/', '/overlay'):
+            self._send_http(writer, 200, "text/html; charset=utf-8", BROADCAST_HTML.encode('utf-8'))
+        else:
+            self._send_http(writer, 404, "text/plain", b"Not found")
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass
+        writer.close()
+
+    @staticmethod
+    def _send_http(writer, status, content_type, body):
+        reason = {200: "OK", 403: "Forbidden", 404: "Not Found"}[status]
+        writer.write(f"HTTP/1.1 {status} {reason}\r\nContent-Type: {content_type}\r\n"
+                     f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode('latin-1') + body)
+
+    async def _serve_websocket(self, reader, writer, key):
+        accept = base64.b64encode(hashlib.sha1((key + WEBSOCKET_GUID).encode('ascii')).digest()).decode('ascii')
+        writer.write(("HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+                      f"Sec-WebSocket-Accept: {accept}\r\n\r\n").encode('ascii'))
+
+        # Estado inicial: los últimos mensajes como deltas "new" (y "fin" si ya están cerrados)
+        client = BroadcastClient(writer)
+        for message in timeline.snapshot(min(MAX_CHAT_MESSAGES, BROADCAST_CLIENT_QUEUE // 2)):
+            client.queue.put_nowait(websocket_frame(self._delta('new', message)))
+            if message['final']:
+                client.queue.put_nowait(websocket_frame(self._delta('final', message)))
+        self.clients.add(client)
+        print(f"[web] Cliente conectado: {client.address}")
+
+        sender = asyncio.ensure_future(self._send_loop(client))
+        try:
+            while True:
+                opcode, payload = await read_websocket_frame(reader)
+                if opcode == 0x8:  # Cierre
+                    if client in self.clients:
+                        client.queue.put_nowait(websocket_frame(payload[:2], 0x8))
+                    break
+                if opcode == 0x9:  # Ping
+                    client.queue.put_nowait(websocket_frame(payload, 0xA))
+        except (asyncio.IncompleteReadError, asyncio.QueueFull, ConnectionError, ValueError):
+            pass
+        finally:
+            self.clients.discard(client)
+            if client.queue.full():
+                sender.cancel()
+            else:
+                client.queue.put_nowait(None)
+            try:
+                await asyncio.wait_for(sender, 2)
+            except (asyncio.TimeoutError, asyncio.CancelledError, ConnectionError):
+                pass
+            writer.close()
+
+    async def _send_loop(self, client):
+        while True:
+            frame = await client.queue.get()
+            if frame is None:
+                return
+            client.writer.write(frame)
+            await client.writer.drain()
+
+def start_broadcast_server(logger=None):
+    """Arranca la difusión WebSocket y la suscribe a la línea de tiempo."""
+    broadcaster = TranscriptBroadcaster(logger=logger)
+    if not broadcaster.start():
+        return None
+    timeline.add_listener(broadcaster.on_timeline_event)
+    audio_sources.append(broadcaster)
+    return broadcaster
 
 class TranscriptionOverlay(QtWidgets.QWidget):
+    # Señal para actualizar las etiquetas desde el hilo que publica en la línea de tiempo
+    update_signal = QtCore.pyqtSignal(str, str)
+
     def __init__(self):
         super().__init__()
         self.init_ui()
+        self.update_signal.connect(self.update_text)
+        timeline.add_listener(lambda event, message: self.update_signal.emit(message['source'], message['text']))
         
     def init_ui(self):
         # Ventana sin bordes, transparente y siempre encima
@@ -295,17 +1529,16 @@ class TranscriptionOverlay(QtWidgets.QWidget):
             QtWidgets.QApplication.quit()
 
 class ChatOverlay(QtWidgets.QWidget):
-    # Señal personalizada para actualizar el chat desde otros hilos
-    update_signal = QtCore.pyqtSignal(str, str)
+    # Señal personalizada para redibujar el chat desde otros hilos
+    update_signal = QtCore.pyqtSignal()
     
     def __init__(self):
         super().__init__()
-        self.messages = []  # Lista de mensajes en el chat
-        self.last_speaker = None  # Último hablante para agrupar mensajes consecutivos
-        self.last_message_time = {}  # Almacena la última vez que cada fuente habló
+        self.messages = []  # Últimos mensajes de la línea de tiempo, en orden de habla
         
-        # Conectar la señal a la función que actualiza el chat
-        self.update_signal.connect(self._add_message_safe)
+        # La línea de tiempo agrupa y ordena; el chat solo se redibuja en el hilo principal
+        self.update_signal.connect(self.update_chat_display)
+        timeline.add_listener(lambda event, message: self.update_signal.emit())
         
         self.init_ui()
         
@@ -350,78 +1583,61 @@ class ChatOverlay(QtWidgets.QWidget):
         # Añadir instrucción inicial
         self.add_message("system", "Inicia una conversación hablando por el micrófono")
         
+        # Mini HUD opcional con métricas en vivo
+        if SHOW_METRICS_HUD:
+            self.hud_label = QtWidgets.QLabel("", self)
+            self.hud_label.setStyleSheet(f"color: #AAAAAA; font-size: 11px; background-color: rgba(0, 0, 0, {BG_OPACITY}); padding: 2px 6px; border-radius: 5px;")
+            self.layout.addWidget(self.hud_label)
+            self.hud_timer = QtCore.QTimer(self)
+            self.hud_timer.timeout.connect(self.update_hud)
+            self.hud_timer.start(METRICS_HUD_INTERVAL)
+        
         self.layout.addWidget(self.chat_area)
         self.setLayout(self.layout)
-        
-    def _add_message_safe(self, source, text):
-        """Método seguro para añadir mensajes (llamado desde el hilo principal)"""
-        # Solo añadir mensaje si tiene contenido
-        if not text or text.strip() == "":
-            return
-        
-        current_time = time.time()
-        
-        # Verificar si es un nuevo mensaje o continuación basado en el tiempo transcurrido
-        new_message = True
-        if source in self.last_message_time:
-            time_since_last = current_time - self.last_message_time[source]
-            # Si ha pasado menos tiempo que el umbral de silencio, se considera continuación
-            if time_since_last < SILENCE_TIMEOUT:
-                new_message = False
-        
-        # Actualizar el tiempo del último mensaje para esta fuente
-        self.last_message_time[source] = current_time
-            
-        # Si es un nuevo mensaje o si el hablante cambió
-        if new_message or source != self.last_speaker:
-            # Generar timestamp para nuevo mensaje
-            if SHOW_TIMESTAMPS:
-                timestamp = time.strftime("%H:%M:%S", time.localtime())
-                # Crear nuevo mensaje con timestamp
-                self.messages.append({
-                    'source': source,
-                    'speaker': SPEAKERS.get(source, source),
-                    'text': text,
-                    'time': current_time,
-                    'timestamp': timestamp
-                })
-            else:
-                # Crear nuevo mensaje sin timestamp
-                self.messages.append({
-                    'source': source,
-                    'speaker': SPEAKERS.get(source, source),
-                    'text': text,
-                    'time': current_time
-                })
-            self.last_speaker = source
-        else:
-            # Continuación del mensaje anterior del mismo hablante
-            self.messages[-1]['text'] += f" {text}"
-            
-        # Limitar el número de mensajes para no sobrecargar
-        if len(self.messages) > MAX_CHAT_MESSAGES:
-            self.messages = self.messages[-MAX_CHAT_MESSAGES:]
-            
-        # Actualizar la visualización del chat
-        self.update_chat_display()
     
-    def add_message(self, source, text):
-        """Emite la señal para añadir un mensaje de manera segura entre hilos"""
-        self.update_signal.emit(source, text)
+    def update_hud(self):
+        """Refresca la línea de métricas (se ejecuta en el hilo principal con QTimer)"""
+        parts = []
+        rtf = metrics.histogram_mean("whisper_rtf", source='mic')
+        if rtf is not None:
+            parts.append(f"RTF {rtf:.2f}")
+        inference = metrics.histogram_mean("whisper_inference_seconds", source='mic')
+        if inference is not None:
+            parts.append(f"inf {inference:.2f}s")
+        parts.append(f"cola {metrics.value('whisper_queue_seconds', source='mic'):.1f}s")
+        translate = metrics.histogram_mean("whisper_translate_seconds", source='mic')
+        if DUAL_OUTPUT and translate is not None and inference:
+            parts.append(f"trad +{translate * 100 / inference:.0f}%")
+        parts.append(f"descartes {metrics.sum_by('whisper_filter_rejections')}")
+        rss = metrics.value("whisper_process_rss_bytes")
+        if rss:
+            parts.append(f"RAM {rss / (1024 * 1024):.0f}MB")
+        gpu = metrics.value("whisper_gpu_memory_allocated_bytes")
+        if gpu:
+            parts.append(f"GPU {gpu / (1024**3):.2f}GB")
+        self.hud_label.setText(" | ".join(parts))
+        
+    def add_message(self, source, text, start=None, end=None):
+        """Publica un mensaje en la línea de tiempo (seguro desde cualquier hilo)"""
+        timeline.add(source, text, start, end)
     
     def update_chat_display(self):
         """Actualiza el área de texto con los mensajes actuales"""
+        self.messages = timeline.snapshot(MAX_CHAT_MESSAGES)
         self.chat_area.clear()
         
         # Crear y aplicar el formato HTML para el chat
         html = ""
         for msg in self.messages:
-            color = COLORS.get(msg['source'], '#FFFFFF')
+            color = msg['color']
             speaker = msg['speaker']
             text = msg['text']
+            # Línea traducida debajo del texto original (modo DUAL_OUTPUT)
+            if msg.get('translation'):
+                text += f"<br><span style='color: {TRANSLATION_COLOR}; font-style: italic;'>{msg['translation']}</span>"
             
             # Incluir timestamp si está disponible y activado
-            if SHOW_TIMESTAMPS and 'timestamp' in msg:
+            if SHOW_TIMESTAMPS:
                 timestamp = msg['timestamp']
                 # Formato HTML para el mensaje con timestamp
                 html += f"""
@@ -448,9 +1664,9 @@ class ChatOverlay(QtWidgets.QWidget):
         cursor.movePosition(QtGui.QTextCursor.End)
         self.chat_area.setTextCursor(cursor)
     
-    def update_text(self, source, text):
+    def update_text(self, source, text, start=None, end=None):
         """Método compatible con TranscriptionOverlay para recibir actualizaciones"""
-        self.add_message(source, text)
+        self.add_message(source, text, start, end)
         
     def mousePressEvent(self, event):
         # Permite hacer click para cerrar la ventana
@@ -465,357 +1681,2783 @@ class ChatOverlay(QtWidgets.QWidget):
             self.move(self.mapToGlobal(event.pos() - QtCore.QPoint(self.width() // 2, self.height() // 2)))
             event.accept()
 
-def audio_capture_mic(device_index, frames_queue):
-    """Lee datos del micrófono y los almacena en la cola."""
-    global running
-    p = pyaudio.PyAudio()
-    
-    # Si el dispositivo es None, usar el dispositivo de entrada predeterminado
-    if device_index is None:
-        try:
-            device_index = p.get_default_input_device_info()['index']
-            print(f"Usando dispositivo de entrada predeterminado (índice {device_index})")
-        except Exception as e:
-            print(f"Error al obtener dispositivo predeterminado: {str(e)}")
-            device_index = 0  # Intentar con el primer dispositivo
-    
-    stream = None
-    try:
-        print(f"Intentando abrir stream de micrófono en dispositivo {device_index}...")
-        stream = p.open(
-            format=FORMAT,
-            channels=CHANNELS,
-            rate=RATE,
-            input=True,
-            input_device_index=device_index,
-            frames_per_buffer=CHUNK
-        )
-        
-        print(f"Captura de audio de micrófono iniciada para dispositivo {device_index}")
-        
-        while running:
-            try:
-                data = stream.read(CHUNK, exception_on_overflow=False)
-                frames_queue.append(data)
-            except Exception as e:
-                print(f"Error durante la captura de audio del micrófono: {str(e)}")
-                time.sleep(0.5)  # Esperar un poco antes de intentar nuevamente
-    except Exception as e:
-        print(f"Error crítico al abrir stream para dispositivo de micrófono {device_index}: {str(e)}")
-        print(f"Detalles del error: {traceback.format_exc()}")
-        # Notificar al usuario en la terminal
-        print("\nERROR: No se pudo abrir el dispositivo de audio para el micrófono.")
-        print("Posibles soluciones:")
-        print("1. Verifica que el dispositivo de micrófono esté conectado y funcionando")
-        print("2. Ejecuta device_list.py para ver los dispositivos disponibles")
-        print("3. Modifica MIC_DEVICE en el código con un índice correcto\n")
-        
-        # En caso de error, simular audio silencioso para evitar que el hilo se detenga
-        print("Usando audio simulado para el micrófono...")
-        while running:
-            silent_frame = b'\x00' * CHUNK * CHANNELS * 2  # 2 bytes por muestra (FORMAT=paInt16)
-            frames_queue.append(silent_frame)
-            time.sleep(0.05)
-    finally:
-        if stream is not None:
-            try:
-                stream.stop_stream()
-                stream.close()
-            except:
-                pass
-        try:
-            p.terminate()
-        except:
-            pass
-        print("Hilo de captura de micrófono finalizado")
+class AudioBuffer:
+    """Buffer circular de muestras int16 que avisa al consumidor cuando hay datos.
 
-def simulate_discord_audio(frames_queue):
-    """Genera frames de audio silencioso para Discord."""
-    global running
-    print("Usando audio simulado para Discord...")
-    while running:
-        silent_frame = b'\x00' * CHUNK * CHANNELS * 2
-        frames_queue.append(silent_frame)
-        time.sleep(0.05)
+    El productor (hilo de captura) escribe con write() y el consumidor se bloquea
+    en read() sobre una Condition hasta que haya suficientes muestras, en lugar de
+    consultar el tamaño de la cola cada pocos milisegundos. Solo se notifica cuando
+    se alcanza wake_threshold para no despertar al consumidor en cada chunk.
+    """
 
-def simulate_discord_conversation(overlay):
-    """Simula respuestas de Discord para propósitos de demostración"""
-    global running
-    
-    # Lista de posibles respuestas para la simulación
-    responses = [
-        "Hola, ¿cómo estás hoy?",
-        "Entiendo lo que dices",
-        "¿Podemos hablar sobre el proyecto?",
-        "Esta transcripción funciona muy bien",
-        "Me encanta este modo de chat",
-        "¿Puedes repetir eso por favor?",
-        "¿Te gustaría jugar?",
-        "La reunión empieza en 5 minutos",
+    def __init__(self, source, capacity_seconds=QUEUE_MAX_SECONDS):
+        self.source = source
+        self.capacity = int(RATE * capacity_seconds)
+        self.data = np.zeros(self.capacity, dtype=np.int16)
+        self.write_pos = 0  # Total de muestras escritas desde el inicio
+        self.read_pos = 0   # Total de muestras consumidas desde el inicio
+        # Reloj de muestras: (posición, instante monotónico de esa muestra). Solo se añade
+        # un ancla nueva cuando la captura tuvo un hueco (dispositivo reabierto, fuente en pausa)
+        self.clock_anchors = deque()
+        self.wake_threshold = 1
+        self.listener = None  # Función opcional llamada cuando hay una ventana completa
+        self.archive = None   # AudioArchive opcional que recibe una copia de cada escritura
+        self.closed = False
+        self.cond = threading.Condition()
+
+    def __len__(self):
+        return self.write_pos - self.read_pos
+
+    def write(self, samples, block=False, capture_time=None):
+        """Añade muestras (bytes int16 o array); descarta las más antiguas si se llena.
+
+        Con block=True (fuentes que leen más rápido que el tiempo real) espera a
+        que el consumidor libere espacio en lugar de descartar audio. capture_time
+        es el instante monotónico de la primera muestra (por defecto, el chunk
+        acaba de terminar de capturarse).
+        """
+        if isinstance(samples, (bytes, bytearray)):
+            samples = np.frombuffer(samples, dtype=np.int16)
+        n = len(samples)
+        if n == 0:
+            return
+        if capture_time is None:
+            capture_time = time.monotonic() - n / RATE
+        with self.cond:
+            if block:
+                needed = min(n, self.capacity)
+                while self.capacity - (self.write_pos - self.read_pos) < needed and not self.closed:
+                    self.cond.wait()
+            self._sync_clock(capture_time)
+            if n > self.capacity:
+                samples = samples[-self.capacity:]
+                self.write_pos += n - self.capacity
+                n = self.capacity
+            start = self.write_pos % self.capacity
+            first = min(n, self.capacity - start)
+            self.data[start:start + first] = samples[:first]
+            if first < n:
+                self.data[:n - first] = samples[first:]
+            self.write_pos += n
+            if self.archive is not None:
+                self.archive.write(samples, capture_time)
+
+            overflow = self.write_pos - self.read_pos - self.capacity
+            if overflow > 0:
+                self.read_pos += overflow
+                metrics.inc("whisper_dropped_samples", overflow, source=self.source)
+
+            if self.write_pos - self.read_pos >= self.wake_threshold:
+                self.cond.notify_all()
+                if self.listener is not None:
+                    self.listener()
+
+    def _sync_clock(self, capture_time):
+        # El reloj de muestras manda; el reloj real solo se usa para detectar huecos
+        if self.clock_anchors:
+            anchor_pos, anchor_time = self.clock_anchors[-1]
+            expected = anchor_time + (self.write_pos - anchor_pos) / RATE
+            if capture_time - expected <= AUDIO_CLOCK_RESYNC:
+                return
+        self.clock_anchors.append((self.write_pos, capture_time))
+
+    def _clock_at(self, pos):
+        for anchor_pos, anchor_time in reversed(self.clock_anchors):
+            if anchor_pos <= pos:
+                return anchor_time + (pos - anchor_pos) / RATE
+        return time.monotonic()
+
+    def clock_at(self, pos):
+        """Instante monotónico en que se capturó la muestra número `pos`."""
+        with self.cond:
+            return self._clock_at(pos)
+
+    def read(self, n, with_time=False):
+        """Espera hasta tener n muestras y las devuelve (None si el buffer se cerró).
+
+        Con with_time=True devuelve (muestras, instante de captura de la primera muestra).
+        """
+        with self.cond:
+            while self.write_pos - self.read_pos < n and not self.closed:
+                self.cond.wait()
+            if self.write_pos - self.read_pos < n:
+                return None
+            start_time = self._clock_at(self.read_pos)
+            start = self.read_pos % self.capacity
+            first = min(n, self.capacity - start)
+            if first == n:
+                out = self.data[start:start + n].copy()
+            else:
+                out = np.concatenate((self.data[start:], self.data[:n - first]))
+            self.read_pos += n
+            while len(self.clock_anchors) > 1 and self.clock_anchors[1][0] <= self.read_pos:
+                self.clock_anchors.popleft()
+            # Avisar a productores bloqueados en write(block=True)
+            self.cond.notify_all()
+            return (out, start_time) if with_time else out
+
+    def peek(self, start_time, n):
+        """Copia (sin consumir) las n muestras capturadas desde start_time.
+
+        El anillo conserva hasta QUEUE_MAX_SECONDS de audio ya leído, así que
+        sirve como historial de la fuente. Las muestras que aún no se han
+        escrito o que ya se sobrescribieron se devuelven como silencio; devuelve
+        None si el intervalo no se solapa con el audio disponible.
+        """
+        with self.cond:
+            if not self.clock_anchors:
+                return None
+            # Ancla vigente en start_time (la más reciente anterior a ese instante)
+            anchor_pos, anchor_time = self.clock_anchors[0]
+            for pos, anchor in reversed(self.clock_anchors):
+                if anchor <= start_time:
+                    anchor_pos, anchor_time = pos, anchor
+                    break
+            first_pos = anchor_pos + int(round((start_time - anchor_time) * RATE))
+            begin = max(first_pos, self.write_pos - self.capacity, 0)
+            end = min(first_pos + n, self.write_pos)
+            if end <= begin:
+                return None
+            out = np.zeros(n, dtype=np.int16)
+            start = begin % self.capacity
+            count = end - begin
+            first = min(count, self.capacity - start)
+            out[begin - first_pos:begin - first_pos + first] = self.data[start:start + first]
+            if first < count:
+                out[begin - first_pos + first:end - first_pos] = self.data[:count - first]
+            return out
+
+    def try_read(self, n, with_time=False):
+        """Devuelve n muestras si ya están disponibles, o None sin esperar."""
+        with self.cond:
+            if self.write_pos - self.read_pos < n:
+                return None
+            return self.read(n, with_time)
+
+    def pad_to_threshold(self):
+        """Completa con silencio la última ventana parcial (fin de una fuente finita)."""
+        with self.cond:
+            pending = (self.write_pos - self.read_pos) % self.wake_threshold
+            end_time = self._clock_at(self.write_pos)
+        if pending:
+            # El silencio continúa el reloj de muestras en lugar de abrir un hueco
+            self.write(np.zeros(self.wake_threshold - pending, dtype=np.int16), block=True, capture_time=end_time)
+
+    def close(self):
+        """Libera a cualquier consumidor bloqueado en read()."""
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+class AudioArchive:
+    """Anillo de PCM int16 en disco con el audio capturado de una fuente.
+
+    El archivo .pcm tiene tamaño fijo (ARCHIVE_MINUTES) y se mapea en memoria,
+    así que cada escritura es una copia a la caché de páginas y el sistema
+    operativo la vuelca a disco en segundo plano. El índice .json relaciona
+    posiciones de muestra con la hora real (como AudioBuffer, solo se añade un
+    ancla cuando la captura tuvo un hueco) y se guarda cada
+    ARCHIVE_SYNC_SECONDS desde otro hilo; al reabrir el archivo el anillo
+    continúa donde se quedó.
+    """
+
+    def __init__(self, source, folder=ARCHIVE_FOLDER, minutes=ARCHIVE_MINUTES, readonly=False):
+        self.source = source
+        self.pcm_path = os.path.join(folder, f"{source}.pcm")
+        self.index_path = os.path.join(folder, f"{source}.json")
+        self.capacity = int(RATE * 60 * minutes)
+        self.write_pos = 0
+        self.anchors = deque()  # (posición, hora epoch de esa muestra)
+        self.lock = threading.Lock()
+        index = None
+        if os.path.exists(self.index_path):
+            with open(self.index_path, encoding='utf-8') as f:
+                index = json.load(f)
+        if readonly:
+            if index is None:
+                raise FileNotFoundError(f"No hay archivo de audio de '{source}' en {folder}")
+            self.capacity = index['capacity']
+        if index is not None and index['capacity'] == self.capacity and index['rate'] == RATE:
+            self.write_pos = index['write_pos']
+            self.anchors = deque(tuple(anchor) for anchor in index['anchors'])
+        mode = 'r' if readonly else ('r+' if self.write_pos else 'w+')
+        if mode == 'w+':
+            os.makedirs(folder, exist_ok=True)
+        self.data = np.memmap(self.pcm_path, dtype=np.int16, mode=mode, shape=(self.capacity,))
+
+    def write(self, samples, capture_time):
+        """Copia un bloque recién capturado (se llama desde AudioBuffer.write)."""
+        n = len(samples)
+        with self.lock:
+            wall_time = audio_clock_to_wall(capture_time)
+            if self.anchors:
+                anchor_pos, anchor_time = self.anchors[-1]
+                expected = anchor_time + (self.write_pos - anchor_pos) / RATE
+            if not self.anchors or wall_time - expected > AUDIO_CLOCK_RESYNC:
+                self.anchors.append((self.write_pos, wall_time))
+            if n > self.capacity:
+                samples = samples[-self.capacity:]
+                self.write_pos += n - self.capacity
+                n = self.capacity
+            start = self.write_pos % self.capacity
+            first = min(n, self.capacity - start)
+            self.data[start:start + first] = samples[:first]
+            if first < n:
+                self.data[:n - first] = samples[first:]
+            self.write_pos += n
+
+    def sync(self):
+        """Guarda el índice y vuelca a disco las páginas modificadas (fuera del hilo de captura)."""
+        with self.lock:
+            oldest = self.write_pos - self.capacity
+            while len(self.anchors) > 1 and self.anchors[1][0] <= oldest:
+                self.anchors.popleft()
+            index = {'source': self.source, 'rate': RATE, 'capacity': self.capacity,
+                     'write_pos': self.write_pos, 'anchors': list(self.anchors)}
+        self.data.flush()
+        temp_path = self.index_path + ".tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(index, f)
+        os.replace(temp_path, self.index_path)  # El índice nunca queda a medias
+
+    def _position_at(self, wall_time):
+        # Un instante dentro de un hueco de la captura corresponde al inicio del tramo siguiente
+        next_pos = self.write_pos
+        for pos, anchor in reversed(self.anchors):
+            if anchor <= wall_time:
+                return min(pos + int(round((wall_time - anchor) * RATE)), next_pos)
+            next_pos = pos
+        return next_pos
+
+    def read_range(self, start, end):
+        """Muestras entre dos horas epoch, recortadas al audio que conserva el anillo."""
+        with self.lock:
+            if not self.anchors:
+                return np.zeros(0, dtype=np.int16)
+            first = max(self._position_at(start), self.write_pos - self.capacity, 0)
+            last = min(self._position_at(end), self.write_pos)
+            if last <= first:
+                return np.zeros(0, dtype=np.int16)
+            offset = first % self.capacity
+            count = last - first
+            head = min(count, self.capacity - offset)
+            return np.concatenate((self.data[offset:offset + head], self.data[:count - head]))
+
+    def export_wav(self, start, end, path):
+        """Escribe en un WAV mono de 16 bits el audio entre dos horas epoch; devuelve los segundos exportados."""
+        samples = self.read_range(start, end)
+        with wave.open(path, 'wb') as wav:
+            wav.setnchannels(1)
+            wav.setsampwidth(2)
+            wav.setframerate(RATE)
+            wav.writeframes(samples.tobytes())
+        return len(samples) / RATE
+
+    def close(self):
+        self.sync()
+
+def run_archive_sync():
+    """Hilo que guarda periódicamente los índices de los archivos de audio."""
+    while not shutdown_event.wait(ARCHIVE_SYNC_SECONDS):
+        for archive in list(audio_archives):
+            try:
+                archive.sync()
+            except OSError as e:
+                print(f"[{archive.source}] Error al sincronizar el archivo de audio: {str(e)}")
+
+def parse_archive_time(value):
+    """Convierte 'HH:MM[:SS]' (hoy), 'AAAA-MM-DD HH:MM:SS' o segundos epoch en hora epoch."""
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    for fmt in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%H:%M:%S", "%H:%M"):
+        try:
+            parsed = datetime.strptime(value, fmt)
+        except ValueError:
+            continue
+        if not fmt.startswith("%Y"):
+            parsed = datetime.combine(datetime.now().date(), parsed.time())
+        return parsed.timestamp()
+    raise ValueError(f"Hora no válida: {value}")
+
+def export_archive(source, start, end, output):
+    """Exporta a WAV un tramo del archivo de una fuente sin abrir la interfaz ni el modelo."""
+    archive = AudioArchive(source, readonly=True)
+    seconds = archive.export_wav(parse_archive_time(start), parse_archive_time(end), output)
+    print(f"Exportados {seconds:.1f}s de '{source}' a {output}")
+    # El WAV se puede volver a transcribir con una fuente {'type': 'file', 'path': output, 'realtime': False}
+    return 0 if seconds else 1
+
+def create_audio_buffer(source):
+    """Crea un AudioBuffer y lo registra para cerrarlo al salir."""
+    audio_buffer = AudioBuffer(source)
+    audio_buffers.append(audio_buffer)
+    if ARCHIVE_ENABLED and (ARCHIVE_SOURCES is None or source in ARCHIVE_SOURCES):
+        try:
+            audio_buffer.archive = AudioArchive(source)
+            audio_archives.append(audio_buffer.archive)
+        except OSError as e:
+            print(f"[{source}] No se pudo abrir el archivo de audio: {str(e)}")
+    return audio_buffer
+
+def request_shutdown():
+    """Detiene todos los hilos: marca running, despierta esperas y cierra buffers y fuentes."""
+    global running
+    running = False
+    shutdown_event.set()
+    for audio_buffer in audio_buffers:
+        audio_buffer.close()
+    for audio_source in audio_sources:
+        audio_source.stop()
+
+class StreamingResampler:
+    """Remuestreador polifásico racional (in_rate -> out_rate) para audio en streaming.
+
+    El filtro anti-aliasing (sinc con ventana Kaiser) se descompone en `up` fases;
+    cada chunk se procesa de forma vectorizada (una vista deslizante y un einsum)
+    y el historial de entrada y la fase se conservan entre chunks, así que la
+    salida es idéntica a procesar toda la señal de una vez.
+    """
+
+    def __init__(self, in_rate, out_rate=RATE, taps_per_phase=RESAMPLER_TAPS_PER_PHASE):
+        g = math.gcd(int(in_rate), int(out_rate))
+        self.in_rate = int(in_rate)
+        self.out_rate = int(out_rate)
+        self.up = self.out_rate // g
+        self.down = self.in_rate // g
+        self.taps = taps_per_phase
+
+        # Prototipo paso bajo a la frecuencia sobremuestreada in_rate * up
+        length = self.up * taps_per_phase
+        cutoff = RESAMPLER_ROLLOFF / max(self.up, self.down)
+        n = np.arange(length) - (length - 1) / 2.0
+        h = cutoff * np.sinc(cutoff * n) * np.kaiser(length, RESAMPLER_KAISER_BETA)
+        h *= self.up / h.sum()  # Ganancia unitaria tras la interpolación
+
+        # Fase p, coeficiente k -> h[p + k * up]; invertido para operar sobre ventanas crecientes
+        self.phases = h.reshape(taps_per_phase, self.up).T[:, ::-1].astype(np.float32).copy()
+        self.history = np.zeros(taps_per_phase - 1, dtype=np.float32)
+        self.next_t = 0  # Próxima muestra de salida en coordenadas sobremuestreadas del chunk
+
+    def process(self, samples):
+        """Remuestrea un chunk int16 y devuelve las muestras int16 a out_rate."""
+        x = np.asarray(samples, dtype=np.float32)
+        n_in = len(x)
+        extended = np.concatenate((self.history, x))
+        limit = n_in * self.up
+        if self.next_t >= limit:
+            out = np.empty(0, dtype=np.int16)
+        else:
+            t = np.arange(self.next_t, limit, self.down)
+            windows = np.lib.stride_tricks.sliding_window_view(extended, self.taps)
+            y = np.einsum('ij,ij->i', self.phases[t % self.up], windows[t // self.up])
+            out = np.clip(np.rint(y), -32768, 32767).astype(np.int16)
+            self.next_t = int(t[-1]) + self.down
+        self.next_t -= limit
+        self.history = extended[len(extended) - (self.taps - 1):]
+        return out
+
+class CaptureWriter:
+    """Reparte cada chunk capturado (muestras intercaladas) entre los buffers de sus fuentes.
+
+    Con varios canales, cada fuente recibe una vista con stride del array
+    intercalado (frames[:, canal]), sin copias intermedias: AudioBuffer.write()
+    copia la vista directamente a su anillo. Todos los canales se escriben en
+    la misma llamada, así que las fuentes quedan alineadas muestra a muestra.
+    """
+
+    def __init__(self, outputs, channels=1, rate=RATE):
+        self.channels = channels
+        self.rate = rate
+        # (canal, buffer, remuestreador) por fuente; cada canal tiene su propio estado de filtro
+        self.outputs = [(channel, audio_buffer, StreamingResampler(rate, RATE) if rate != RATE else None)
+                        for channel, audio_buffer in outputs]
+
+    def write(self, data, capture_time=None):
+        samples = np.frombuffer(data, dtype=np.int16)
+        if self.channels > 1:
+            samples = samples[:len(samples) - len(samples) % self.channels].reshape(-1, self.channels)
+        if capture_time is None:
+            capture_time = time.monotonic() - len(samples) / self.rate
+        for channel, audio_buffer, resampler in self.outputs:
+            view = samples[:, channel] if self.channels > 1 else samples
+            if resampler is not None:
+                start = time.perf_counter()
+                view = resampler.process(view)
+                elapsed = time.perf_counter() - start
+                metrics.observe("whisper_resample_seconds", elapsed, source=audio_buffer.source)
+                metrics.inc("whisper_resample_cpu_seconds", elapsed, source=audio_buffer.source)
+                metrics.inc("whisper_resample_audio_seconds", len(samples) / self.rate, source=audio_buffer.source)
+            audio_buffer.write(view, capture_time=capture_time)
+
+class CaptureCallback:
+    """Callback de PortAudio que escribe directamente en el AudioBuffer.
+
+    Se ejecuta en el hilo de audio de PortAudio, así que solo hace trabajo O(1):
+    copiar las muestras, contar desbordamientos y medir latencia y jitter.
+    """
+
+    def __init__(self, source, writer, rate=RATE):
+        self.source = source
+        self.writer = writer
+        self.rate = rate
+        self.last_callback = None  # time.perf_counter() de la última llamada
+
+    def __call__(self, in_data, frame_count, time_info, status_flags):
+        now = time.perf_counter()
+        if status_flags & pyaudio.paInputOverflow:
+            metrics.inc("whisper_capture_overflows", source=self.source)
+        if status_flags & pyaudio.paInputUnderflow:
+            metrics.inc("whisper_capture_underflows", source=self.source)
+        # Latencia entre el ADC y la entrega al callback (algunas APIs devuelven 0)
+        adc_time = time_info.get('input_buffer_adc_time', 0) if time_info else 0
+        current_time = time_info.get('current_time', 0) if time_info else 0
+        adc_latency = current_time - adc_time if adc_time and current_time else 0
+        if adc_latency:
+            metrics.set("whisper_capture_latency_seconds", adc_latency, source=self.source)
+        if in_data:
+            self.writer.write(in_data, time.monotonic() - adc_latency - frame_count / self.rate)
+        # Jitter: desviación del intervalo entre callbacks respecto al esperado
+        if self.last_callback is not None:
+            metrics.observe("whisper_capture_jitter_seconds",
+                            abs((now - self.last_callback) - frame_count / self.rate), source=self.source)
+        self.last_callback = now
+
+        return (None, pyaudio.paContinue if running else pyaudio.paComplete)
+
+def audio_capture_device(device_index, outputs, source='mic', channels=CHANNELS):
+    """Captura audio de un dispositivo PyAudio en los buffers, reabriendo el dispositivo si falla.
+
+    `outputs` es una lista de (canal, AudioBuffer): con channels > 1 se abre un único
+    stream multicanal y cada canal alimenta el buffer de su fuente.
+
+    En modo "callback" PortAudio entrega el audio desde su propio hilo y este hilo
+    solo vigila el stream; en modo "blocking" se lee con stream.read(). Los errores
+    reabren el dispositivo con backoff exponencial acotado por CAPTURE_RETRY_MAX.
+    """
+    global running
+    p = pyaudio.PyAudio()
+    
+    # Si el dispositivo es None, usar el dispositivo de entrada predeterminado
+    if device_index is None:
+        try:
+            device_index = p.get_default_input_device_info()['index']
+            print(f"Usando dispositivo de entrada predeterminado (índice {device_index})")
+        except Exception as e:
+            print(f"Error al obtener dispositivo predeterminado: {str(e)}")
+            device_index = 0  # Intentar con el primer dispositivo
+    
+    backoff = CAPTURE_RETRY_INITIAL
+    first_failure = True
+    try:
+        while running:
+            stream = None
+            opened_at = None
+            try:
+                # Muchas interfaces y cables virtuales solo funcionan a 44.1/48 kHz:
+                # capturar a su frecuencia nativa y remuestrear a RATE en software
+                capture_rate = RATE
+                if CAPTURE_NATIVE_RATE:
+                    capture_rate = int(p.get_device_info_by_index(device_index)['defaultSampleRate'])
+                writer = CaptureWriter(outputs, channels, capture_rate)
+                frames_per_buffer = int(CHUNK * capture_rate / RATE)
+                
+                print(f"[{source}] Intentando abrir stream en dispositivo {device_index} a {capture_rate} Hz...")
+                callback = CaptureCallback(source, writer, capture_rate) if CAPTURE_MODE == "callback" else None
+                stream = p.open(
+                    format=FORMAT,
+                    channels=channels,
+                    rate=capture_rate,
+                    input=True,
+                    input_device_index=device_index,
+                    frames_per_buffer=frames_per_buffer,
+                    stream_callback=callback
+                )
+                opened_at = time.time()
+                metrics.set("whisper_capture_input_latency_seconds", stream.get_input_latency(), source=source)
+                print(f"[{source}] Captura de audio iniciada para dispositivo {device_index} (modo {CAPTURE_MODE}, {capture_rate} Hz)")
+                
+                if callback is not None:
+                    # PortAudio escribe en el buffer; aquí solo se detecta si el stream
+                    # se detiene o deja de entregar audio (p. ej. dispositivo desconectado)
+                    stream.start_stream()
+                    started = time.perf_counter()
+                    while running and not shutdown_event.wait(CAPTURE_WATCHDOG_INTERVAL):
+                        last_audio = callback.last_callback or started
+                        stalled = time.perf_counter() - last_audio > CAPTURE_WATCHDOG_INTERVAL
+                        if not stream.is_active() or stalled:
+                            raise IOError("el stream de captura dejó de entregar audio")
+                else:
+                    while running:
+                        try:
+                            data = stream.read(frames_per_buffer, exception_on_overflow=True)
+                        except IOError as e:
+                            if getattr(e, 'errno', None) == pyaudio.paInputOverflowed:
+                                # Se perdió audio por desbordamiento: contarlo y seguir leyendo
+                                metrics.inc("whisper_capture_overflows", source=source)
+                                continue
+                            raise
+                        writer.write(data)
+            except Exception as e:
+                if not running:
+                    break
+                metrics.inc("whisper_capture_errors", source=source)
+                print(f"[{source}] Error en la captura de audio (dispositivo {device_index}): {str(e)}")
+                if first_failure:
+                    first_failure = False
+                    print(f"Detalles del error: {traceback.format_exc()}")
+                    # Notificar al usuario en la terminal
+                    print(f"\nERROR: No se pudo abrir el dispositivo de audio para '{source}'.")
+                    print("Posibles soluciones:")
+                    print("1. Verifica que el dispositivo esté conectado y funcionando")
+                    print("2. Ejecuta device_list.py para ver los dispositivos disponibles")
+                    print("3. Modifica MIC_DEVICE o la entrada 'device' en AUDIO_SOURCES con un índice correcto\n")
+                
+                # Si el stream funcionó un buen rato, el fallo es nuevo: reiniciar el backoff
+                if opened_at is not None and time.time() - opened_at > CAPTURE_RETRY_MAX:
+                    backoff = CAPTURE_RETRY_INITIAL
+                print(f"Reintentando abrir el dispositivo en {backoff:.1f}s...")
+                if shutdown_event.wait(backoff):
+                    break
+                backoff = min(backoff * 2, CAPTURE_RETRY_MAX)
+            finally:
+                if stream is not None:
+                    try:
+                        stream.stop_stream()
+                        stream.close()
+                    except:
+                        pass
+    finally:
+        try:
+            p.terminate()
+        except:
+            pass
+        print(f"Hilo de captura de {source} finalizado")
+
+class AudioSource:
+    """Fuente de audio genérica: produce PCM int16 y lo escribe en su AudioBuffer.
+
+    Las subclases implementan run() (se ejecuta en el hilo de captura) y entregan
+    el audio con feed(), que convierte a mono y remuestrea a RATE, de modo que el
+    resto del pipeline recibe siempre el mismo formato sea cual sea el origen.
+    """
+
+    def __init__(self, name, audio_buffer, config):
+        self.name = name
+        self.audio_buffer = audio_buffer
+        self.config = config
+        self.rate = int(config.get('rate', RATE))
+        self.channels = int(config.get('channels', 1))
+        self.resampler = StreamingResampler(self.rate, RATE) if self.rate != RATE else None
+        self.pending = b""  # Bytes sobrantes que no completan un frame
+
+    def run(self):
+        raise NotImplementedError
+
+    def stop(self):
+        """Desbloquea run() si está esperando en una operación de E/S."""
+        pass
+
+    def feed(self, data, block=False):
+        """Entrega PCM s16le intercalado (rate/channels de la fuente) al buffer."""
+        if self.pending:
+            data = self.pending + data
+        frame_bytes = 2 * self.channels
+        usable = len(data) - len(data) % frame_bytes
+        self.pending = data[usable:]
+        if usable == 0:
+            return
+        samples = np.frombuffer(data[:usable], dtype=np.int16)
+        if self.channels > 1:
+            samples = samples.reshape(-1, self.channels).mean(axis=1).astype(np.int16)
+        if self.resampler is not None:
+            samples = self.resampler.process(samples)
+        self.audio_buffer.write(samples, block=block)
+
+    def finish(self):
+        """Marca el fin de una fuente finita para que se transcriba la última ventana."""
+        self.audio_buffer.pad_to_threshold()
+        print(f"[{self.name}] Fin de la fuente de audio")
+
+class DeviceSource(AudioSource):
+    """Dispositivo de entrada PyAudio (micrófono, cable virtual, etc.)."""
+
+    def run(self):
+        audio_capture_device(self.config.get('device'), [(0, self.audio_buffer)], self.name)
+
+class MultichannelDeviceSource(AudioSource):
+    """Un único stream PyAudio de N canales repartido entre varias fuentes.
+
+    Útil con interfaces y mezcladores loopback que exponen micrófono y Discord
+    como canales del mismo dispositivo: un solo stream, un solo hilo y un solo
+    reloj para todas las fuentes.
+    """
+
+    def __init__(self, name, audio_buffers, config):
+        super().__init__(name, None, config)
+        self.audio_buffers = audio_buffers  # nombre de fuente -> AudioBuffer
+
+    def run(self):
+        channel_map = self.config['channels']
+        outputs = [(channel, self.audio_buffers[source]) for source, channel in channel_map.items()]
+        audio_capture_device(self.config.get('device'), outputs, self.name, max(channel_map.values()) + 1)
+
+class NullSource(AudioSource):
+    """Fuente sin audio: queda aparcada hasta el cierre sin despertar a nadie."""
+
+    def run(self):
+        print(f"[{self.name}] Fuente sin audio (aparcada)")
+        shutdown_event.wait()
+
+class FileSource(AudioSource):
+    """Archivo WAV (o FLAC/OGG con soundfile), en tiempo real o lo más rápido posible."""
+
+    def run(self):
+        path = self.config['path']
+        realtime = self.config.get('realtime', True)
+        try:
+            if path.lower().endswith('.wav'):
+                blocks = self._read_wav(path)
+            elif SOUNDFILE_AVAILABLE:
+                blocks = self._read_soundfile(path)
+            else:
+                print(f"[{self.name}] Para leer {path} instala soundfile: pip install soundfile")
+                return
+            
+            print(f"[{self.name}] Leyendo {path} ({'tiempo real' if realtime else 'máxima velocidad'})")
+            next_time = time.monotonic()
+            for block in blocks:
+                if not running:
+                    return
+                # En modo rápido se bloquea cuando el buffer está lleno en lugar de perder audio
+                self.feed(block, block=not realtime)
+                if realtime:
+                    next_time += len(block) / (2 * self.channels * self.rate)
+                    delay = next_time - time.monotonic()
+                    if delay > 0 and shutdown_event.wait(delay):
+                        return
+            self.finish()
+        except Exception as e:
+            print(f"[{self.name}] Error al leer el archivo de audio {path}: {str(e)}")
+
+    def _read_wav(self, path):
+        with wave.open(path, 'rb') as wav:
+            if wav.getsampwidth() != 2:
+                raise ValueError("solo se admiten archivos WAV PCM de 16 bits")
+            self.rate = wav.getframerate()
+            self.channels = wav.getnchannels()
+            self.resampler = StreamingResampler(self.rate, RATE) if self.rate != RATE else None
+            frames_per_block = int(CHUNK * self.rate / RATE)
+            while True:
+                block = wav.readframes(frames_per_block)
+                if not block:
+                    break
+                yield block
+
+    def _read_soundfile(self, path):
+        with soundfile.SoundFile(path) as f:
+            self.rate = f.samplerate
+            self.channels = f.channels
+            self.resampler = StreamingResampler(self.rate, RATE) if self.rate != RATE else None
+            for block in f.blocks(blocksize=int(CHUNK * self.rate / RATE), dtype='int16'):
+                yield block.tobytes()
+
+class PipeSource(AudioSource):
+    """PCM s16le crudo desde stdin ('-') o un FIFO con nombre."""
+
+    def run(self):
+        path = self.config.get('path', '-')
+        block_size = int(CHUNK * self.rate / RATE) * 2 * self.channels
+        while running:
+            try:
+                stream = sys.stdin.buffer if path == '-' else open(path, 'rb')
+                print(f"[{self.name}] Leyendo PCM crudo de {'stdin' if path == '-' else path}")
+                while running:
+                    data = stream.read(block_size)
+                    if not data:
+                        break
+                    self.feed(data)
+                if path == '-':
+                    self.finish()
+                    return
+                # Un FIFO llega a EOF cuando el escritor lo cierra: volver a abrirlo
+                stream.close()
+            except Exception as e:
+                print(f"[{self.name}] Error al leer PCM de {path}: {str(e)}")
+                if shutdown_event.wait(CAPTURE_RETRY_INITIAL):
+                    return
+
+class SocketSource(AudioSource):
+    """PCM s16le crudo por un socket TCP (un cliente a la vez) o UDP local."""
+
+    def __init__(self, name, audio_buffer, config):
+        super().__init__(name, audio_buffer, config)
+        self.protocol = config['type']
+        self.sock = None
+
+    def run(self):
+        host = self.config.get('host', SOURCE_BIND_HOST)
+        port = int(self.config['port'])
+        try:
+            if self.protocol == 'udp':
+                self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                self.sock.bind((host, port))
+                print(f"[{self.name}] Escuchando PCM por UDP en {host}:{port}")
+                while running:
+                    data, _ = self.sock.recvfrom(65536)
+                    self.feed(data)
+            else:
+                self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                self.sock.bind((host, port))
+                self.sock.listen(1)
+                print(f"[{self.name}] Escuchando PCM por TCP en {host}:{port}")
+                while running:
+                    conn, address = self.sock.accept()
+                    print(f"[{self.name}] Cliente conectado desde {address[0]}:{address[1]}")
+                    with conn:
+                        while running:
+                            data = conn.recv(65536)
+                            if not data:
+                                break
+                            self.feed(data)
+                    self.pending = b""
+                    print(f"[{self.name}] Cliente desconectado")
+        except OSError as e:
+            if running:
+                print(f"[{self.name}] Error en el socket {self.protocol.upper()} {host}:{port}: {str(e)}")
+
+    def stop(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+
+AUDIO_SOURCE_TYPES = {
+    'device': DeviceSource,
+    'file': FileSource,
+    'pipe': PipeSource,
+    'tcp': SocketSource,
+    'udp': SocketSource,
+    'none': NullSource,
+    'multichannel': MultichannelDeviceSource,
+}
+
+def source_names(config):
+    """Nombres de las fuentes que produce una entrada de AUDIO_SOURCES."""
+    if config.get('type') == 'multichannel':
+        return list(config['channels'])
+    return [config['name']]
+
+def create_audio_source(config, audio_buffers):
+    """Instancia la fuente descrita por una entrada de AUDIO_SOURCES.
+
+    `audio_buffers` asocia cada nombre de source_names(config) con su AudioBuffer.
+    """
+    source_type = config.get('type', 'device')
+    if source_type not in AUDIO_SOURCE_TYPES:
+        raise ValueError(f"Tipo de fuente de audio desconocido: {source_type}")
+    name = config['name']
+    if 'label' in config:
+        SPEAKERS[name] = config['label']
+    if 'color' in config:
+        COLORS[name] = config['color']
+    if source_type == 'multichannel':
+        audio_source = MultichannelDeviceSource(name, audio_buffers, config)
+    else:
+        audio_source = AUDIO_SOURCE_TYPES[source_type](name, audio_buffers[name], config)
+    audio_sources.append(audio_source)
+    return audio_source
+
+def parse_rtp_packet(packet):
+    """Extrae (payload_type, secuencia, timestamp, ssrc, payload) de un paquete RTP v2."""
+    if len(packet) < 12 or packet[0] >> 6 != 2:
+        return None
+    csrc_count = packet[0] & 0x0F
+    payload_type = packet[1] & 0x7F
+    sequence, timestamp, ssrc = struct.unpack('!HII', packet[2:12])
+    offset = 12 + 4 * csrc_count
+    if packet[0] & 0x10:  # Cabecera de extensión (p. ej. 0xBEDE de Discord)
+        if len(packet) < offset + 4:
+            return None
+        extension_words = struct.unpack('!H', packet[offset + 2:offset + 4])[0]
+        offset += 4 + 4 * extension_words
+    end = len(packet)
+    if packet[0] & 0x20:  # Relleno: el último byte indica cuántos bytes sobran
+        end -= packet[-1]
+    if offset > end:
+        return None
+    return payload_type, sequence, timestamp, ssrc, packet[offset:end]
+
+class RtpStream:
+    """Un hablante (SSRC) con su propio decodificador, buffer y estado de transcripción."""
+
+    def __init__(self, ssrc, index):
+        self.ssrc = ssrc
+        self.source = f"discord-{ssrc}"
+        # Registrado como el resto de buffers: se cierra al salir, se archiva y aparece en las métricas
+        self.buffer = create_audio_buffer(self.source)
+        self.state = SourceState(self.source)
+        self.decoder = None
+        self.resampler = None
+        self.clock_rate = None
+        self.last_sequence = None
+        self.next_timestamp = None  # Timestamp RTP esperado para el siguiente paquete
+        self.last_packet = time.monotonic()
+        self.unflushed = False  # Hay una ventana parcial esperando más audio
+
+        SPEAKERS.setdefault(self.source, RTP_SSRC_NAMES.get(ssrc, f"Discord {index + 1}"))
+        COLORS.setdefault(self.source, RTP_SPEAKER_COLORS[index % len(RTP_SPEAKER_COLORS)])
+
+    def decode(self, payload_type, payload):
+        """Decodifica el payload a PCM int16 mono a RATE."""
+        if payload_type == RTP_PCM_PAYLOAD_TYPE:
+            if self.clock_rate is None:
+                self.clock_rate = RTP_PCM_RATE
+                self.resampler = StreamingResampler(RTP_PCM_RATE, RATE) if RTP_PCM_RATE != RATE else None
+            samples = np.frombuffer(payload[:len(payload) // 2 * 2], dtype='>i2').astype(np.int16)
+            frames = len(samples)
+        else:
+            if self.decoder is None:
+                self.clock_rate = 48000
+                self.decoder = opuslib.Decoder(48000, RTP_OPUS_CHANNELS)
+                self.resampler = StreamingResampler(48000, RATE)
+            pcm = self.decoder.decode(bytes(payload), 5760)  # Máximo de un paquete Opus (120 ms)
+            samples = np.frombuffer(pcm, dtype=np.int16)
+            if RTP_OPUS_CHANNELS > 1:
+                samples = samples.reshape(-1, RTP_OPUS_CHANNELS).mean(axis=1).astype(np.int16)
+            frames = len(samples)
+        if self.resampler is not None:
+            samples = self.resampler.process(samples)
+        return samples, frames
+
+class RtpReceiver:
+    """Recibe RTP/Opus por UDP y registra cada SSRC como una fuente independiente.
+
+    Un único hilo recibe y decodifica los paquetes de todos los hablantes y las
+    ventanas se transcriben a través del InferenceScheduler compartido, así que
+    el número de hilos no crece con el número de personas en el canal.
+    """
+
+    def __init__(self, scheduler, port=RTP_PORT, host=SOURCE_BIND_HOST):
+        self.scheduler = scheduler
+        self.host = host
+        self.port = port
+        self.sock = None
+        self.streams = {}
+        self.window_samples = int(RATE * BUFFER_SECONDS)
+        metrics.set_callback("whisper_rtp_streams", lambda: len(self.streams))
+
+    def stop(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+
+    def _get_stream(self, ssrc):
+        stream = self.streams.get(ssrc)
+        if stream is None and len(self.streams) < RTP_MAX_STREAMS:
+            stream = RtpStream(ssrc, len(self.streams))
+            self.scheduler.add_source(stream.state, stream.buffer)
+            self.streams[ssrc] = stream
+            print(f"[rtp] Nuevo hablante SSRC {ssrc}: {SPEAKERS[stream.source]}")
+        return stream
+
+    def _handle_control(self, packet):
+        """Mensaje JSON {"ssrc": ..., "name": ..., "color": ...} para nombrar a un hablante."""
+        try:
+            message = json.loads(packet.decode('utf-8'))
+            ssrc = int(message['ssrc'])
+        except Exception:
+            return
+        if message.get('name'):
+            RTP_SSRC_NAMES[ssrc] = message['name']
+        stream = self._get_stream(ssrc)
+        if stream is not None:
+            if message.get('name'):
+                SPEAKERS[stream.source] = message['name']
+            if message.get('color'):
+                COLORS[stream.source] = message['color']
+
+    def _handle_packet(self, packet):
+        parsed = parse_rtp_packet(packet)
+        if parsed is None:
+            return
+        payload_type, sequence, timestamp, ssrc, payload = parsed
+        stream = self._get_stream(ssrc)
+        if stream is None:
+            return
+        metrics.inc("whisper_rtp_packets", source=stream.source)
+
+        if stream.last_sequence is not None:
+            delta = (sequence - stream.last_sequence) & 0xFFFF
+            if delta == 0 or delta > 0x8000:
+                metrics.inc("whisper_rtp_late_packets", source=stream.source)
+                return
+            if delta > 1:
+                metrics.inc("whisper_rtp_lost_packets", delta - 1, source=stream.source)
+        stream.last_sequence = sequence
+        stream.last_packet = time.monotonic()
+
+        if payload_type != RTP_PCM_PAYLOAD_TYPE and not OPUS_AVAILABLE:
+            return
+        samples, frames = stream.decode(payload_type, payload)
+
+        # Discord deja de enviar durante los silencios pero el timestamp sigue avanzando:
+        # rellenar huecos cortos con silencio para conservar la duración real del habla
+        if stream.next_timestamp is not None:
+            gap = (timestamp - stream.next_timestamp) & 0xFFFFFFFF
+            if 0 < gap < RTP_MAX_GAP_SECONDS * stream.clock_rate:
+                stream.buffer.write(np.zeros(int(gap * RATE / stream.clock_rate), dtype=np.int16))
+        stream.next_timestamp = (timestamp + frames) & 0xFFFFFFFF
+
+        stream.buffer.write(samples)
+        stream.unflushed = len(stream.buffer) % self.window_samples != 0
+
+    def _flush_idle_streams(self):
+        """Completa la ventana parcial de los hablantes que dejaron de enviar paquetes."""
+        now = time.monotonic()
+        for stream in self.streams.values():
+            if stream.unflushed and now - stream.last_packet >= RTP_IDLE_FLUSH_SECONDS:
+                stream.unflushed = False
+                stream.buffer.pad_to_threshold()
+
+    def receive_loop(self):
+        """Hilo de recepción: un socket UDP para todos los hablantes."""
+        if not OPUS_AVAILABLE:
+            print("[rtp] opuslib no está disponible: solo se aceptará PCM L16 (pip install opuslib)")
+        try:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.sock.bind((self.host, self.port))
+            print(f"[rtp] Escuchando RTP por UDP en {self.host}:{self.port}")
+            while running:
+                # Solo hace falta despertar por tiempo si algún hablante tiene audio sin transcribir
+                pending = any(stream.unflushed for stream in self.streams.values())
+                self.sock.settimeout(RTP_IDLE_FLUSH_SECONDS if pending else None)
+                try:
+                    packet = self.sock.recv(65536)
+                except socket.timeout:
+                    packet = None
+                if packet:
+                    if packet[:1] == b'{':
+                        self._handle_control(packet)
+                    else:
+                        self._handle_packet(packet)
+                self._flush_idle_streams()
+        except OSError as e:
+            if running:
+                print(f"[rtp] Error en el socket RTP {self.host}:{self.port}: {str(e)}")
+
+def simulate_discord_conversation(overlay):
+    """Simula respuestas de Discord para propósitos de demostración"""
+    global running
+    
+    # Lista de posibles respuestas para la simulación
+    responses = [
+        "Hola, ¿cómo estás hoy?",
+        "Entiendo lo que dices",
+        "¿Podemos hablar sobre el proyecto?",
+        "Esta transcripción funciona muy bien",
+        "Me encanta este modo de chat",
+        "¿Puedes repetir eso por favor?",
+        "¿Te gustaría jugar?",
+        "La reunión empieza en 5 minutos",
         "Necesito tu ayuda con algo",
         "¿Has visto el nuevo video?"
     ]
     
     # Esperar un tiempo inicial para dar tiempo a hablar primero
-    time.sleep(10)
+    if shutdown_event.wait(10):
+        return
     
     # Mientras se ejecuta el programa, simular respuestas de Discord
     while running:
         # Elegir una respuesta aleatoria
         if random.random() < 0.3:  # 30% de probabilidad de responder
             response = random.choice(responses)
-            overlay.update_text('discord', response)
+            timeline.add('discord', response)
             print(f"[discord] Simulación: {response}")
             
         # Esperar entre 10 y 20 segundos para la próxima respuesta
-        time.sleep(random.uniform(10, 20))
+        shutdown_event.wait(random.uniform(10, 20))
 
-def transcribe_loop(source, model, frames_queue, overlay, logger=None):
-    """Procesa la cola cada X segundos, envía a Whisper y actualiza overlay."""
-    global running
-    buffer_size = int(RATE / CHUNK * BUFFER_SECONDS)
-    overlap_size = int(RATE / CHUNK * OVERLAP_SECONDS)
-    last_error_time = 0
-    error_count = 0
-    previous_text = ""
-    last_silence_time = time.time()
-    silence_detected = False
-    total_transcriptions = 0
-    silence_periods = 0
-    last_stats_log = time.time()
-    
-    log_prefix = f"[{source.upper()}]"
+_model_tokenizers = {}  # id(modelo) -> tokenizer de Whisper
+
+def model_tokenizer(model):
+    """Tokenizer de Whisper de un modelo (el cliente remoto usa el que corresponde a MODEL_SIZE)."""
+    tokenizer = _model_tokenizers.get(id(model))
+    if tokenizer is None:
+        multilingual = getattr(model, 'is_multilingual', not MODEL_SIZE.endswith(".en"))
+        extra = {'num_languages': model.num_languages} if hasattr(model, 'num_languages') else {}
+        tokenizer = whisper.tokenizer.get_tokenizer(
+            multilingual, language=LANGUAGE if multilingual else None, task="transcribe", **extra)
+        _model_tokenizers[id(model)] = tokenizer
+    return tokenizer
+
+def compression_ratio(text):
+    """Misma medida que usa Whisper para detectar texto repetitivo."""
+    text_bytes = text.encode('utf-8')
+    return len(text_bytes) / len(zlib.compress(text_bytes)) if text_bytes else 0.0
+
+class PromptContext:
+    """Contexto del decoder de una fuente: los últimos tokens aceptados, en un anillo acotado.
+
+    Cada texto aceptado se tokeniza una sola vez al añadirlo y el prompt se
+    entrega ya tokenizado, así que su coste no crece con la conversación.
+    El texto repetitivo o que coincide con patrones de alucinación no entra
+    nunca, para que el modelo no se realimente con sus propios bucles.
+    """
+
+    def __init__(self, max_tokens=PROMPT_MAX_TOKENS):
+        self.tokens = deque(maxlen=max_tokens)
+        self.last_end = None  # Fin (reloj de audio) del último texto añadido
+
+    def reset(self):
+        self.tokens.clear()
+        self.last_end = None
+
+    def expire(self, start_time):
+        """Reinicia el contexto si el audio lleva más de MAX_SILENCE_BEFORE_RESET sin texto."""
+        if (RESET_CONTEXT_AFTER_SILENCE and self.last_end is not None and start_time is not None
+                and start_time - self.last_end > MAX_SILENCE_BEFORE_RESET):
+            self.reset()
+
+    def add(self, tokenizer, text, end_time=None, source=None):
+        """Añade un texto aceptado; devuelve False si se descarta por parecer una alucinación."""
+        text = text.strip()
+        if (not text or text.lower() in HALLUCINATION_PATTERNS
+                or compression_ratio(text) > DECODE_COMPRESSION_RATIO_THRESHOLD):
+            metrics.inc("whisper_prompt_rejected_texts", source=source)
+            return False
+        self.tokens.extend(tokenizer.encode(" " + text))
+        self.last_end = end_time
+        return True
+
+    def prompt_tokens(self):
+        return list(self.tokens) if self.tokens else None
+
+    def prompt_text(self, tokenizer):
+        return tokenizer.decode(list(self.tokens)) if self.tokens else None
+
+class LanguageTracker:
+    """Idioma de una fuente, detectado una vez y reutilizado en cada ventana.
+
+    Mientras no hay un idioma fijado, cada ventana pasa por la detección de
+    Whisper y se decodifica con el idioma más probable; las probabilidades de
+    las frases que superan los filtros se promedian y, con
+    LANGUAGE_DETECT_UTTERANCES frases y una media de al menos
+    LANGUAGE_MIN_CONFIDENCE, el idioma queda fijado y las ventanas siguientes
+    se decodifican sin detección. La comprobación se repite cada
+    LANGUAGE_RECHECK_SECONDS o cuando el filtro de confianza empieza a descartar.
+    """
+
+    def __init__(self, source):
+        self.source = source
+        self.language = None if LANGUAGE_DETECT else LANGUAGE  # Idioma fijado (None mientras se detecta)
+        self.confidence = 0.0
+        self.observations = deque(maxlen=LANGUAGE_DETECT_UTTERANCES)
+        self.detected_at = 0.0
+        self.rejections = 0
+
+    def needs_detection(self):
+        if not LANGUAGE_DETECT:
+            return False
+        if self.language is None or self.rejections >= LANGUAGE_RECHECK_REJECTIONS:
+            return True
+        return time.monotonic() - self.detected_at >= LANGUAGE_RECHECK_SECONDS
+
+    def note_rejection(self):
+        """Descarte por baja confianza: varios seguidos sugieren que el idioma fijado ya no es el correcto."""
+        self.rejections += 1
+
+    def observe(self, probs):
+        """Añade las probabilidades de idioma de una frase aceptada; devuelve el idioma si cambia.
+
+        Sin probabilidades (ventana decodificada con el idioma fijado) la frase
+        solo corta la racha de descartes. Durante una comprobación los descartes
+        se conservan hasta que el idioma se confirma o cambia, para que la
+        detección siga activa hasta reunir sus LANGUAGE_DETECT_UTTERANCES votos.
+        """
+        if probs is None:
+            self.rejections = 0
+            return None
+        self.observations.append(probs)
+        if len(self.observations) < self.observations.maxlen:
+            return None
+        totals = {}
+        for observation in self.observations:
+            for language, prob in observation.items():
+                totals[language] = totals.get(language, 0.0) + prob
+        language, total = max(totals.items(), key=lambda item: item[1])
+        confidence = total / len(self.observations)
+        if confidence < LANGUAGE_MIN_CONFIDENCE:
+            return None  # Resultado dudoso: se sigue detectando con las frases siguientes
+        previous, self.language, self.confidence = self.language, language, confidence
+        self.detected_at = time.monotonic()
+        self.observations.clear()
+        self.rejections = 0
+        metrics.set("whisper_language_confidence", confidence, source=self.source)
+        if previous is not None and previous != language:
+            metrics.inc("whisper_language_changes", source=self.source)
+        return language if language != previous else None
+
+def language_probabilities(model, mel_or_features):
+    """Probabilidad de cada idioma de LANGUAGE_CANDIDATES para una ventana.
+
+    Acepta el log-mel de la ventana o las características del encoder ya
+    calculadas; en el segundo caso solo cuesta un paso del decoder.
+    """
+    with torch.no_grad():
+        _, probs = model.detect_language(mel_or_features)
+    if LANGUAGE_CANDIDATES:
+        probs = {language: probs.get(language, 0.0) for language in LANGUAGE_CANDIDATES}
+    total = sum(probs.values()) or 1.0
+    return {language: prob / total for language, prob in probs.items()}
+
+class SourceState:
+    """Estado de transcripción de una fuente: contexto, idioma, silencio y errores."""
+
+    def __init__(self, source):
+        self.source = source
+        self.log_prefix = f"[{source.upper()}]"
+        self.context = PromptContext()
+        self.language = LanguageTracker(source)
+        self.preprocessor = AudioPreprocessor(source) if PREPROCESS_ENABLED else None
+        self.speakers = SpeakerTracker(source) if DIARIZATION_ENABLED and source in DIARIZATION_SOURCES else None
+        self.last_silence_time = time.time()
+        self.silence_detected = False
+        self.last_stats_log = time.time()
+        self.last_error_time = 0
+        self.error_count = 0
+
+def segment_value(segment, key, default):
+    """Lee un campo de un segmento de Whisper (dict o atributo según la versión)."""
+    if isinstance(segment, dict):
+        return segment.get(key, default)
+    return getattr(segment, key, default)
+
+class SpeechGate:
+    """Etapa intermedia de la cascada: decide con un modelo pequeño si hay voz.
+
+    Las ventanas que superan MIN_AUDIO_LEVEL pasan por el encoder de GATE_MODEL_SIZE
+    y un único paso del decoder sobre el token de inicio, que da la misma
+    probabilidad de "sin voz" que Whisper calcula al decodificar. Solo las
+    ventanas por debajo de GATE_NO_SPEECH_THRESHOLD llegan al modelo principal;
+    por cada descarte se contabiliza como ahorrado el tiempo medio de inferencia
+    del modelo principal para esa fuente menos el coste de la compuerta.
+    """
+
+    def __init__(self, model):
+        self.model = model
+        # Mismo tokenizer que el decoder (num_languages cambia los ids especiales en large-v3);
+        # el idioma no importa: la probabilidad de "sin voz" se lee en la posición del token de inicio
+        self.tokenizer = model_tokenizer(model)
+        self.sot_sequence = torch.tensor([list(self.tokenizer.sot_sequence)], device=model.device)
+        self.n_mels = getattr(model.dims, 'n_mels', 80)
+        self.dtype = torch.float16 if HALF_PRECISION and DEVICE == "cuda" else torch.float32
+
+    def no_speech_prob(self, audio):
+        with torch.no_grad():
+            mel = whisper.log_mel_spectrogram(whisper.pad_or_trim(torch.from_numpy(audio)), n_mels=self.n_mels)
+            audio_features = self.model.embed_audio(mel[None].to(self.model.device, self.dtype))
+            logits = self.model.logits(self.sot_sequence, audio_features)
+            return logits[0, 0].float().softmax(dim=-1)[self.tokenizer.no_speech].item()
+
+    def has_speech(self, audio, source):
+        start = time.perf_counter()
+        probability = self.no_speech_prob(audio)
+        elapsed = time.perf_counter() - start
+        metrics.observe("whisper_gate_seconds", elapsed, source=source)
+        if probability < GATE_NO_SPEECH_THRESHOLD:
+            return True
+        main_cost = metrics.histogram_mean("whisper_inference_seconds", source=source) or 0
+        metrics.inc("whisper_gate_saved_seconds", max(0.0, main_cost - elapsed), source=source)
+        if DEBUG_MODE:
+            print(f"[{source}] Compuerta: sin voz ({probability:.2f}), ventana descartada")
+        return False
+
+def load_speech_gate(model, logger=None):
+    """Prepara la compuerta de voz (reutiliza el modelo principal si es del mismo tamaño)."""
+    try:
+        if GATE_MODEL_SIZE != MODEL_SIZE or isinstance(model, RemoteModel):
+            print(f"Cargando modelo '{GATE_MODEL_SIZE}' para la compuerta de voz...")
+            model = whisper.load_model(GATE_MODEL_SIZE, device=DEVICE)
+        return SpeechGate(model)
+    except Exception as e:
+        print(f"No se pudo preparar la compuerta de voz: {str(e)}")
+        if logger:
+            logger.error(f"Compuerta de voz desactivada: {str(e)}")
+        return None
+
+class EchoSuppressor:
+    """Detecta ventanas de ECHO_SOURCE que solo contienen el audio de ECHO_REFERENCE.
+
+    Con altavoces, el micrófono capta lo que suena en Discord con un retardo de
+    unos milisegundos. Se busca la ventana del micrófono en el historial del
+    buffer de referencia (mismo reloj de audio, hasta ECHO_MAX_LAG_SECONDS
+    antes) con una correlación cruzada por FFT, normalizada por la energía de
+    cada desplazamiento. Si la correlación máxima supera
+    ECHO_CORRELATION_THRESHOLD, la referencia explica la mayor parte de la
+    energía del micrófono y la ventana se descarta antes de la inferencia.
+
+    Con voz propia no correlada la correlación es sqrt(Eeco / (Eeco + Evoz)):
+    cuando se habla a la vez que suena Discord con la misma potencia vale
+    1/sqrt(2) ≈ 0,71, así que el umbral debe quedar por encima para no
+    descartar la voz propia (0,75 exige que el eco sea ~56 % de la energía).
+    """
+
+    def __init__(self, reference_buffer, max_lag=ECHO_MAX_LAG_SECONDS, threshold=ECHO_CORRELATION_THRESHOLD):
+        self.reference_buffer = reference_buffer
+        self.max_lag = int(RATE * max_lag)
+        self.threshold = threshold
+
+    def correlation(self, audio, reference):
+        """Máxima correlación normalizada de `audio` con cualquier tramo de `reference` de su longitud."""
+        n = len(audio)
+        lags = len(reference) - n + 1
+        size = 1 << (n + len(reference) - 1).bit_length()
+        reference = reference.astype(np.float64)
+        # Correlación de todos los desplazamientos a la vez: IFFT(FFT(ref) * conj(FFT(audio)))
+        cross = np.fft.irfft(np.fft.rfft(reference, size) * np.conj(np.fft.rfft(audio, size)), size)[:lags]
+        # Energía de la referencia en cada desplazamiento con una suma acumulada
+        cumulative = np.concatenate(([0.0], np.cumsum(reference * reference)))
+        reference_energy = cumulative[n:n + lags] - cumulative[:lags]
+        norm = np.sqrt(np.maximum(reference_energy, 1e-12) * float(np.dot(audio, audio)))
+        return float(np.max(np.abs(cross) / norm))
+
+    def is_echo(self, audio, start_time, source):
+        """True si la ventana (float32, capturada desde start_time) es eco de la referencia."""
+        if start_time is None:
+            return False
+        started = time.perf_counter()
+        reference = self.reference_buffer.peek(start_time - self.max_lag / RATE, len(audio) + self.max_lag)
+        if reference is None or np.max(np.abs(reference)) < MIN_AUDIO_LEVEL * 32768:
+            metrics.observe("whisper_echo_seconds", time.perf_counter() - started, source=source)
+            return False  # Discord en silencio: no puede haber eco
+        correlation = self.correlation(audio.astype(np.float64), reference)
+        elapsed = time.perf_counter() - started
+        metrics.observe("whisper_echo_seconds", elapsed, source=source)
+        metrics.observe("whisper_echo_correlation", correlation, source=source)
+        if correlation < self.threshold:
+            return False
+        main_cost = metrics.histogram_mean("whisper_inference_seconds", source=source) or 0
+        metrics.inc("whisper_echo_saved_seconds", max(0.0, main_cost - elapsed), source=source)
+        if DEBUG_MODE:
+            print(f"[{source}] Eco de {self.reference_buffer.source} (correlación {correlation:.2f}), ventana descartada")
+        return True
+
+class AudioPreprocessor:
+    """Acondiciona las ventanas de una fuente antes de la inferencia.
+
+    Supresión de ruido por compuerta espectral: la STFT de la ventana (tramas
+    con ventana raíz de Hann y salto de media trama, todas en un único rfft)
+    se compara bin a bin con un perfil de ruido aprendido de las ventanas de
+    silencio y de las tramas más débiles de cada ventana; los bins que no lo
+    superan en PREPROCESS_GATE_DB se atenúan PREPROCESS_REDUCTION_DB y la
+    señal se reconstruye por solapamiento-suma. Después se normaliza la
+    ganancia para llevar la voz a PREPROCESS_TARGET_RMS, con un cambio suave
+    entre ventanas y sin saturar; una ventana sin tramas de voz se deja con
+    ganancia unidad para no amplificar el ruido residual.
+
+    Si el coste supera PREPROCESS_BUDGET_SECONDS, las ventanas siguientes solo
+    reciben la ganancia hasta pasadas PREPROCESS_RETRY_WINDOWS; en ellas la voz
+    se distingue comparando la potencia de cada trama con el perfil de ruido.
+    """
+
+    def __init__(self, source, frame=PREPROCESS_FRAME):
+        self.source = source
+        self.frame = frame
+        self.hop = frame // 2
+        # Raíz de Hann periódica en análisis y síntesis: con 50 % de solapamiento la suma es 1
+        self.window = np.sqrt(0.5 - 0.5 * np.cos(2 * np.pi * np.arange(frame) / frame)).astype(np.float32)
+        # Potencia media por muestra a partir de la mitad positiva del espectro de una trama (Parseval)
+        self.power_scale = 2 / (frame * frame * float(np.mean(self.window ** 2)))
+        self.noise_profile = None  # Magnitud media del ruido por bin
+        self.gate = 10 ** (PREPROCESS_GATE_DB / 20)
+        self.floor = 10 ** (-PREPROCESS_REDUCTION_DB / 20)
+        self.max_gain = 10 ** (PREPROCESS_MAX_GAIN_DB / 20)
+        self.gain = 1.0
+        self.bypass_remaining = 0
+
+    def _stft(self, audio):
+        padded = np.concatenate((np.zeros(self.hop, np.float32), audio,
+                                 np.zeros(self.hop + (-len(audio)) % self.hop, np.float32)))
+        frames = np.lib.stride_tricks.sliding_window_view(padded, self.frame)[::self.hop] * self.window
+        return np.fft.rfft(frames, axis=1)
+
+    def _istft(self, spectrum, length):
+        frames = np.fft.irfft(spectrum, self.frame, axis=1).astype(np.float32) * self.window
+        out = np.zeros((len(frames) + 1) * self.hop, np.float32)
+        out[:-self.hop].reshape(-1, self.hop)[:] += frames[:, :self.hop]
+        out[self.hop:].reshape(-1, self.hop)[:] += frames[:, self.hop:]
+        return out[self.hop:self.hop + length]
+
+    def _update_noise(self, magnitude):
+        estimate = magnitude.mean(axis=0)
+        if self.noise_profile is None:
+            self.noise_profile = estimate
+        else:
+            self.noise_profile += PREPROCESS_NOISE_ADAPT * (estimate - self.noise_profile)
+
+    def _frame_speech_level(self, audio):
+        """RMS de la voz sin STFT, a partir de las tramas más fuertes que el perfil de ruido.
+
+        Sin perfil de ruido no se puede separar la voz del fondo y devuelve 0
+        (ganancia unidad).
+        """
+        if self.noise_profile is None:
+            return 0.0
+        usable = len(audio) - len(audio) % self.frame
+        power = np.mean(np.square(audio[:usable].reshape(-1, self.frame), dtype=np.float64), axis=1)
+        noise_power = float((self.noise_profile ** 2).sum()) * self.power_scale
+        # Margen de PREPROCESS_GATE_DB / 2: la trama entera mezcla voz y ruido, así que
+        # la voz destaca menos que comparando bin a bin
+        speech = power > noise_power * self.gate
+        return float(np.sqrt(power[speech].mean())) if speech.any() else 0.0
+
+    def learn_noise(self, audio):
+        """Actualiza el perfil de ruido con una ventana sin voz (descartada por nivel)."""
+        self._update_noise(np.abs(self._stft(audio)))
+
+    def process(self, audio):
+        """Devuelve la ventana (float32) con el ruido atenuado y la ganancia normalizada."""
+        start = time.perf_counter()
+        if self.bypass_remaining > 0:
+            self.bypass_remaining -= 1
+            metrics.inc("whisper_preprocess_bypassed", source=self.source)
+            speech_level = self._frame_speech_level(audio)
+        else:
+            spectrum = self._stft(audio)
+            magnitude = np.abs(spectrum)
+            # Las tramas más débiles de la ventana también son ruido de fondo
+            energy = magnitude.sum(axis=1)
+            self._update_noise(magnitude[energy <= np.percentile(energy, 10)])
+            keep = magnitude > self.noise_profile * self.gate
+            # Suavizado temporal de la máscara (trama anterior y siguiente) contra el ruido musical
+            mask = keep.astype(np.float32)
+            mask[1:-1] = (mask[:-2] + mask[1:-1] + mask[2:]) / 3
+            mask = np.maximum(mask, self.floor)
+            audio = self._istft(spectrum * mask, len(audio))
+            # RMS de la voz a partir de la energía de las tramas con contenido por encima del ruido
+            kept_power = ((magnitude * keep) ** 2).sum(axis=1)
+            speech = kept_power > (self.noise_profile ** 2).sum()
+            speech_level = 0.0
+            if speech.any():
+                speech_level = float(np.sqrt(kept_power[speech].mean() * self.power_scale))
+
+        gain = 1.0  # Ventana sin voz: amplificar el ruido residual solo invitaría a alucinar
+        if speech_level > 1e-5:
+            target = min(self.max_gain, PREPROCESS_TARGET_RMS / speech_level)
+            self.gain += 0.5 * (target - self.gain)  # Transición suave entre ventanas
+            gain = self.gain  # La ganancia aprendida se conserva para la siguiente ventana con voz
+        peak = float(np.max(np.abs(audio))) if len(audio) else 0.0
+        gain = min(gain, 0.99 / peak) if peak > 0 else gain
+        audio = audio * gain
+
+        elapsed = time.perf_counter() - start
+        metrics.observe("whisper_preprocess_seconds", elapsed, source=self.source)
+        metrics.set("whisper_preprocess_gain_db", 20 * math.log10(max(gain, 1e-6)), source=self.source)
+        if elapsed > PREPROCESS_BUDGET_SECONDS and self.bypass_remaining == 0:
+            self.bypass_remaining = PREPROCESS_RETRY_WINDOWS
+        return audio.astype(np.float32)
+
+def mel_filterbank(n_fft, n_mels, rate=RATE):
+    """Matriz (n_mels, n_fft // 2 + 1) de filtros triangulares en escala mel."""
+    def to_mel(hz):
+        return 2595 * np.log10(1 + hz / 700)
+    edges = 700 * (10 ** (np.linspace(0, to_mel(rate / 2), n_mels + 2) / 2595) - 1)
+    freqs = np.fft.rfftfreq(n_fft, 1 / rate)
+    lower, center, upper = edges[:-2, None], edges[1:-1, None], edges[2:, None]
+    rising = (freqs - lower) / (center - lower)
+    falling = (upper - freqs) / (upper - center)
+    return np.maximum(0, np.minimum(rising, falling)).astype(np.float32)
+
+class SpeakerTracker:
+    """Distingue hablantes dentro de una fuente mezclada con agrupamiento en línea.
+
+    La huella de cada segmento de Whisper es la media de sus MFCC (log-mel de
+    40 bandas y DCT ortonormal sin el coeficiente 0, así que no depende del
+    volumen), calculada para todas las tramas con un único rfft y dos
+    productos de matrices. Como la DCT es ortonormal, la distancia euclídea
+    entre huellas equivale a la diferencia media de la envolvente espectral en
+    dB. Cada segmento se asigna al hablante actual si está a menos de
+    DIARIZATION_THRESHOLD_DB, si no al centroide más cercano por debajo del
+    umbral, y si ninguno lo está se crea un hablante nuevo con una etiqueta y
+    un color estables.
+    """
+
+    FRAME = 400      # 25 ms
+    HOP = 160        # 10 ms
+    N_FFT = 512
+    N_MELS = 40
+    N_MFCC = 20
+    _filterbank = None
+    _dct = None
+
+    def __init__(self, source):
+        self.source = source
+        self.centroids = []  # Huella media de cada hablante
+        self.counts = []
+        self.current = None  # Índice del último hablante asignado
+        self.window = np.hamming(self.FRAME).astype(np.float32)
+        if SpeakerTracker._filterbank is None:
+            SpeakerTracker._filterbank = mel_filterbank(self.N_FFT, self.N_MELS)
+            k = np.arange(self.N_MELS)
+            dct = np.cos(np.pi / self.N_MELS * (k[:, None] + 0.5) * np.arange(self.N_MFCC)[None, :])
+            SpeakerTracker._dct = (dct * np.sqrt(2 / self.N_MELS)).astype(np.float32)[:, 1:]
+        # Distancia euclídea de MFCC equivalente a DIARIZATION_THRESHOLD_DB de diferencia media por banda
+        self.threshold = DIARIZATION_THRESHOLD_DB * math.log(10) / 10 * math.sqrt(self.N_MELS)
+
+    def label(self, index):
+        return f"{SPEAKERS.get(self.source, self.source)} {index + 1}"
+
+    def color(self, index):
+        return RTP_SPEAKER_COLORS[index % len(RTP_SPEAKER_COLORS)]
+
+    def embedding(self, audio):
+        """Media de los MFCC de las tramas con voz (None si no hay suficientes)."""
+        if len(audio) < self.FRAME:
+            return None
+        frames = np.lib.stride_tricks.sliding_window_view(audio, self.FRAME)[::self.HOP] * self.window
+        power = np.abs(np.fft.rfft(frames, self.N_FFT, axis=1)) ** 2
+        log_mel = np.log(power @ self._filterbank.T + 1e-10)
+        # Solo tramas con voz: a menos de 30 dB de la trama más fuerte
+        energy = log_mel.mean(axis=1)
+        voiced = energy > energy.max() - 30 * math.log(10) / 10
+        if voiced.sum() * self.HOP < DIARIZATION_MIN_SECONDS * RATE:
+            return None
+        return (log_mel[voiced] @ self._dct).mean(axis=0)
+
+    def assign(self, audio):
+        """Índice del hablante de un segmento de audio float32."""
+        embedding = self.embedding(audio)
+        if embedding is None:
+            return self.current  # Segmento demasiado corto: se mantiene el hablante anterior
+        distances = [float(np.linalg.norm(embedding - centroid)) for centroid in self.centroids]
+        if self.current is not None and distances[self.current] < self.threshold:
+            index = self.current  # Histéresis: no cambiar de hablante si el actual encaja
+        elif distances and min(distances) < self.threshold or len(self.centroids) >= DIARIZATION_MAX_SPEAKERS:
+            index = int(np.argmin(distances))
+        else:
+            index = len(self.centroids)
+            self.centroids.append(embedding)
+            self.counts.append(0)
+            metrics.set("whisper_speakers", len(self.centroids), source=self.source)
+        # Media móvil con memoria acotada para seguir cambios lentos de la voz o del canal
+        self.counts[index] += 1
+        self.centroids[index] += (embedding - self.centroids[index]) / min(self.counts[index], 20)
+        if self.current is not None and index != self.current:
+            metrics.inc("whisper_speaker_changes", source=self.source)
+        self.current = index
+        return index
+
+    def split(self, audio, segments):
+        """Agrupa los segmentos consecutivos de un mismo hablante.
+
+        Devuelve una lista de (hablante, inicio, fin, texto) con tiempos relativos
+        a la ventana; hablante es None si aún no hay ninguna huella fiable.
+        """
+        started = time.perf_counter()
+        turns = []
+        for segment in segments:
+            seg_start = segment_value(segment, 'start', 0)
+            seg_end = segment_value(segment, 'end', len(audio) / RATE)
+            seg_text = segment_value(segment, 'text', "").strip()
+            if not seg_text:
+                continue
+            index = self.assign(audio[int(seg_start * RATE):int(seg_end * RATE)])
+            if turns and turns[-1][0] == index:
+                speaker, turn_start, _, turn_text = turns[-1]
+                turns[-1] = (speaker, turn_start, seg_end, f"{turn_text} {seg_text}")
+            else:
+                turns.append((index, seg_start, seg_end, seg_text))
+        metrics.observe("whisper_diarization_rtf", (time.perf_counter() - started) / (len(audio) / RATE),
+                        source=self.source)
+        return turns
+
+def parse_timestamp_segments(tokenizer, tokens, duration):
+    """Convierte los tokens de una decodificación con marcas de tiempo en segmentos (inicio, fin, texto)."""
+    timestamp_begin = tokenizer.timestamp_begin
+    segments = []
+    start = None
+    text_tokens = []
+    for token in tokens:
+        if token >= timestamp_begin:
+            position = (token - timestamp_begin) * 0.02  # Resolución de las marcas de Whisper
+            if start is not None and text_tokens:
+                segments.append((start, min(position, duration), tokenizer.decode(text_tokens)))
+                start = None
+                text_tokens = []
+            else:
+                start = position  # Inicio de segmento (o la marca repetida entre dos segmentos)
+        else:
+            text_tokens.append(token)
+    if text_tokens:
+        segments.append((start or 0.0, duration, tokenizer.decode(text_tokens)))
+    # Las marcas pasadas del final (relleno a 30 s) se recortan a la duración real
+    return [(min(start, end), end, text) for start, end, text in segments if text.strip()]
+
+class ModelLock:
+    """Turno de uso de un modelo local compartido entre hilos, con prioridad para el directo.
+
+    whisper.decode instala los hooks de la caché KV en los módulos del propio
+    modelo, así que dos decodificaciones simultáneas sobre el mismo modelo
+    mezclan sus cachés. La inferencia en vivo lo toma con `with`; el trabajo de
+    fondo (el refinado) usa acquire(live=False) y solo entra cuando ninguna
+    ventana en vivo lo está usando ni esperando turno.
+    """
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.held = False
+        self.live_waiting = 0  # Ventanas en vivo esperando el modelo (bloquean el trabajo de fondo)
+
+    def acquire(self, live=True):
+        with self.cond:
+            if live:
+                self.live_waiting += 1
+                try:
+                    while self.held:
+                        self.cond.wait()
+                finally:
+                    self.live_waiting -= 1
+            else:
+                while self.held or self.live_waiting:
+                    self.cond.wait()
+            self.held = True
+
+    def release(self):
+        with self.cond:
+            self.held = False
+            self.cond.notify_all()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+model_lock = ModelLock()  # Modelo local principal (inferencia en vivo y refinado)
+
+def decode_with_budget(model, audio, source, prompt_tokens=None, fast=False, language=LANGUAGE):
+    """Decodifica una ventana con un presupuesto de latencia y un fallback de temperatura acotado.
+
+    Como model.transcribe(), reintenta a mayor temperatura si el resultado parece
+    una alucinación (compresión alta o logprob bajo), pero solo con las
+    temperaturas de DECODE_TEMPERATURES y mientras quede presupuesto: si no cabe
+    otro intento con búsqueda en haz se pasa a decodificación voraz, y si el
+    presupuesto se agota se devuelve None para no retrasar la siguiente ventana.
+    El resultado tiene el formato de model.transcribe() con los segmentos
+    sacados de los tokens de marca de tiempo.
+
+    El encoder se ejecuta una sola vez: los reintentos y, con DUAL_OUTPUT, la
+    traducción al inglés ('translation' en el resultado) decodifican a partir
+    de las mismas características de audio. Con language=None el idioma se
+    detecta sobre esas mismas características ('language_probs' en el resultado).
+    """
+    start = time.perf_counter()
+    duration = len(audio) / RATE
+    tokenizer = model_tokenizer(model)
+    fp16 = HALF_PRECISION if DEVICE == "cuda" else False
+    mel = whisper.log_mel_spectrogram(whisper.pad_or_trim(torch.from_numpy(audio)),
+                                      n_mels=getattr(model.dims, 'n_mels', 80))
+    with torch.no_grad():
+        audio_features = model.embed_audio(mel[None].to(model.device, torch.float16 if fp16 else torch.float32))[0]
+    language_probs = None
+    if language is None and model.is_multilingual:
+        language_probs = language_probabilities(model, audio_features)
+        language = max(language_probs, key=language_probs.get)
+        metrics.inc("whisper_language_detections", source=source)
+
+    beam_size = 5 if USE_BEAM_SEARCH and not fast else None
+    decoded = None
+    for attempt, temperature in enumerate(DECODE_TEMPERATURES):
+        elapsed = time.perf_counter() - start
+        if attempt > 0:
+            if elapsed >= DECODE_LATENCY_BUDGET:
+                metrics.inc("whisper_decode_budget_overruns", source=source)
+                return None
+            metrics.inc("whisper_decode_fallbacks", source=source)
+        # Pasar a voraz si un intento más con búsqueda en haz no cabe en lo que queda
+        if beam_size and temperature == 0:
+            expected = metrics.histogram_mean("whisper_decode_attempt_seconds", source=source, mode="beam") or 0
+            if elapsed + expected > DECODE_LATENCY_BUDGET:
+                beam_size = None
+                metrics.inc("whisper_decode_greedy_switches", source=source)
+        mode = "beam" if beam_size and temperature == 0 else "greedy"
+
+        attempt_start = time.perf_counter()
+        decoded = whisper.decode(model, audio_features, whisper.DecodingOptions(
+            task="transcribe",
+            language=language,
+            temperature=temperature,
+            beam_size=beam_size if temperature == 0 else None,
+            prompt=prompt_tokens,
+            fp16=fp16,
+            without_timestamps=False
+        ))
+        metrics.observe("whisper_decode_attempt_seconds", time.perf_counter() - attempt_start, source=source, mode=mode)
+
+        # Ventana sin voz: no tiene sentido reintentar
+        if decoded.no_speech_prob > DECODE_NO_SPEECH_THRESHOLD and decoded.avg_logprob < DECODE_LOGPROB_THRESHOLD:
+            return {'text': "", 'segments': [], 'language': decoded.language}
+        if (decoded.compression_ratio <= DECODE_COMPRESSION_RATIO_THRESHOLD
+                and decoded.avg_logprob >= DECODE_LOGPROB_THRESHOLD):
+            break
+
+    if time.perf_counter() - start > DECODE_LATENCY_BUDGET:
+        metrics.inc("whisper_decode_budget_overruns", source=source)
+        return None
+
+    segments = [{'start': seg_start, 'end': seg_end, 'text': text,
+                 'avg_logprob': decoded.avg_logprob, 'no_speech_prob': decoded.no_speech_prob,
+                 'temperature': decoded.temperature, 'compression_ratio': decoded.compression_ratio}
+                for seg_start, seg_end, text in parse_timestamp_segments(tokenizer, decoded.tokens, duration)]
+    result = {'text': decoded.text, 'segments': segments, 'language': decoded.language,
+              'language_probs': language_probs}
+
+    # Segunda salida desde las mismas características: solo cuesta la decodificación
+    if DUAL_OUTPUT and decoded.text.strip() and model.is_multilingual and decoded.language != "en":
+        if time.perf_counter() - start < DECODE_LATENCY_BUDGET:
+            translate_start = time.perf_counter()
+            translated = whisper.decode(model, audio_features, whisper.DecodingOptions(
+                task="translate", language=decoded.language, temperature=0.0, fp16=fp16, without_timestamps=True))
+            metrics.observe("whisper_translate_seconds", time.perf_counter() - translate_start, source=source)
+            result['translation'] = translated.text.strip()
+        else:
+            metrics.inc("whisper_translate_skipped", source=source)
+    return result
+
+def filter_repetitions(text):
+    """Limita las palabras repetidas seguidas y los patrones de alucinación repetidos a MAX_REPETITIONS."""
+    # 1. Filtro básico de repeticiones de palabras
+    words = text.split()
+    filtered_words = []
+    repetition_count = 0
+    last_word = None
     
-    if logger:
-        logger.info(f"{log_prefix} Iniciando bucle de transcripción con modelo {MODEL_SIZE}")
+    for word in words:
+        if word == last_word:
+            repetition_count += 1
+        else:
+            repetition_count = 0
+        
+        if repetition_count < MAX_REPETITIONS:
+            filtered_words.append(word)
+        
+        last_word = word
     
-    print(f"Iniciando bucle de transcripción para {source}")
+    text = " ".join(filtered_words)
     
-    while running:
+    # 2. Filtro avanzado para patrones repetitivos "¿eh?" y similares
+    for pattern in HALLUCINATION_PATTERNS:
+        # Contar ocurrencias
+        pattern_count = text.lower().count(pattern)
+        
+        # Si hay más de MAX_REPETITIONS ocurrencias, filtrar todas
+        if pattern_count > MAX_REPETITIONS:
+            # Reemplazar el patrón con una sola ocurrencia
+            text = re.sub(f"(?i){re.escape(pattern)}\\s*", f"{pattern} ", text, count=1)
+            # Eliminar las ocurrencias restantes
+            text = re.sub(f"(?i){re.escape(pattern)}\\s*", "", text)
+    return text
+
+def filter_hallucinated_words(text):
+    """Quita las palabras completas que coinciden con HALLUCINATION_PATTERNS."""
+    return " ".join(word for word in text.split()
+                    if not FILTER_SHORT_PHRASES or word.lower() not in HALLUCINATION_PATTERNS)
+
+def is_too_short_text(text):
+    """Textos muy cortos que son una alucinación conocida (se permiten palabras cortas como "Hola" o "Sí")."""
+    return (FILTER_SHORT_PHRASES and len(text.split()) < MIN_TEXT_LENGTH
+            and text.lower() in HALLUCINATION_PATTERNS)
+
+def average_logprob(segments):
+    """Log-probabilidad media de los segmentos de Whisper (-1 si no hay segmentos)."""
+    if not segments:
+        return -1
+    return sum(segment_value(segment, 'avg_logprob', -1) for segment in segments) / len(segments)
+
+def screen_transcript(text, segments):
+    """Filtros posteriores al modelo: repeticiones, alucinaciones, textos cortos y confianza.
+
+    Devuelve (texto filtrado, confianza, motivo), donde motivo es None si el
+    texto se acepta o la razón de descarte de whisper_filter_rejections.
+    """
+    # 1-2. Repeticiones de palabras y de patrones de alucinación
+    if DETECT_REPETITIONS:
+        text = filter_repetitions(text)
+    
+    # 3. Filtrar expresiones cortas de la lista de alucinaciones
+    text = filter_hallucinated_words(text)
+    
+    # 4. Verificar si el texto debe ignorarse por ser muy corto
+    if is_too_short_text(text):
+        return text, 0, "too_short"
+    
+    # 5. Filtrar transcripciones con baja confianza
+    avg_confidence = average_logprob(segments)
+    confidence = np.exp(avg_confidence) if avg_confidence > -float('inf') else 0  # Convertir log-prob a probabilidad, con protección
+    
+    # Reducir el umbral para palabras cortas (para permitir que "Hola" pase)
+    adjusted_threshold = CONFIDENCE_THRESHOLD
+    if len(text.split()) <= 2:  # Para palabras o frases muy cortas
+        adjusted_threshold = CONFIDENCE_THRESHOLD * 0.8  # Reducir el umbral en 20%
+    if confidence < adjusted_threshold:
+        return text, confidence, "low_confidence"
+    if not text:
+        return text, confidence, "filtered_empty"
+    return text, confidence, None
+
+def decode_parameters(model, language, fast, preprocess=False, backend=None):
+    """Ajustes que determinan el resultado de Whisper para una ventana (parte de la clave de caché).
+
+    preprocess indica si el audio pasa por AudioPreprocessor antes del modelo.
+    backend es el que produjo el resultado ("remote", o "transcribe" para el
+    modelo de respaldo de RemoteModel); por omisión, el que usará la próxima
+    ventana. Los resultados del servidor llevan el modelo y el dispositivo que
+    anuncia en /health; devuelve None si aún no se conocen (no se cachea).
+    """
+    if backend is None:
+        backend = model.backend() if isinstance(model, RemoteModel) else DECODE_MODE
+    remote = backend == "remote"
+    if remote and model.server_info is None:
+        return None
+    server = model.server_info if remote else {'model': MODEL_SIZE, 'device': DEVICE,
+                                                'fp16': HALF_PRECISION and DEVICE == "cuda"}
+    return {
+        'model': server.get('model'),
+        'backend': backend,
+        'device': server.get('device'),
+        'fp16': server.get('fp16'),
+        'language': language,
+        'candidates': list(LANGUAGE_CANDIDATES or []) if language is None else None,
+        'beam_size': 5 if USE_BEAM_SEARCH and not fast else None,
+        'preprocess': [PREPROCESS_FRAME, PREPROCESS_GATE_DB, PREPROCESS_REDUCTION_DB, PREPROCESS_NOISE_ADAPT,
+                       PREPROCESS_TARGET_RMS, PREPROCESS_MAX_GAIN_DB] if preprocess else None,
+        'temperatures': list(DECODE_TEMPERATURES) if backend in ("budgeted", "remote") else None,
+        'thresholds': [DECODE_COMPRESSION_RATIO_THRESHOLD, DECODE_LOGPROB_THRESHOLD, DECODE_NO_SPEECH_THRESHOLD],
+        'dual_output': DUAL_OUTPUT,
+    }
+
+class TranscriptionCache:
+    """Caché en disco del resultado de Whisper de cada ventana, con expulsión LRU por tamaño.
+
+    La clave es el SHA-256 de las muestras capturadas (antes del
+    preprocesado, que tiene estado) y de decode_parameters(), así que solo se
+    reutiliza un resultado si el audio y los ajustes son idénticos. El prompt
+    de contexto no entra en la clave porque depende de lo que aceptaron los
+    filtros en ventanas anteriores: se guarda junto al resultado y, con
+    CACHE_MATCH_PROMPT, get() solo lo devuelve si coincide. Se guarda el
+    resultado sin filtrar (texto, segmentos con avg_logprob y no_speech_prob,
+    idioma, traducción) para que los filtros posteriores puedan ajustarse y
+    volver a aplicarse. El orden LRU
+    se reconstruye al arrancar con la fecha de modificación de los archivos,
+    que se actualiza en cada acierto.
+    """
+
+    def __init__(self, folder=CACHE_FOLDER, max_bytes=CACHE_MAX_MB * 1024 * 1024):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.entries = {}  # clave -> tamaño, del uso más antiguo al más reciente (orden de inserción)
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+        os.makedirs(folder, exist_ok=True)
+        files = []
+        for name in os.listdir(folder):
+            if name.endswith(".json"):
+                stat = os.stat(os.path.join(folder, name))
+                files.append((stat.st_mtime, name[:-5], stat.st_size))
+        for _, key, size in sorted(files):
+            self.entries[key] = size
+            self.total_bytes += size
+        metrics.set("whisper_cache_bytes", self.total_bytes)
+
+    @staticmethod
+    def key(audio, parameters):
+        digest = hashlib.sha256(np.ascontiguousarray(audio).tobytes())
+        digest.update(json.dumps(parameters, sort_keys=True).encode('utf-8'))
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.folder, f"{key}.json")
+
+    def get(self, key, source=None, prompt=None):
+        """Resultado guardado para la clave, o None (también si CACHE_MATCH_PROMPT y el prompt difiere)."""
+        with self.lock:
+            if key not in self.entries:
+                metrics.inc("whisper_cache_misses", source=source)
+                return None
+            self.entries[key] = self.entries.pop(key)  # Pasa a ser la más reciente
         try:
-            current_time = time.time()
-            
-            # Registrar estadísticas periódicas de este hilo de transcripción
-            if logger and LOG_PERFORMANCE and (current_time - last_stats_log >= LOG_STATS_INTERVAL):
-                logger.info(f"{log_prefix} Estadísticas - Transcripciones: {total_transcriptions}, Periodos de silencio: {silence_periods}")
-                last_stats_log = current_time
-            
-            if len(frames_queue) >= buffer_size:
-                # Obtener datos y limpiar cola
-                frames = [frames_queue.popleft() for _ in range(buffer_size)]
-                audio_bytes = b"".join(frames)
-                
-                # Convertir a float32 numpy
-                audio_np = np.frombuffer(audio_bytes, np.int16).astype(np.float32) / 32768.0
-                
-                # Verificar nivel de audio (evita errores con silencio)
-                audio_level = np.max(np.abs(audio_np))
-                
-                if SILENCE_SKIP and audio_level < MIN_AUDIO_LEVEL:
-                    if DEBUG_MODE and source == 'mic':  # Solo para el micrófono para no llenar la consola
-                        print(f"[{source}] Audio silencioso detectado (nivel: {audio_level:.4f})")
-                    
-                    # Verificar si el silencio es prolongado para reiniciar contexto
-                    if not silence_detected:
-                        silence_detected = True
-                        silence_periods += 1
-                        last_silence_time = current_time
-                        if logger and LOG_LEVEL <= logging.DEBUG:
-                            logger.debug(f"{log_prefix} Silencio detectado (nivel: {audio_level:.4f})")
-                    elif RESET_CONTEXT_AFTER_SILENCE and (current_time - last_silence_time > MAX_SILENCE_BEFORE_RESET):
-                        if previous_text and DEBUG_MODE:
-                            print(f"[{source}] Silencio prolongado detectado, reiniciando contexto")
-                            if logger:
-                                logger.info(f"{log_prefix} Silencio prolongado ({current_time - last_silence_time:.1f}s), reiniciando contexto")
-                        previous_text = ""  # Reiniciar contexto después de silencio prolongado
-                    
-                    time.sleep(0.1)
-                    continue
+            with open(self._path(key), encoding='utf-8') as f:
+                result = json.load(f)
+            os.utime(self._path(key))
+        except (OSError, ValueError):
+            with self.lock:
+                self.total_bytes -= self.entries.pop(key, 0)
+            metrics.inc("whisper_cache_misses", source=source)
+            return None
+        if result.get('prompt') != (list(prompt) if prompt else None):
+            metrics.inc("whisper_cache_prompt_mismatches", source=source)
+            if CACHE_MATCH_PROMPT:
+                metrics.inc("whisper_cache_misses", source=source)
+                return None
+        metrics.inc("whisper_cache_hits", source=source)
+        return result
+
+    def put(self, key, result, prompt=None):
+        """Guarda un resultado con el formato de model.transcribe() y el prompt con que se obtuvo.
+
+        Expulsa lo usado hace más tiempo si se supera el tamaño máximo.
+        """
+        entry = {
+            'prompt': list(prompt) if prompt else None,
+            'text': result.get('text', ""),
+            'language': result.get('language'),
+            'language_probs': result.get('language_probs'),
+            'translation': result.get('translation'),
+            'segments': [{field: segment_value(segment, field, None)
+                          for field in ('start', 'end', 'text', 'avg_logprob', 'no_speech_prob',
+                                        'temperature', 'compression_ratio')}
+                         for segment in result.get('segments') or []],
+        }
+        data = json.dumps(entry, default=float).encode('utf-8')
+        try:
+            with open(self._path(key), 'wb') as f:
+                f.write(data)
+        except OSError as e:
+            print(f"No se pudo escribir en la caché de transcripciones: {str(e)}")
+            return
+        evicted = []
+        with self.lock:
+            self.total_bytes += len(data) - self.entries.pop(key, 0)
+            self.entries[key] = len(data)
+            while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+                oldest = next(iter(self.entries))
+                self.total_bytes -= self.entries.pop(oldest)
+                evicted.append(oldest)
+            metrics.set("whisper_cache_bytes", self.total_bytes)
+        for oldest in evicted:
+            try:
+                os.remove(self._path(oldest))
+            except OSError:
+                pass
+            metrics.inc("whisper_cache_evictions")
+
+def process_window(state, model, window, overlay, logger=None, fast=False, start_time=None):
+    """Filtra, transcribe y publica una ventana de audio int16 de una fuente.
+
+    Con fast=True (ventana con retraso) se usa decodificación voraz en lugar de beam search.
+    start_time es el instante de captura (reloj de audio) de la primera muestra de la
+    ventana; el texto se publica en la línea de tiempo con el intervalo que indican
+    los segmentos de Whisper.
+    """
+    source = state.source
+    log_prefix = state.log_prefix
+    window_seconds = len(window) / RATE
+    
+    current_time = time.time()
+    
+    # Registrar estadísticas periódicas de esta fuente
+    if logger and LOG_PERFORMANCE and (current_time - state.last_stats_log >= LOG_STATS_INTERVAL):
+        queue_delay = metrics.histogram_mean("whisper_queue_delay_seconds", source=source) or 0
+        logger.info(f"{log_prefix} Estadísticas - Transcripciones: {metrics.value('whisper_transcriptions', source=source)}, "
+                    f"Periodos de silencio: {metrics.value('whisper_silence_periods', source=source)}, "
+                    f"Espera media en cola: {queue_delay:.2f}s")
+        # Descartes por etapa de la cascada: nivel de audio, compuerta de voz y filtros tras el modelo
+        level = metrics.value('whisper_filter_rejections', source=source, reason="silence")
+        gate = metrics.value('whisper_filter_rejections', source=source, reason="gate_no_speech")
+        echo = metrics.value('whisper_filter_rejections', source=source, reason="echo")
+        after_model = sum(metrics.value('whisper_filter_rejections', source=source, reason=reason)
+                          for reason in ("too_short", "low_confidence", "filtered_empty"))
+        logger.info(f"{log_prefix} Cascada - Descartes por nivel: {level}, por eco: {echo}, por compuerta: {gate}, "
+                    f"tras el modelo: {after_model}, "
+                    f"inferencia ahorrada: {metrics.value('whisper_gate_saved_seconds', source=source):.1f}s")
+        if state.preprocessor is not None:
+            preprocess_cost = metrics.histogram_mean("whisper_preprocess_seconds", source=source) or 0
+            logger.info(f"{log_prefix} Preprocesado - Coste medio: {preprocess_cost * 1000:.1f}ms, "
+                        f"ganancia: {metrics.value('whisper_preprocess_gain_db', source=source):+.1f}dB, "
+                        f"ventanas sin supresión: {metrics.value('whisper_preprocess_bypassed', source=source)}")
+        if ECHO_SUPPRESSION and source == ECHO_SOURCE:
+            echo_cost = metrics.histogram_mean("whisper_echo_seconds", source=source) or 0
+            logger.info(f"{log_prefix} Eco - Coste medio de detección: {echo_cost * 1000:.1f}ms, "
+                        f"inferencia ahorrada: {metrics.value('whisper_echo_saved_seconds', source=source):.1f}s")
+        if LANGUAGE_DETECT:
+            logger.info(f"{log_prefix} Idioma - Fijado: {state.language.language or 'detectando'} "
+                        f"(confianza {state.language.confidence:.2f}), "
+                        f"ventanas con detección: {metrics.value('whisper_language_detections', source=source)}")
+        translate = metrics.histogram_mean("whisper_translate_seconds", source=source)
+        if DUAL_OUTPUT and translate is not None:
+            inference = metrics.histogram_mean("whisper_inference_seconds", source=source) or 0
+            logger.info(f"{log_prefix} Traducción - Coste medio: {translate:.2f}s "
+                        f"({translate * 100 / inference if inference else 0:.0f}% de la inferencia), "
+                        f"omitidas por presupuesto: {metrics.value('whisper_translate_skipped', source=source)}")
+        state.last_stats_log = current_time
+    
+    # Convertir a float32 numpy
+    audio_np = window.astype(np.float32) / 32768.0
+    
+    # Verificar nivel de audio (evita errores con silencio)
+    audio_level = np.max(np.abs(audio_np))
+    
+    if SILENCE_SKIP and audio_level < MIN_AUDIO_LEVEL:
+        if DEBUG_MODE and source == 'mic':  # Solo para el micrófono para no llenar la consola
+            print(f"[{source}] Audio silencioso detectado (nivel: {audio_level:.4f})")
+        if state.preprocessor is not None:
+            state.preprocessor.learn_noise(audio_np)  # Las ventanas de silencio definen el perfil de ruido
+        
+        # Verificar si el silencio es prolongado para reiniciar contexto
+        if not state.silence_detected:
+            state.silence_detected = True
+            metrics.inc("whisper_silence_periods", source=source)
+            state.last_silence_time = current_time
+            if logger and LOG_LEVEL <= logging.DEBUG:
+                logger.debug(f"{log_prefix} Silencio detectado (nivel: {audio_level:.4f})")
+        elif RESET_CONTEXT_AFTER_SILENCE and (current_time - state.last_silence_time > MAX_SILENCE_BEFORE_RESET):
+            if state.context.tokens and DEBUG_MODE:
+                print(f"[{source}] Silencio prolongado detectado, reiniciando contexto")
+                if logger:
+                    logger.info(f"{log_prefix} Silencio prolongado ({current_time - state.last_silence_time:.1f}s), reiniciando contexto")
+            state.context.reset()  # Reiniciar contexto después de silencio prolongado
+        
+        metrics.inc("whisper_filter_rejections", source=source, reason="silence")
+        return
+    else:
+        # Reiniciar flag de silencio cuando se detecta audio
+        state.silence_detected = False
+    
+    # Verificar que el audio no sea completamente ceros o tenga una forma incorrecta
+    if len(audio_np) == 0 or np.all(audio_np == 0):
+        if DEBUG_MODE and source == 'mic':
+            print(f"[{source}] Audio vacío detectado, saltando")
+        metrics.inc("whisper_filter_rejections", source=source, reason="empty_audio")
+        return
+    
+    # Eco de Discord captado por el micrófono: ya se transcribe desde su propia fuente
+    if echo_suppressor is not None and source == ECHO_SOURCE and echo_suppressor.is_echo(audio_np, start_time, source):
+        metrics.inc("whisper_filter_rejections", source=source, reason="echo")
+        return
+    
+    # Supresión de ruido y normalización de ganancia (después del eco, que compara la señal original)
+    if state.preprocessor is not None:
+        audio_np = state.preprocessor.process(audio_np)
+    
+    # Compuerta de voz: un modelo pequeño descarta ruido, toses o teclas antes del modelo principal
+    if speech_gate is not None and not speech_gate.has_speech(audio_np, source):
+        metrics.inc("whisper_filter_rejections", source=source, reason="gate_no_speech")
+        return
+    
+    try:
+        # Transcribir con idioma español
+        transcription_start = time.time()
+        # Usar texto anterior como contexto (ya tokenizado)
+        tokenizer = model_tokenizer(model)
+        state.context.expire(start_time)
+        # Idioma fijado de la fuente, o None para detectarlo en esta ventana
+        detect_language = state.language.needs_detection()
+        language = None if detect_language else state.language.language
+        prompt_tokens = state.context.prompt_tokens() if USE_PREVIOUS_TEXT else None
+        # Misma ventana con los mismos ajustes: el resultado sale de la caché sin pasar por el modelo
+        cache_key = result = None
+        parameters = decode_parameters(model, language, fast, state.preprocessor is not None)
+        if transcription_cache is not None and parameters is not None:
+            cache_key = transcription_cache.key(window, parameters)
+            result = transcription_cache.get(cache_key, source, prompt_tokens)
+        if result is None:
+            # Un modelo local se usa por turnos (lo comparte el refinado); el servidor admite concurrencia
+            with nullcontext() if isinstance(model, RemoteModel) else model_lock:
+                if DECODE_MODE == "budgeted" and not isinstance(model, RemoteModel):
+                    result = decode_with_budget(model, audio_np, source, prompt_tokens, fast, language)
+                    if result is None:
+                        if DEBUG_MODE:
+                            print(f"[{source}] Presupuesto de latencia agotado, ventana descartada")
+                        metrics.inc("whisper_filter_rejections", source=source, reason="over_budget")
+                        return
                 else:
-                    # Reiniciar flag de silencio cuando se detecta audio
-                    silence_detected = False
-                
-                # Verificar que el audio no sea completamente ceros o tenga una forma incorrecta
-                if len(audio_np) == 0 or np.all(audio_np == 0):
-                    if DEBUG_MODE and source == 'mic':
-                        print(f"[{source}] Audio vacío detectado, saltando")
-                    time.sleep(0.1)
-                    continue
-                
-                try:
-                    # Transcribir con idioma español
-                    transcription_start = time.time()
+                    language_probs = None
+                    if detect_language and not isinstance(model, RemoteModel):
+                        # Detección explícita para restringirla a LANGUAGE_CANDIDATES (pasa otra vez por el encoder)
+                        mel = whisper.log_mel_spectrogram(whisper.pad_or_trim(torch.from_numpy(audio_np)),
+                                                          n_mels=getattr(model.dims, 'n_mels', 80)).to(model.device)
+                        language_probs = language_probabilities(model, mel)
+                        language = max(language_probs, key=language_probs.get)
+                    if detect_language:
+                        metrics.inc("whisper_language_detections", source=source)
                     result = model.transcribe(
                         audio_np, 
                         fp16=HALF_PRECISION if DEVICE == "cuda" else False, 
-                        language=LANGUAGE,  # Usar español como idioma
+                        language=language,  # Idioma fijado de la fuente (None: lo detecta el servidor)
                         task="transcribe",   # Tarea de transcripción
-                        beam_size=5 if USE_BEAM_SEARCH else None,  # Usar búsqueda en haz si está activado
-                        initial_prompt=previous_text if USE_PREVIOUS_TEXT and previous_text else None  # Usar texto anterior como contexto
+                        beam_size=5 if USE_BEAM_SEARCH and not fast else None,  # Usar búsqueda en haz si está activado
+                        initial_prompt=state.context.prompt_text(tokenizer) if USE_PREVIOUS_TEXT else None
                     )
-                    transcription_time = time.time() - transcription_start
-                    text = result['text'].strip()
-                    
-                    # Detectar y eliminar repeticiones excesivas si está activado
-                    if DETECT_REPETITIONS:
-                        # 1. Filtro básico de repeticiones de palabras
-                        words = text.split()
-                        filtered_words = []
-                        repetition_count = 0
-                        last_word = None
-                        
-                        for word in words:
-                            if word == last_word:
-                                repetition_count += 1
-                            else:
-                                repetition_count = 0
-                            
-                            if repetition_count < MAX_REPETITIONS:
-                                filtered_words.append(word)
-                            
-                            last_word = word
-                        
-                        text = " ".join(filtered_words)
-                        
-                        # 2. Filtro avanzado para patrones repetitivos "¿eh?" y similares
-                        for pattern in HALLUCINATION_PATTERNS:
-                            # Contar ocurrencias
-                            pattern_count = text.lower().count(pattern)
-                            
-                            # Si hay más de MAX_REPETITIONS ocurrencias, filtrar todas
-                            if pattern_count > MAX_REPETITIONS:
-                                # Reemplazar el patrón con una sola ocurrencia
-                                text = re.sub(f"(?i){re.escape(pattern)}\\s*", f"{pattern} ", text, count=1)
-                                # Eliminar las ocurrencias restantes
-                                text = re.sub(f"(?i){re.escape(pattern)}\\s*", "", text)
-                    
-                    # 3. Filtrar expresiones cortas de la lista de alucinaciones
-                    words = text.split()
-                    filtered_words = []
-                    for word in words:
-                        # Filtrar palabras completas que coincidan con patrones de alucinación
-                        if not FILTER_SHORT_PHRASES or word.lower() not in HALLUCINATION_PATTERNS:
-                            filtered_words.append(word)
-                    
-                    text = " ".join(filtered_words)
-                    
-                    # 4. Verificar si el texto debe ignorarse por ser muy corto
-                    # Pero permitir palabras cortas importantes como "Hola", "Sí", etc.
-                    is_too_short = False
-                    if FILTER_SHORT_PHRASES:
-                        word_count = len(text.split())
-                        # Ignorar textos muy cortos que probablemente sean ruido
-                        if word_count < MIN_TEXT_LENGTH:
-                            # Solo descartar si es una palabra que está en el patrón de alucinaciones
-                            if text.lower() in HALLUCINATION_PATTERNS:
-                                is_too_short = True
-                                if DEBUG_MODE:
-                                    print(f"[{source}] Texto demasiado corto, ignorado: {text}")
-                    
-                    if is_too_short:
-                        time.sleep(0.1)
-                        continue
-                    
-                    # 5. Filtrar transcripciones con baja confianza
-                    # Obtener la confianza de manera segura (compatible con CPU y CUDA)
-                    try:
-                        # Formato antiguo (CPU)
-                        avg_confidence = sum(segment.avg_logprob for segment in result["segments"]) / len(result["segments"]) if result["segments"] else -1
-                    except AttributeError:
-                        try:
-                            # Formato nuevo (CUDA)
-                            avg_confidence = sum(segment.get('avg_logprob', -1) for segment in result["segments"]) / len(result["segments"]) if result["segments"] else -1
-                        except:
-                            # Si falla cualquier método, usar un valor predeterminado
-                            if DEBUG_MODE:
-                                print(f"[{source}] No se pudo determinar la confianza, usando valor predeterminado")
-                            avg_confidence = -1
-                    
-                    normalized_confidence = np.exp(avg_confidence) if avg_confidence > -float('inf') else 0  # Convertir log-prob a probabilidad, con protección
-                    
-                    # Registrar información sobre alucinaciones detectadas para análisis
-                    text_before_filtering = result['text'].strip()
-                    if logger and LOG_LEVEL <= logging.DEBUG and text_before_filtering != text:
-                        # Registrar cuando se han filtrado alucinaciones o repeticiones
-                        logger.debug(f"{log_prefix} Texto original: '{text_before_filtering}' → Texto filtrado: '{text}'")
-                    
-                    # Reducir el umbral para palabras cortas (para permitir que "Hola" pase)
-                    adjusted_threshold = CONFIDENCE_THRESHOLD
-                    if len(text.split()) <= 2:  # Para palabras o frases muy cortas
-                        adjusted_threshold = CONFIDENCE_THRESHOLD * 0.8  # Reducir el umbral en 20%
-                    
-                    if normalized_confidence < adjusted_threshold:
-                        if DEBUG_MODE:
-                            print(f"[{source}] Baja confianza ({normalized_confidence:.4f}), ignorado: {text}")
-                        time.sleep(0.1)
-                        continue
-                    
-                    # Solo actualizar si hay texto después de todos los filtros
-                    if text:
-                        overlay.update_text(source, text)
-                        print(f"[{source}] Transcripción: {text}")
-                        total_transcriptions += 1
-                        
-                        # Logging de la transcripción si está habilitado
-                        if logger and LOG_TRANSCRIPTIONS:
-                            timestamp = time.strftime("%H:%M:%S", time.localtime())
-                            confidence_str = f", confianza: {normalized_confidence:.2f}" if normalized_confidence > 0 else ""
-                            perf_str = f", tiempo: {transcription_time:.2f}s" if LOG_PERFORMANCE else ""
-                            logger.info(f"{log_prefix} [{timestamp}] {SPEAKERS.get(source, source)}: {text}{confidence_str}{perf_str}")
-                        
-                        # Actualizar texto anterior para contexto, pero limitar a las últimas CONTEXT_SENTENCES
-                        if USE_PREVIOUS_TEXT:
-                            # Dividir en oraciones (aproximado)
-                            sentences = re.split(r'[.!?]+', previous_text)
-                            # Quedarse con las últimas CONTEXT_SENTENCES oraciones significativas
-                            significant_sentences = [s for s in sentences if len(s.strip()) > 3][-CONTEXT_SENTENCES:]
-                            # Reconstruir contexto
-                            previous_text = ". ".join(significant_sentences) + ". " + text
-                        
-                        # Resetear contador de errores si hay transcripción exitosa
-                        error_count = 0
-                except Exception as e:
-                    current_time = time.time()
-                    error_count += 1
-                    
-                    # Limitar los mensajes de error para no saturar la consola
-                    if current_time - last_error_time > 5:  # máximo un mensaje cada 5 segundos
-                        error_msg = f"[{source}] Error en la transcripción: {str(e)}"
-                        print(error_msg)
-                        if logger:
-                            logger.error(f"{log_prefix} {str(e)}")
-                        last_error_time = current_time
-                    
-                    # Si hay muchos errores consecutivos, esperar más tiempo
-                    if error_count > 10:
-                        critical_msg = f"[{source}] Demasiados errores consecutivos, esperando más tiempo..."
-                        print(critical_msg)
-                        if logger:
-                            logger.warning(f"{log_prefix} Detectados {error_count} errores consecutivos")
-                        time.sleep(2)
-                        error_count = 0
-                    else:
-                        time.sleep(0.5)
+                    result['language_probs'] = language_probs
+            transcription_time = time.time() - transcription_start
+            metrics.observe("whisper_inference_seconds", transcription_time, source=source)
+            metrics.observe("whisper_rtf", transcription_time / window_seconds, source=source)
+            if transcription_cache is not None and 'backend' in result:
+                # Clave del backend que produjo el resultado: el cliente puede haber pasado del
+                # servidor al modelo de respaldo (o al revés) mientras se decodificaba la ventana
+                parameters = decode_parameters(model, language, fast, state.preprocessor is not None, result['backend'])
+                cache_key = transcription_cache.key(window, parameters) if parameters is not None else None
+            if cache_key is not None:
+                transcription_cache.put(cache_key, result, prompt_tokens)
+        else:
+            transcription_time = time.time() - transcription_start
+        text, normalized_confidence, reason = screen_transcript(result['text'].strip(), result["segments"])
+        
+        # Registrar información sobre alucinaciones detectadas para análisis
+        text_before_filtering = result['text'].strip()
+        if logger and LOG_LEVEL <= logging.DEBUG and text_before_filtering != text:
+            # Registrar cuando se han filtrado alucinaciones o repeticiones
+            logger.debug(f"{log_prefix} Texto original: '{text_before_filtering}' → Texto filtrado: '{text}'")
+        
+        if reason == "too_short":
+            if DEBUG_MODE:
+                print(f"[{source}] Texto demasiado corto, ignorado: {text}")
+            metrics.inc("whisper_filter_rejections", source=source, reason=reason)
+            return
+        
+        if reason == "low_confidence":
+            if DEBUG_MODE:
+                print(f"[{source}] Baja confianza ({normalized_confidence:.4f}), ignorado: {text}")
+            metrics.inc("whisper_filter_rejections", source=source, reason=reason)
+            state.language.note_rejection()
+            return
+        
+        # Solo actualizar si hay texto después de todos los filtros
+        if text:
+            speech_start = speech_end = None
+            if start_time is not None:
+                segments = result.get("segments") or []
+                offset = min((segment_value(seg, 'start', 0) for seg in segments), default=0)
+                duration = max((segment_value(seg, 'end', window_seconds) for seg in segments), default=window_seconds)
+                speech_start = start_time + min(offset, window_seconds)
+                speech_end = start_time + min(duration, window_seconds)
+            translation = result.get('translation') or None
+            # Turnos de palabra dentro de la ventana (un único turno sin detección de hablante)
+            turns = [(None, speech_start, speech_end, text)]
+            speaker_change = False
+            if state.speakers is not None and start_time is not None:
+                split = state.speakers.split(audio_np, result.get("segments") or [])
+                speaker_change = len(split) > 1
+                if not speaker_change:
+                    # Sin cambio de hablante: se conserva el texto filtrado de la ventana
+                    turns = [(split[0][0] if split else None, speech_start, speech_end, text)]
+                else:
+                    turns = []
+                    for index, turn_start, turn_end, turn_text in split:
+                        # Cada turno se publica por separado, así que pasa por los mismos filtros que la ventana
+                        turn_text, _, reason = screen_transcript(turn_text, result["segments"])
+                        if reason is not None:
+                            metrics.inc("whisper_diarization_rejected_turns", source=source, reason=reason)
+                            continue
+                        turns.append((index, start_time + turn_start, start_time + min(turn_end, window_seconds), turn_text))
+                    if not turns:
+                        metrics.inc("whisper_filter_rejections", source=source, reason="filtered_empty")
+                        return
+                    # Lo que se imprime, se registra y pasa al contexto es solo lo publicado
+                    text = " ".join(turn_text for _, _, _, turn_text in turns)
+                    speech_end = turns[-1][2]
+            # Las frases aceptadas alimentan la detección de idioma (sin probabilidades, cuenta como un voto)
+            if detect_language:
+                probs = result.get('language_probs') or ({result['language']: 1.0} if result.get('language') else None)
+                changed = state.language.observe(probs)
+                if changed:
+                    state.context.reset()  # El contexto en el idioma anterior sesgaría al decoder
+                    print(f"[{source}] Idioma detectado: {changed} (confianza {state.language.confidence:.2f})")
+                    if logger:
+                        logger.info(f"{log_prefix} Idioma detectado: {changed} (confianza {state.language.confidence:.2f})")
             else:
-                # Esperar a que haya suficientes frames
-                time.sleep(0.1)
+                state.language.observe(None)
+            message = None
+            for position, (index, turn_start, turn_end, turn_text) in enumerate(turns):
+                speaker = state.speakers.label(index) if index is not None else None
+                color = state.speakers.color(index) if index is not None else None
+                # La traducción es de toda la ventana: acompaña al último turno
+                message = timeline.add(source, turn_text, turn_start, turn_end,
+                                       translation if position == len(turns) - 1 else None, speaker, color)
+            # El refinado sustituye el texto de la ventana entera, así que solo se pide sin cambio de hablante
+            if transcript_refiner is not None and message is not None and not speaker_change:
+                transcript_refiner.submit(message, audio_np, source, result.get('language') or language)
+            print(f"[{source}] Transcripción: {text}")
+            if translation:
+                print(f"[{source}] Traducción: {translation}")
+            metrics.inc("whisper_transcriptions", source=source)
+            
+            # Logging de la transcripción si está habilitado
+            if logger and LOG_TRANSCRIPTIONS:
+                timestamp = time.strftime("%H:%M:%S", time.localtime())
+                confidence_str = f", confianza: {normalized_confidence:.2f}" if normalized_confidence > 0 else ""
+                perf_str = f", tiempo: {transcription_time:.2f}s" if LOG_PERFORMANCE else ""
+                logger.info(f"{log_prefix} [{timestamp}] {SPEAKERS.get(source, source)}: {text}{confidence_str}{perf_str}")
+            
+            # Añadir el texto al contexto (anillo de PROMPT_MAX_TOKENS tokens)
+            if USE_PREVIOUS_TEXT:
+                state.context.add(tokenizer, text, speech_end, source)
+            
+            # Resetear contador de errores si hay transcripción exitosa
+            state.error_count = 0
+        else:
+            metrics.inc("whisper_filter_rejections", source=source, reason="filtered_empty")
+    except Exception as e:
+        current_time = time.time()
+        state.error_count += 1
+        metrics.inc("whisper_transcription_errors", source=source)
+        
+        # Limitar los mensajes de error para no saturar la consola
+        if current_time - state.last_error_time > 5:  # máximo un mensaje cada 5 segundos
+            error_msg = f"[{source}] Error en la transcripción: {str(e)}"
+            print(error_msg)
+            if logger:
+                logger.error(f"{log_prefix} {str(e)}")
+            state.last_error_time = current_time
+        
+        # Si hay muchos errores consecutivos, esperar más tiempo
+        if state.error_count > 10:
+            critical_msg = f"[{source}] Demasiados errores consecutivos, esperando más tiempo..."
+            print(critical_msg)
+            if logger:
+                logger.warning(f"{log_prefix} Detectados {state.error_count} errores consecutivos")
+            time.sleep(2)
+            state.error_count = 0
+        else:
+            time.sleep(0.5)
+
+class ScheduledSource:
+    """Fuente registrada en el planificador con sus ventanas pendientes."""
+
+    def __init__(self, state, audio_buffer, priority, realtime=True):
+        self.state = state
+        self.audio_buffer = audio_buffer
+        self.priority = priority
+        # False en fuentes que esperan al consumidor (archivo a máxima velocidad): su
+        # audio no envejece en la cola, así que no se les aplica el presupuesto de latencia
+        self.realtime = realtime
+        self.pending = deque()  # Segmentos listos para inferencia, del más antiguo al más nuevo
+        self.ready = False      # El buffer tiene al menos una ventana sin extraer
+        self.busy = False       # Un worker está procesando esta fuente (su estado no es concurrente)
+
+class Segment:
+    """Ventana lista para inferencia.
+
+    captured_at es el instante (monotónico) en que llegó su última muestra y mide
+    la espera en cola; start_time es el reloj de muestras de su primera muestra y
+    sitúa el texto en la línea de tiempo.
+    """
+    __slots__ = ('entry', 'audio', 'captured_at', 'start_time', 'fast')
+
+    def __init__(self, entry, audio, captured_at, start_time=None):
+        self.entry = entry
+        self.audio = audio
+        self.captured_at = captured_at
+        self.start_time = start_time
+        self.fast = False
+
+class InferenceScheduler:
+    """Cola común delante del modelo para todas las fuentes.
+
+    Los buffers avisan cuando tienen una ventana completa; los workers extraen
+    las ventanas como segmentos y eligen el siguiente según SCHEDULER_POLICY.
+    Los segmentos que superan SCHEDULER_LATENCY_BUDGET se decodifican en modo
+    rápido o se descartan, y los que superan el doble se descartan siempre, de
+    modo que una fuente muy activa no puede retrasar indefinidamente a las demás.
+    Las fuentes que no son de tiempo real (archivos leídos a máxima velocidad)
+    quedan fuera de esa política: su productor espera al consumidor y no pierden
+    audio por ir con retraso.
+    """
+
+    def __init__(self, policy=SCHEDULER_POLICY, latency_budget=SCHEDULER_LATENCY_BUDGET):
+        self.policy = policy
+        self.latency_budget = latency_budget
+        self.window_samples = int(RATE * BUFFER_SECONDS)
+        self.entries = []
+        self.round_robin_index = 0
+        lock = threading.Lock()
+        self.cond = threading.Condition(lock)       # Workers esperando ventanas
+        self.idle_cond = threading.Condition(lock)  # Trabajo de baja prioridad esperando a que no haya ventanas
+
+    def add_source(self, state, audio_buffer, priority=None, realtime=True):
+        """Registra una fuente; su buffer avisará al planificador con cada ventana."""
+        if priority is None:
+            priority = SOURCE_PRIORITIES.get(state.source, 0)
+        entry = ScheduledSource(state, audio_buffer, priority, realtime)
+        audio_buffer.wake_threshold = self.window_samples
+        audio_buffer.listener = lambda: self._mark_ready(entry)
+        metrics.set_callback("whisper_queue_seconds", lambda: len(audio_buffer) / RATE, source=state.source)
+        with self.cond:
+            self.entries.append(entry)
+        return entry
+
+    def stop(self):
+        with self.cond:
+            self.cond.notify_all()
+            self.idle_cond.notify_all()
+
+    def _is_idle(self):
+        return not any(e.ready or e.pending or e.busy for e in self.entries)
+
+    def wait_idle(self):
+        """Bloquea hasta que no haya ventanas pendientes ni en inferencia (False al cerrar)."""
+        with self.cond:
+            while running and not self._is_idle():
+                self.idle_cond.wait()
+        return running
+
+    def _mark_ready(self, entry):
+        # Se llama desde el hilo productor: solo marca y despierta, sin leer audio
+        with self.cond:
+            entry.ready = True
+            self.cond.notify()
+
+    def _drain(self, entry):
+        """Convierte en segmentos todas las ventanas completas del buffer de una fuente."""
+        windows = []
+        while True:
+            window = entry.audio_buffer.try_read(self.window_samples, with_time=True)
+            if window is None:
+                break
+            windows.append(window)
+        if not windows:
+            return
+        # El último audio del buffer acaba de llegar: cada ventana terminó de capturarse
+        # tantos segundos antes como audio quede por detrás de ella. Una fuente que no es
+        # de tiempo real escribe tan rápido como se lee, así que su audio llega ahora
+        now = time.monotonic()
+        behind = len(entry.audio_buffer) + self.window_samples * (len(windows) - 1)
+        with self.cond:
+            for window, start_time in windows:
+                captured_at = now - behind / RATE if entry.realtime else now
+                entry.pending.append(Segment(entry, window, captured_at, start_time))
+                behind -= self.window_samples
+
+    def _choose(self, candidates):
+        if self.policy == "round_robin":
+            count = len(self.entries)
+            for offset in range(count):
+                entry = self.entries[(self.round_robin_index + offset) % count]
+                if entry in candidates:
+                    self.round_robin_index = (self.round_robin_index + offset + 1) % count
+                    return entry
+        if self.policy == "mic_priority":
+            return min(candidates, key=lambda e: (-e.priority, e.pending[0].captured_at))
+        # "edf": el plazo de cada segmento es captured_at + presupuesto, igual para todos
+        return min(candidates, key=lambda e: e.pending[0].captured_at)
+
+    def next_segment(self):
+        """Bloquea hasta tener un segmento que procesar (None al cerrar la aplicación)."""
+        while running:
+            with self.cond:
+                while running and not any(e.ready or (e.pending and not e.busy) for e in self.entries):
+                    self.cond.wait()
+                if not running:
+                    return None
+                to_drain = [e for e in self.entries if e.ready]
+                for entry in to_drain:
+                    entry.ready = False
+            for entry in to_drain:
+                self._drain(entry)
+
+            with self.cond:
+                now = time.monotonic()
+                candidates = [e for e in self.entries if e.pending and not e.busy]
+                while candidates:
+                    entry = self._choose(candidates)
+                    segment = entry.pending.popleft()
+                    age = now - segment.captured_at
+                    source = entry.state.source
+                    if entry.realtime and age > self.latency_budget:
+                        if SCHEDULER_STALE_ACTION == "drop" or age > 2 * self.latency_budget:
+                            metrics.inc("whisper_scheduler_dropped", source=source)
+                            if not entry.pending:
+                                candidates.remove(entry)
+                            continue
+                        segment.fast = True
+                        metrics.inc("whisper_scheduler_downgraded", source=source)
+                    metrics.observe("whisper_queue_delay_seconds", age, source=source)
+                    entry.busy = True
+                    return segment
+        return None
+
+    def done(self, segment):
+        """Libera la fuente del segmento para que otro worker pueda atenderla."""
+        with self.cond:
+            segment.entry.busy = False
+            if segment.entry.pending:
+                self.cond.notify()
+            elif self._is_idle():
+                self.idle_cond.notify_all()
+
+class RefinementJob:
+    """Texto ya publicado pendiente de volver a transcribirse con el modelo de refinado."""
+    __slots__ = ('message_id', 'part', 'audio', 'source', 'language')
+
+    def __init__(self, message_id, part, audio, source, language=LANGUAGE):
+        self.message_id = message_id
+        self.part = part
+        self.audio = audio
+        self.source = source
+        self.language = language
+
+class TranscriptRefiner:
+    """Segunda pasada: re-decodifica las ventanas publicadas con un modelo mayor.
+
+    Guarda en memoria el audio de los últimos textos publicados y, solo cuando el
+    planificador no tiene ventanas en vuelo ni pendientes, los transcribe con
+    REFINE_MODEL_SIZE y búsqueda en haz. El texto mejorado sustituye al original
+    en la línea de tiempo (y de ahí en el chat, la web y los subtítulos si el
+    mensaje aún no se cerró) solo si supera los mismos filtros que el texto en
+    vivo. Si REFINE_MODEL_SIZE coincide con MODEL_SIZE se reutiliza el modelo en
+    vivo y se toma con model_lock como trabajo de fondo, así que nunca adelanta
+    a una ventana en vivo: como mucho una ventana en vivo espera a que termine
+    el refinado en curso. Con un modelo de refinado propio no hay bloqueo y las
+    ventanas en vivo no esperan nunca.
+    """
+
+    def __init__(self, scheduler, live_model, logger=None):
+        self.scheduler = scheduler
+        self.live_model = live_model
+        self.logger = logger
+        self.model = None
+        self.jobs = deque()
+        self.cond = threading.Condition()
+        metrics.set_callback("whisper_refine_pending", lambda: len(self.jobs))
+
+    def submit(self, message, audio, source, language=LANGUAGE):
+        """Encola el último texto publicado en `message` (se llama desde el hilo de inferencia)."""
+        job = RefinementJob(message['id'], len(message['parts']) - 1, audio, source, language)
+        timeline.hold(job.message_id)
+        with self.cond:
+            self.jobs.append(job)
+            dropped = self.jobs.popleft() if len(self.jobs) > REFINE_MAX_PENDING else None
+            self.cond.notify()
+        if dropped is not None:
+            metrics.inc("whisper_refine_dropped", source=dropped.source)
+            timeline.replace_part(dropped.message_id, dropped.part, None)
+
+    def stop(self):
+        with self.cond:
+            self.cond.notify_all()
+
+    def _load_model(self):
+        if REFINE_MODEL_SIZE == MODEL_SIZE and not isinstance(self.live_model, RemoteModel):
+            return self.live_model  # Mismo modelo: el refinado solo añade búsqueda en haz
+        print(f"Cargando modelo de refinado '{REFINE_MODEL_SIZE}' en {DEVICE}...")
+        model = whisper.load_model(REFINE_MODEL_SIZE, device=DEVICE)
+        print(f"Modelo de refinado '{REFINE_MODEL_SIZE}' cargado")
+        return model
+
+    def run(self):
+        try:
+            self.model = self._load_model()
+        except Exception as e:
+            print(f"No se pudo cargar el modelo de refinado: {str(e)}")
+            if self.logger:
+                self.logger.error(f"Refinado desactivado: {str(e)}")
+            return
+
+        while running:
+            with self.cond:
+                while running and not self.jobs:
+                    self.cond.wait()
+            if not self.scheduler.wait_idle():
+                break
+            with self.cond:
+                if not self.jobs:
+                    continue
+                job = self.jobs.popleft()
+            self._refine(job)
+
+        # Liberar los mensajes retenidos para que se cierren
+        with self.cond:
+            pending, self.jobs = list(self.jobs), deque()
+        for job in pending:
+            timeline.replace_part(job.message_id, job.part, None)
+
+    def _refine(self, job):
+        text = None
+        try:
+            # Solo el modelo en vivo compartido necesita turno; un modelo de refinado propio
+            # decodifica en paralelo y no hace esperar a las ventanas en vivo
+            shared = self.model is self.live_model
+            if shared:
+                model_lock.acquire(live=False)
+            try:
+                start = time.perf_counter()
+                result = self.model.transcribe(
+                    job.audio,
+                    fp16=HALF_PRECISION if DEVICE == "cuda" else False,
+                    language=job.language,
+                    task="transcribe",
+                    beam_size=REFINE_BEAM_SIZE
+                )
+            finally:
+                if shared:
+                    model_lock.release()
+            metrics.observe("whisper_refine_seconds", time.perf_counter() - start, source=job.source)
+            metrics.inc("whisper_refine_windows", source=job.source)
+            # Un refinado que no pasaría los filtros en vivo no sustituye al texto publicado
+            text, _, reason = screen_transcript(result['text'].strip(), result['segments'])
+            if reason is not None:
+                metrics.inc("whisper_refine_rejected", source=job.source, reason=reason)
+                text = None
         except Exception as e:
-            error_msg = f"[{source}] Error en el bucle de transcripción: {str(e)}"
+            print(f"[{job.source}] Error en el refinado: {str(e)}")
+        if timeline.replace_part(job.message_id, job.part, text):
+            metrics.inc("whisper_refine_changed", source=job.source)
+            if self.logger and LOG_TRANSCRIPTIONS:
+                self.logger.info(f"[{job.source.upper()}] Refinado: {text}")
+
+def transcribe_loop(scheduler, model, overlay, logger=None):
+    """Worker de inferencia: procesa los segmentos que elige el planificador."""
+    global running
+    if logger:
+        logger.info(f"Iniciando bucle de transcripción con modelo {MODEL_SIZE} (política {scheduler.policy})")
+
+    print(f"Iniciando bucle de transcripción ({threading.current_thread().name})")
+
+    while running:
+        segment = scheduler.next_segment()
+        if segment is None:
+            break
+        state = segment.entry.state
+        try:
+            process_window(state, model, segment.audio, overlay, logger, fast=segment.fast, start_time=segment.start_time)
+        except Exception as e:
+            error_msg = f"[{state.source}] Error en el bucle de transcripción: {str(e)}"
             print(error_msg)
             if logger:
-                logger.error(f"{log_prefix} Error general: {str(e)}")
+                logger.error(f"{state.log_prefix} Error general: {str(e)}")
                 if LOG_LEVEL <= logging.DEBUG:
-                    logger.debug(f"{log_prefix} Traza: {traceback.format_exc()}")
+                    logger.debug(f"{state.log_prefix} Traza: {traceback.format_exc()}")
             time.sleep(1)  # Esperar más tiempo en caso de error general
-    
+        finally:
+            scheduler.done(segment)
+
     # Mensaje de finalización
-    end_msg = f"Bucle de transcripción para {source} finalizado"
-    print(end_msg)
+    print(f"Bucle de transcripción finalizado ({threading.current_thread().name})")
+    if logger:
+        logger.info(f"Finalizado. Total transcripciones: {metrics.sum_by('whisper_transcriptions')}")
+
+class InferenceJob:
+    """Petición de transcripción pendiente en el servidor de inferencia."""
+    __slots__ = ('audio', 'options', 'result', 'error', 'done')
+
+    def __init__(self, audio, options):
+        self.audio = audio
+        self.options = options
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+class BatchPromptTask(whisper.decoding.DecodingTask):
+    """DecodingTask de whisper con un prompt propio para cada ventana del lote.
+
+    whisper.decode() aplica el mismo prompt a todo el lote. Aquí la tarea se
+    construye con el prompt de la primera ventana (fija la posición de los
+    tokens especiales y del primer token generado) y antes del bucle de
+    decodificación se sustituye fila a fila por el de cada ventana, así que
+    todos los prompts deben tener la misma longitud.
+    """
+
+    def __init__(self, model, options, prompts=None):
+        super().__init__(model, options)
+        self.prompts = torch.tensor(prompts) if prompts else None
+
+    def _main_loop(self, audio_features, tokens):
+        if self.prompts is not None:
+            tokens = tokens.clone()
+            prompts = self.prompts.repeat_interleave(self.n_group, dim=0).to(tokens.device)
+            tokens[:, 1:1 + prompts.shape[1]] = prompts  # Tras <|startofprev|>
+        return super()._main_loop(audio_features, tokens)
+
+def transcribe_batch(model, jobs):
+    """Transcribe varias ventanas con una pasada de decodificación por grupo de opciones.
+
+    Las ventanas se convierten a log-mel de 30 s y se apilan en un único tensor;
+    se agrupan las peticiones con las mismas opciones de decodificación salvo el
+    prompt, que cada ventana conserva: los prompts de un grupo se recortan a la
+    longitud del más corto quedándose con los tokens más recientes (el mismo
+    recorte que hace Whisper cuando el prompt no cabe). Como decode_with_budget(),
+    las ventanas con compresión alta o logprob bajo se vuelven a decodificar,
+    juntas, con la siguiente temperatura de DECODE_TEMPERATURES, y los umbrales
+    son los DECODE_* configurados. Se decodifica con marcas de tiempo y cada
+    resultado imita la salida de model.transcribe(), con los segmentos sacados
+    de los tokens de marca de tiempo igual que en decode_with_budget(), así que
+    los clientes conservan los tiempos de cada segmento para la línea de
+    tiempo, los subtítulos y la detección de hablante.
+    """
+    groups = {}
+    for job in jobs:
+        options = {name: value for name, value in job.options.items() if name != 'initial_prompt'}
+        key = (tuple(sorted(options.items())), bool(job.options.get('initial_prompt')))
+        groups.setdefault(key, []).append(job)
+
+    n_mels = getattr(model.dims, 'n_mels', 80)
+    tokenizer = model_tokenizer(model)
+    for (key, prompted), group in groups.items():
+        options = dict(key)
+        try:
+            mels = torch.stack([
+                whisper.log_mel_spectrogram(whisper.pad_or_trim(torch.from_numpy(job.audio)), n_mels=n_mels)
+                for job in group
+            ]).to(model.device)
+            prompts = None
+            if prompted:
+                prompts = [tokenizer.encode(" " + job.options['initial_prompt'].strip()) for job in group]
+                length = min(model.dims.n_text_ctx // 2 - 1, min(len(prompt) for prompt in prompts))
+                prompts = [prompt[len(prompt) - length:] for prompt in prompts]
+
+            decoded = [None] * len(group)
+            pending = list(range(len(group)))
+            for attempt, temperature in enumerate(DECODE_TEMPERATURES):
+                if attempt > 0:
+                    metrics.inc("whisper_decode_fallbacks", len(pending), source="server")
+                decoding_options = whisper.DecodingOptions(
+                    task=options.get('task', 'transcribe'),
+                    language=options.get('language'),
+                    temperature=temperature,
+                    beam_size=options.get('beam_size') if temperature == 0 else None,
+                    prompt=prompts[pending[0]] if prompts else None,
+                    fp16=HALF_PRECISION and DEVICE == "cuda",
+                    without_timestamps=False
+                )
+                task = BatchPromptTask(model, decoding_options, [prompts[i] for i in pending] if prompts else None)
+                results = task.run(mels[pending])
+                metrics.observe("whisper_server_batch_size", len(pending))
+                retry = []
+                for index, result in zip(pending, results):
+                    decoded[index] = result
+                    # Ventana sin voz: no tiene sentido reintentar
+                    if result.no_speech_prob > DECODE_NO_SPEECH_THRESHOLD and result.avg_logprob < DECODE_LOGPROB_THRESHOLD:
+                        continue
+                    if (result.compression_ratio > DECODE_COMPRESSION_RATIO_THRESHOLD
+                            or result.avg_logprob < DECODE_LOGPROB_THRESHOLD):
+                        retry.append(index)
+                pending = retry
+                if not pending:
+                    break
+
+            for job, result in zip(group, decoded):
+                duration = len(job.audio) / RATE
+                # Mismo criterio que model.transcribe() para descartar ventanas sin voz
+                if result.no_speech_prob > DECODE_NO_SPEECH_THRESHOLD and result.avg_logprob < DECODE_LOGPROB_THRESHOLD:
+                    job.result = {'text': "", 'segments': [], 'language': result.language}
+                else:
+                    segments = [{'start': seg_start, 'end': seg_end, 'text': text,
+                                 'avg_logprob': result.avg_logprob, 'no_speech_prob': result.no_speech_prob,
+                                 'temperature': result.temperature, 'compression_ratio': result.compression_ratio}
+                                for seg_start, seg_end, text in parse_timestamp_segments(tokenizer, result.tokens, duration)]
+                    job.result = {'text': result.text, 'language': result.language, 'segments': segments}
+        except Exception as e:
+            for job in group:
+                job.error = str(e)
+        for job in group:
+            job.done.set()
+
+class InferenceBatcher:
+    """Junta las peticiones concurrentes de varios clientes en lotes para un único modelo."""
+
+    def __init__(self, model, max_batch=INFERENCE_SERVER_MAX_BATCH, batch_wait=INFERENCE_SERVER_BATCH_WAIT):
+        self.model = model
+        self.max_batch = max_batch
+        self.batch_wait = batch_wait
+        self.jobs = deque()
+        self.cond = threading.Condition()
+        metrics.set_callback("whisper_server_pending", lambda: len(self.jobs))
+
+    def submit(self, job):
+        with self.cond:
+            self.jobs.append(job)
+            self.cond.notify()
+        metrics.inc("whisper_server_requests")
+
+    def run(self):
+        while running:
+            with self.cond:
+                while running and not self.jobs:
+                    self.cond.wait(1.0)
+                # Dar un margen breve para que lleguen más peticiones al mismo lote
+                deadline = time.monotonic() + self.batch_wait
+                while running and len(self.jobs) < self.max_batch:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.cond.wait(remaining)
+                batch = [self.jobs.popleft() for _ in range(min(self.max_batch, len(self.jobs)))]
+            if batch:
+                start = time.perf_counter()
+                transcribe_batch(self.model, batch)
+                metrics.observe("whisper_inference_seconds", time.perf_counter() - start, source="server")
+
+class _InferenceRequestHandler(BaseHTTPRequestHandler):
+    """POST /transcribe: [longitud JSON u32][opciones JSON][PCM int16]. GET /health."""
+    protocol_version = "HTTP/1.1"  # Conexiones persistentes para el pool de los clientes
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/health":
+            self._send_json(200, {'model': MODEL_SIZE, 'device': DEVICE, 'fp16': HALF_PRECISION and DEVICE == "cuda",
+                                  'pending': len(self.server.batcher.jobs)})
+        else:
+            self._send_json(404, {'error': "not found"})
+
+    def do_POST(self):
+        if self.path != "/transcribe":
+            self._send_json(404, {'error': "not found"})
+            return
+        try:
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            options_length = struct.unpack('!I', body[:4])[0]
+            options = json.loads(body[4:4 + options_length].decode('utf-8'))
+            audio = np.frombuffer(body[4 + options_length:], dtype=np.float32)
+        except Exception as e:
+            self._send_json(400, {'error': str(e)})
+            return
+        job = InferenceJob(audio, options)
+        self.server.batcher.submit(job)
+        job.done.wait()
+        if job.error:
+            self._send_json(500, {'error': job.error})
+        else:
+            self._send_json(200, job.result)
+
+    def log_message(self, format, *args):
+        pass
+
+def run_inference_server(host=INFERENCE_SERVER_HOST, port=INFERENCE_SERVER_PORT):
+    """Modo servidor (--server): un modelo compartido por todas las instancias del overlay."""
+    logger = setup_logging()
+    print(f"Cargando modelo Whisper '{MODEL_SIZE}' en {DEVICE} para el servidor de inferencia...")
+    model = whisper.load_model(MODEL_SIZE, device=DEVICE)
+    batcher = InferenceBatcher(model)
+    threading.Thread(target=batcher.run, daemon=True, name="InferenceBatchThread").start()
+
+    server = ThreadingHTTPServer((host, port), _InferenceRequestHandler)
+    server.daemon_threads = True
+    server.batcher = batcher
+    print(f"Servidor de inferencia escuchando en http://{host}:{port} (lotes de hasta {batcher.max_batch})")
     if logger:
-        logger.info(f"{log_prefix} Finalizado. Total transcripciones: {total_transcriptions}")
+        logger.info(f"Servidor de inferencia iniciado en {host}:{port} con modelo {MODEL_SIZE}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\nServidor de inferencia detenido")
+    finally:
+        request_shutdown()
+        server.server_close()
+    return 0
+
+class RemoteModel:
+    """Cliente del servidor de inferencia con la misma interfaz que model.transcribe().
+
+    Mantiene un pool de conexiones HTTP persistentes: cada hilo de transcripción
+    usa la suya, así que varias ventanas están en vuelo a la vez y el servidor
+    las agrupa en un mismo lote. Si el servidor no responde se usa un modelo
+    local (cargado la primera vez que hace falta) y se vuelve a probar el
+    servidor pasados INFERENCE_SERVER_RETRY segundos. El modelo local lo
+    comparten todos los hilos, así que se usa de uno en uno. Cada resultado
+    lleva en 'backend' quién lo produjo, para la clave de caché.
+    """
+
+    def __init__(self, host=INFERENCE_SERVER_HOST, port=INFERENCE_SERVER_PORT, logger=None):
+        self.host = host
+        self.port = port
+        self.logger = logger
+        self.pool = deque()  # Conexiones libres (LIFO para reutilizar la más reciente)
+        self.pool_lock = threading.Lock()
+        self.retry_at = 0  # time.monotonic() a partir del cual se vuelve a probar el servidor
+        self.server_info = None  # Respuesta de /health (modelo y dispositivo del servidor); None si se desconoce
+        self.local_model = None
+        self.local_lock = threading.Lock()  # Carga y uso del modelo local de respaldo
+
+    def _connection(self):
+        with self.pool_lock:
+            if self.pool:
+                return self.pool.pop()
+        return http.client.HTTPConnection(self.host, self.port, timeout=INFERENCE_CLIENT_TIMEOUT)
+
+    def _release(self, connection):
+        with self.pool_lock:
+            if len(self.pool) < INFERENCE_CLIENT_CONNECTIONS:
+                self.pool.append(connection)
+                return
+        connection.close()
+
+    def _transcribe_locally(self, audio, **options):
+        # Un único modelo para todos los hilos: dos decodificaciones a la vez mezclarían su caché KV
+        with self.local_lock:
+            if self.local_model is None:
+                print(f"Cargando modelo local '{MODEL_SIZE}' de respaldo...")
+                self.local_model = whisper.load_model(MODEL_SIZE, device=DEVICE)
+            result = self.local_model.transcribe(audio, **options)
+        result['backend'] = "transcribe"
+        return result
+
+    def backend(self):
+        """Backend que usará la próxima ventana: "remote" o "transcribe" (modelo local de respaldo)."""
+        return "remote" if time.monotonic() >= self.retry_at else "transcribe"
+
+    def health(self):
+        """Devuelve la información del servidor (y la guarda en server_info) o None si no está disponible."""
+        connection = self._connection()
+        try:
+            connection.request("GET", "/health")
+            response = connection.getresponse()
+            info = json.loads(response.read().decode('utf-8'))
+            self._release(connection)
+            self.server_info = info
+            return info
+        except (OSError, http.client.HTTPException, ValueError):
+            connection.close()
+            return None
+
+    def transcribe(self, audio, fp16=False, language=None, task="transcribe", beam_size=None, initial_prompt=None):
+        if time.monotonic() >= self.retry_at:
+            options = json.dumps({'language': language, 'task': task, 'beam_size': beam_size,
+                                  'initial_prompt': initial_prompt}).encode('utf-8')
+            body = struct.pack('!I', len(options)) + options + np.ascontiguousarray(audio, dtype=np.float32).tobytes()
+            connection = self._connection()
+            try:
+                connection.request("POST", "/transcribe", body, {"Content-Type": "application/octet-stream"})
+                response = connection.getresponse()
+                payload = json.loads(response.read().decode('utf-8'))
+                if response.status != 200:
+                    # Error del modelo en el servidor (p. ej. sin memoria): se trata como un servidor caído
+                    raise http.client.HTTPException(f"HTTP {response.status}: {payload.get('error', '')}")
+                self._release(connection)
+                if self.server_info is None:
+                    self.health()  # El servidor volvió (quizá reiniciado con otro modelo)
+                payload['backend'] = "remote"
+                return payload
+            except (OSError, http.client.HTTPException, ValueError) as e:
+                connection.close()
+                self.retry_at = time.monotonic() + INFERENCE_SERVER_RETRY
+                self.server_info = None
+                metrics.inc("whisper_client_fallbacks")
+                print(f"Servidor de inferencia no disponible ({str(e)}), usando el modelo local")
+                if self.logger:
+                    self.logger.warning(f"Servidor de inferencia no disponible: {str(e)}")
+                if not INFERENCE_CLIENT_FALLBACK:
+                    raise
+
+        return self._transcribe_locally(audio, fp16=fp16, language=language, task=task,
+                                        beam_size=beam_size, initial_prompt=initial_prompt)
 
 def main():
-    global running
+    global running, transcript_refiner, speech_gate, echo_suppressor, transcription_cache
     running = True
     
     try:
@@ -850,10 +4492,41 @@ def main():
             print(f"- El procesamiento será más lento que con GPU")
             print("=" * 60 + "\n")
         
-        # Cargar modelo Whisper (tiny/base/small según poder)
-        print("Cargando modelo Whisper (esto puede tardar unos segundos)...")
-        model = whisper.load_model(MODEL_SIZE, device=DEVICE)  # Modelo ajustado según configuración
-        print(f"Modelo '{MODEL_SIZE}' cargado correctamente en {DEVICE}")
+        # Cargar modelo Whisper (tiny/base/small según poder) o conectar con el servidor compartido
+        if INFERENCE_MODE == "client":
+            model = RemoteModel(logger=logger)
+            info = model.health()
+            if info:
+                print(f"Usando el servidor de inferencia {INFERENCE_SERVER_HOST}:{INFERENCE_SERVER_PORT} "
+                      f"(modelo '{info['model']}' en {info['device']})")
+            else:
+                print(f"Servidor de inferencia {INFERENCE_SERVER_HOST}:{INFERENCE_SERVER_PORT} no disponible; "
+                      f"se usará el modelo local")
+        else:
+            print("Cargando modelo Whisper (esto puede tardar unos segundos)...")
+            model = whisper.load_model(MODEL_SIZE, device=DEVICE)  # Modelo ajustado según configuración
+            print(f"Modelo '{MODEL_SIZE}' cargado correctamente en {DEVICE}")
+        if GATE_ENABLED:
+            speech_gate = load_speech_gate(model, logger)
+            if speech_gate is not None:
+                print(f"Compuerta de voz activa con el modelo '{GATE_MODEL_SIZE}' (umbral {GATE_NO_SPEECH_THRESHOLD})")
+        if CACHE_ENABLED:
+            try:
+                transcription_cache = TranscriptionCache()
+                print(f"Caché de transcripciones en '{CACHE_FOLDER}': {len(transcription_cache.entries)} ventanas "
+                      f"({transcription_cache.total_bytes / (1024 * 1024):.1f} MB de {CACHE_MAX_MB} MB)")
+            except OSError as e:
+                print(f"No se pudo abrir la caché de transcripciones: {str(e)}")
+        if LANGUAGE_DETECT:
+            candidates = ", ".join(LANGUAGE_CANDIDATES) if LANGUAGE_CANDIDATES else "todos"
+            print(f"Detección de idioma por fuente activa (candidatos: {candidates})")
+        if DUAL_OUTPUT:
+            if DECODE_MODE != "budgeted" or isinstance(model, RemoteModel):
+                print("DUAL_OUTPUT requiere DECODE_MODE = 'budgeted' y modelo local; no se mostrará la traducción")
+            elif not model.is_multilingual:
+                print(f"DUAL_OUTPUT: el modelo '{MODEL_SIZE}' no es multilingüe; no se mostrará la traducción")
+            else:
+                print("Doble salida activa: transcripción y traducción al inglés desde la misma pasada del encoder")
 
         # Crear aplicación y overlay
         print("Creando interfaz de usuario...")
@@ -862,98 +4535,125 @@ def main():
         overlay.show()
         print("Interfaz creada correctamente")
 
-        # Colas para audio
-        mic_queue = deque(maxlen=1000)  # Limitar tamaño de la cola para evitar fuga de memoria
-        discord_queue = deque(maxlen=1000)
-        
+        # Un buffer por fuente (capacidad limitada a QUEUE_MAX_SECONDS para evitar fuga de memoria)
         print(f"\nIniciando captura de audio con configuración:")
-        print(f"MIC_DEVICE: {MIC_DEVICE}")
-        print(f"DISCORD_DEVICE: {DISCORD_DEVICE}")
+        for config in AUDIO_SOURCES:
+            print(f"- {config['name']}: {', '.join(f'{k}={v}' for k, v in config.items() if k != 'name')}")
         print(f"BUFFER_SECONDS: {BUFFER_SECONDS}")
         print(f"DEBUG_MODE: {DEBUG_MODE}")
 
-        # Hilos de captura
+        # Cierre de mensajes de la línea de tiempo y subtítulos en streaming
+        subtitle_writer = None
+        if SUBTITLE_EXPORT:
+            try:
+                subtitle_writer = SubtitleWriter(logger=logger)
+                timeline.add_listener(subtitle_writer.on_timeline_event)
+            except OSError as e:
+                print(f"No se pudieron crear los archivos de subtítulos: {str(e)}")
+        threading.Thread(target=timeline.run_finalizer, daemon=True, name="TimelineThread").start()
+        if ARCHIVE_ENABLED:
+            threading.Thread(target=run_archive_sync, daemon=True, name="ArchiveSyncThread").start()
+            print(f"Archivo de audio activo en '{ARCHIVE_FOLDER}' ({ARCHIVE_MINUTES} minutos por fuente)")
+        if BROADCAST_ENABLED:
+            start_broadcast_server(logger)
+
+        # Un hilo de captura por fuente; la inferencia pasa por un planificador común
+        scheduler = InferenceScheduler()
+        audio_sources.append(scheduler)
         try:
-            # Hilo para el micrófono
-            mic_thread = threading.Thread(
-                target=audio_capture_mic,
-                args=(MIC_DEVICE, mic_queue),
-                daemon=True,
-                name="MicThread"
-            )
-            
-            # Para Discord usamos simulación por ahora para mayor estabilidad
-            discord_thread = threading.Thread(
-                target=simulate_discord_audio,
-                args=(discord_queue,),
-                daemon=True,
-                name="DiscordThread"
-            )
-            
-            mic_thread.start()
-            print("Hilo de captura de micrófono iniciado")
+            for config in AUDIO_SOURCES:
+                name = config['name']
+                buffers = {}
+                for source in source_names(config):
+                    buffers[source] = create_audio_buffer(source)
+                    scheduler.add_source(SourceState(source), buffers[source], config.get('priority'),
+                                         realtime=config.get('realtime', True))
+                audio_source = create_audio_source(config, buffers)
+                
+                threading.Thread(
+                    target=audio_source.run,
+                    daemon=True,
+                    name=f"{name.capitalize()}Thread"
+                ).start()
+                print(f"Hilo de captura de {name} iniciado ({config.get('type', 'device')})")
             
-            discord_thread.start()
-            print("Hilo de audio de Discord iniciado (simulado)")
+            # Recepción de Discord por hablante (RTP/Opus): un solo hilo para todos los SSRC
+            if RTP_ENABLED:
+                rtp_receiver = RtpReceiver(scheduler)
+                audio_sources.append(rtp_receiver)
+                threading.Thread(target=rtp_receiver.receive_loop, daemon=True, name="RtpReceiveThread").start()
+                print(f"Recepción RTP por hablante iniciada en el puerto {RTP_PORT}")
+
+            # Supresión de eco: el historial del buffer de referencia sirve para buscar su audio en el micrófono
+            if ECHO_SUPPRESSION:
+                reference = next((b for b in audio_buffers if b.source == ECHO_REFERENCE), None)
+                if reference is not None:
+                    echo_suppressor = EchoSuppressor(reference)
+                    print(f"Supresión de eco activa: {ECHO_SOURCE} frente a {ECHO_REFERENCE} "
+                          f"(retardo máximo {ECHO_MAX_LAG_SECONDS}s, umbral {ECHO_CORRELATION_THRESHOLD})")
+                else:
+                    print(f"Supresión de eco desactivada: no hay fuente '{ECHO_REFERENCE}'")
         except Exception as e:
             print(f"Error al iniciar hilos de captura de audio: {str(e)}")
             traceback.print_exc()
             time.sleep(10)
             raise
 
-        # Hilos de transcripción
+        # Refinado en segundo plano con un modelo mayor (solo cuando el planificador está libre)
+        if REFINE_ENABLED:
+            transcript_refiner = TranscriptRefiner(scheduler, model, logger)
+            audio_sources.append(transcript_refiner)
+            threading.Thread(target=transcript_refiner.run, daemon=True, name="RefineThread").start()
+            print(f"Refinado en segundo plano con el modelo '{REFINE_MODEL_SIZE}' activado")
+
+        # Hilos de inferencia (comparten el modelo a través del planificador). En modo cliente
+        # hay al menos un hilo por conexión para tener varias peticiones en vuelo
+        workers = max(SCHEDULER_WORKERS, INFERENCE_CLIENT_CONNECTIONS) if INFERENCE_MODE == "client" else SCHEDULER_WORKERS
         try:
-            mic_transcribe = threading.Thread(
-                target=transcribe_loop,
-                args=('mic', model, mic_queue, overlay, logger),
-                daemon=True,
-                name="MicTranscribeThread"
-            )
-            
-            discord_transcribe = threading.Thread(
-                target=transcribe_loop,
-                args=('discord', model, discord_queue, overlay, logger),
-                daemon=True,
-                name="DiscordTranscribeThread"
-            )
-            
-            mic_transcribe.start()
-            print("Hilo de transcripción de micrófono iniciado")
-            
-            discord_transcribe.start()
-            print("Hilo de transcripción de Discord iniciado")
+            for worker_index in range(workers):
+                threading.Thread(
+                    target=transcribe_loop,
+                    args=(scheduler, model, overlay, logger),
+                    daemon=True,
+                    name=f"TranscribeThread-{worker_index + 1}"
+                ).start()
+            print(f"{workers} hilo(s) de transcripción iniciados (política {SCHEDULER_POLICY})")
         except Exception as e:
             print(f"Error al iniciar hilos de transcripción: {str(e)}")
             traceback.print_exc()
             time.sleep(10)
             raise
 
-        # Hilo para simular conversación de Discord
+        # Hilo para simular conversación de Discord (solo si Discord no tiene una fuente real)
         try:
-            discord_simulation_thread = threading.Thread(
-                target=simulate_discord_conversation,
-                args=(overlay,),
-                daemon=True,
-                name="DiscordSimulationThread"
-            )
-            discord_simulation_thread.start()
-            print("Hilo de simulación de conversación de Discord iniciado")
+            simulate_discord = not RTP_ENABLED and any(c['name'] == 'discord' and c.get('type') == 'none' for c in AUDIO_SOURCES)
+            if simulate_discord:
+                discord_simulation_thread = threading.Thread(
+                    target=simulate_discord_conversation,
+                    args=(overlay,),
+                    daemon=True,
+                    name="DiscordSimulationThread"
+                )
+                discord_simulation_thread.start()
+                print("Hilo de simulación de conversación de Discord iniciado")
         except Exception as e:
             print(f"Error al iniciar hilo de simulación de conversación de Discord: {str(e)}")
             traceback.print_exc()
             time.sleep(10)
             raise
 
-        # Hilo para registrar estadísticas periódicas
+        # Hilo para muestrear métricas y registrar estadísticas periódicas
         try:
+            if METRICS_HTTP_ENABLED:
+                start_metrics_server(logger)
             stats_thread = threading.Thread(
-                target=log_stats,
+                target=metrics_sampler,
                 args=(logger,),
                 daemon=True,
                 name="StatsThread"
             )
             stats_thread.start()
-            print("Hilo de registro de estadísticas iniciado")
+            print("Hilo de muestreo de métricas iniciado")
         except Exception as e:
             print(f"Error al iniciar hilo de estadísticas: {str(e)}")
             traceback.print_exc()
@@ -965,8 +4665,19 @@ def main():
         print("El audio de Discord aparecería en azul (actualmente simulado)")
         print("Haz click en la ventana para cerrar la aplicación")
         
+        # Perfilador de muestreo (aparcado hasta que se active)
+        profiler = SamplingProfiler(logger=logger)
+        profiler_shortcut = install_profiler_triggers(profiler, overlay)
+        # El bucle de Qt no devuelve el control a Python por sí solo, así que un
+        # temporizador vacío permite que los manejadores de señales se ejecuten
+        signal_timer = QtCore.QTimer()
+        signal_timer.timeout.connect(lambda: None)
+        signal_timer.start(500)
+        if PROFILER_START_ON_LAUNCH:
+            profiler.start()
+        
         # Conectar señal de cierre de aplicación
-        app.aboutToQuit.connect(lambda: setattr(sys.modules[__name__], 'running', False))
+        app.aboutToQuit.connect(request_shutdown)
         
         # Registrar inicio completo del sistema en el log
         if logger:
@@ -976,7 +4687,7 @@ def main():
         
         return app.exec_()
     except Exception as e:
-        running = False
+        request_shutdown()
         error_msg = f"ERROR CRÍTICO: {str(e)}"
         print(error_msg)
         if logger:
@@ -987,16 +4698,42 @@ def main():
         time.sleep(30)
         return 1
     finally:
-        # Asegurarse de que la variable running se establezca a False al salir
-        running = False
+        # Asegurarse de que todos los hilos terminen al salir
+        request_shutdown()
+        
+        # Cerrar los mensajes pendientes para que lleguen a los subtítulos
+        timeline.finalize(float('inf'))
+        if 'subtitle_writer' in locals() and subtitle_writer:
+            subtitle_writer.close()
+        for archive in audio_archives:
+            try:
+                archive.close()
+            except OSError as e:
+                print(f"[{archive.source}] Error al cerrar el archivo de audio: {str(e)}")
+        
+        if METRICS_CSV_EXPORT:
+            export_metrics_csv(logger if 'logger' in locals() else None)
         
         # Registrar finalización de la aplicación
         if 'logger' in locals() and logger:
             logger.info("=== FIN DE SESIÓN - Discord Whisper Overlay ===")
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Discord Whisper Overlay")
+    parser.add_argument('--server', action='store_true',
+                        help="Ejecutar solo el servidor de inferencia compartido (sin overlay ni captura)")
+    parser.add_argument('--port', type=int, default=INFERENCE_SERVER_PORT, help="Puerto del servidor de inferencia")
+    parser.add_argument('--export', metavar='FUENTE', help="Exportar a WAV un tramo del archivo de audio de una fuente")
+    parser.add_argument('--start', help="Inicio del tramo a exportar ('HH:MM:SS' de hoy, 'AAAA-MM-DD HH:MM:SS' o epoch)")
+    parser.add_argument('--end', help="Fin del tramo a exportar (mismo formato que --start)")
+    parser.add_argument('--output', default="archivo.wav", help="WAV de salida de --export")
+    args, _ = parser.parse_known_args()  # Los argumentos restantes son para Qt
+    if args.export:
+        if not args.start or not args.end:
+            parser.error("--export requiere --start y --end")
+        sys.exit(export_archive(args.export, args.start, args.end, args.output))
     try:
-        exit_code = main()
+        exit_code = run_inference_server(port=args.port) if args.server else main()
         print(f"Programa finalizado con código: {exit_code}")
     except Exception as e:
         print(f"Error no capturado: {str(e)}")
@@ -1005,4 +4742,3 @@ if __name__ == "__main__":
         print("Presiona Enter para cerrar esta ventana...")
         input()
         sys.exit(0)
-`
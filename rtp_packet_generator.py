@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Generador local de paquetes RTP para probar la recepción por hablante de
+Discord Whisper Overlay (RTP_ENABLED = True) sin un bot de Discord.
+
+Simula varios hablantes simultáneos, cada uno con su propio SSRC, que alternan
+ráfagas de "voz" y silencios. Durante los silencios no se envían paquetes pero el
+timestamp RTP sigue avanzando, igual que hace Discord. Por defecto envía PCM L16
+(no requiere dependencias); con --opus envía Opus a 48 kHz estéreo (requiere opuslib).
+Con --wav se usa audio real en lugar de tonos sintéticos.
+"""
+
+import argparse
+import json
+import random
+import socket
+import struct
+import time
+import wave
+
+import numpy as np
+
+# Deben coincidir con la configuración de discord_whisper_complete.py
+RTP_PORT = 5004
+RTP_PCM_PAYLOAD_TYPE = 96
+RTP_PCM_RATE = 16000
+RTP_OPUS_PAYLOAD_TYPE = 120  # El que usa Discord
+FRAME_MS = 20
+
+class SyntheticSpeaker:
+    """Hablante sintético: tono modulado en ráfagas de 1-3 s separadas por silencios."""
+
+    def __init__(self, index, rate, wav_samples=None):
+        self.ssrc = random.randint(1, 0xFFFFFFFF)
+        self.name = f"Hablante {index + 1}"
+        self.rate = rate
+        self.frequency = 180 + 40 * index
+        self.sequence = random.randint(0, 0xFFFF)
+        self.timestamp = random.randint(0, 0xFFFFFFFF)
+        self.phase = 0
+        self.wav_samples = wav_samples
+        self.wav_position = random.randint(0, len(wav_samples) - 1) if wav_samples is not None else 0
+        self.talking = False
+        self.remaining = random.uniform(0.2, 2.0)
+
+    def next_frame(self, frame_samples):
+        """Devuelve el siguiente frame de audio int16, o None si el hablante está en silencio."""
+        self.remaining -= frame_samples / self.rate
+        if self.remaining <= 0:
+            self.talking = not self.talking
+            self.remaining = random.uniform(1.0, 3.0) if self.talking else random.uniform(0.5, 2.0)
+        if not self.talking:
+            return None
+
+        if self.wav_samples is not None:
+            indices = (self.wav_position + np.arange(frame_samples)) % len(self.wav_samples)
+            self.wav_position = int(indices[-1]) + 1
+            return self.wav_samples[indices]
+
+        t = (self.phase + np.arange(frame_samples)) / self.rate
+        self.phase += frame_samples
+        envelope = 0.6 + 0.4 * np.sin(2 * np.pi * 4 * t)  # Modulación silábica aproximada
+        signal = np.sin(2 * np.pi * self.frequency * t) + 0.3 * np.sin(2 * np.pi * 2 * self.frequency * t)
+        return (signal * envelope * 6000).astype(np.int16)
+
+def load_wav_mono(path, rate):
+    """Carga un WAV de 16 bits como mono a la frecuencia indicada (remuestreo lineal)."""
+    with wave.open(path, 'rb') as wav:
+        channels = wav.getnchannels()
+        source_rate = wav.getframerate()
+        samples = np.frombuffer(wav.readframes(wav.getnframes()), dtype=np.int16)
+    if channels > 1:
+        samples = samples.reshape(-1, channels).mean(axis=1)
+    if source_rate != rate:
+        positions = np.arange(0, len(samples), source_rate / rate)
+        samples = np.interp(positions, np.arange(len(samples)), samples)
+    return samples.astype(np.int16)
+
+def rtp_header(payload_type, sequence, timestamp, ssrc):
+    return struct.pack('!BBHII', 0x80, payload_type & 0x7F, sequence & 0xFFFF, timestamp & 0xFFFFFFFF, ssrc)
+
+def main():
+    parser = argparse.ArgumentParser(description="Genera paquetes RTP de varios hablantes hacia el overlay")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=RTP_PORT)
+    parser.add_argument('--speakers', type=int, default=12, help="Número de hablantes simultáneos")
+    parser.add_argument('--seconds', type=float, default=60, help="Duración de la simulación")
+    parser.add_argument('--opus', action='store_true', help="Enviar Opus en lugar de PCM L16 (requiere opuslib)")
+    parser.add_argument('--wav', help="Archivo WAV de 16 bits con voz real para todos los hablantes")
+    parser.add_argument('--loss', type=float, default=0.0, help="Probabilidad de perder cada paquete (0-1)")
+    args = parser.parse_args()
+
+    rate = 48000 if args.opus else RTP_PCM_RATE
+    frame_samples = rate * FRAME_MS // 1000
+    wav_samples = load_wav_mono(args.wav, rate) if args.wav else None
+    speakers = [SyntheticSpeaker(i, rate, wav_samples) for i in range(args.speakers)]
+
+    encoders = {}
+    if args.opus:
+        import opuslib
+        for speaker in speakers:
+            encoders[speaker.ssrc] = opuslib.Encoder(48000, 2, opuslib.APPLICATION_VOIP)
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    address = (args.host, args.port)
+
+    # Mensajes de control con el nombre de cada SSRC
+    for speaker in speakers:
+        sock.sendto(json.dumps({'ssrc': speaker.ssrc, 'name': speaker.name}).encode('utf-8'), address)
+        print(f"SSRC {speaker.ssrc}: {speaker.name}")
+
+    print(f"\nEnviando {args.speakers} hablantes a {args.host}:{args.port} durante {args.seconds:.0f}s "
+          f"({'Opus' if args.opus else 'PCM L16'})...")
+    sent = 0
+    start = time.monotonic()
+    frames_total = int(args.seconds * 1000 / FRAME_MS)
+    for frame_index in range(frames_total):
+        for speaker in speakers:
+            frame = speaker.next_frame(frame_samples)
+            if frame is not None and random.random() >= args.loss:
+                if args.opus:
+                    stereo = np.repeat(frame, 2).tobytes()
+                    payload = encoders[speaker.ssrc].encode(stereo, frame_samples)
+                    packet = rtp_header(RTP_OPUS_PAYLOAD_TYPE, speaker.sequence, speaker.timestamp, speaker.ssrc) + payload
+                else:
+                    packet = rtp_header(RTP_PCM_PAYLOAD_TYPE, speaker.sequence, speaker.timestamp, speaker.ssrc) + frame.astype('>i2').tobytes()
+                sock.sendto(packet, address)
+                sent += 1
+            if frame is not None:
+                speaker.sequence += 1
+            speaker.timestamp += frame_samples
+
+        # Mantener el ritmo de tiempo real
+        delay = start + (frame_index + 1) * FRAME_MS / 1000 - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    print(f"Listo: {sent} paquetes enviados")
+
+if __name__ == "__main__":
+    try:
+        main()
+    except KeyboardInterrupt:
+        print("\nInterrumpido")
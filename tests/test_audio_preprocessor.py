@@ -0,0 +1,85 @@
+"""Pruebas de AudioPreprocessor: supresión de ruido y normalización de ganancia.
+
+Importan la aplicación completa, así que se omiten si faltan sus dependencias
+(torch, whisper, pyaudio, PyQt5). No necesitan dispositivo de audio ni GPU.
+"""
+import numpy as np
+import pytest
+
+for dependency in ("torch", "whisper", "pyaudio", "PyQt5"):
+    pytest.importorskip(dependency)
+
+import discord_whisper_complete as app
+
+WINDOW_SECONDS = 3.0
+
+
+def hum(seconds, level=0.004, seed=0):
+    """Zumbido de red (50 Hz y armónicos) con ruido blanco de fondo."""
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(seconds * app.RATE)) / app.RATE
+    tone = sum(np.sin(2 * np.pi * 50 * k * t) / k for k in range(1, 6))
+    noise = tone / np.max(np.abs(tone)) * level + rng.standard_normal(len(t)) * level / 4
+    return noise.astype(np.float32)
+
+
+def quiet_voice(seconds, level=0.01):
+    """Vocal sintética con sílabas (modulación de 4 Hz) y pausas, a bajo volumen."""
+    t = np.arange(int(seconds * app.RATE)) / app.RATE
+    f0 = 140 * (1 + 0.05 * np.sin(2 * np.pi * 0.7 * t))
+    phase = 2 * np.pi * np.cumsum(f0) / app.RATE
+    voiced = sum(np.sin(k * phase) * np.exp(-((140 * k - 700) / 400) ** 2) for k in range(1, 30))
+    syllables = np.clip(np.sin(2 * np.pi * 4 * t), 0, None)
+    voice = voiced * syllables
+    return (voice / np.max(np.abs(voice)) * level).astype(np.float32)
+
+
+def rms(audio):
+    return float(np.sqrt(np.mean(audio.astype(np.float64) ** 2)))
+
+
+@pytest.fixture
+def preprocessor():
+    preprocessor = app.AudioPreprocessor("test")
+    preprocessor.learn_noise(hum(WINDOW_SECONDS, seed=1))
+    return preprocessor
+
+
+def test_quiet_speech_is_amplified(preprocessor):
+    window = quiet_voice(WINDOW_SECONDS) + hum(WINDOW_SECONDS, seed=2)
+    for _ in range(3):
+        out = preprocessor.process(window)
+    assert preprocessor.gain > 2.0
+    assert rms(out) > 2.0 * rms(window)
+    assert np.max(np.abs(out)) < 1.0
+
+
+def test_noise_only_window_keeps_unity_gain(preprocessor):
+    for seed in range(3):
+        preprocessor.process(quiet_voice(WINDOW_SECONDS) + hum(WINDOW_SECONDS, seed=seed + 2))
+    learned_gain = preprocessor.gain
+    assert learned_gain > 2.0
+
+    noise = hum(WINDOW_SECONDS, seed=10)
+    out = preprocessor.process(noise)
+    # La supresión puede atenuar el ruido, pero la ganancia aprendida con voz no se aplica
+    assert rms(out) <= rms(noise) * 1.01
+    assert preprocessor.gain == learned_gain
+
+
+def test_bypassed_windows_amplify_speech_but_not_noise(preprocessor):
+    for seed in range(3):
+        preprocessor.process(quiet_voice(WINDOW_SECONDS) + hum(WINDOW_SECONDS, seed=seed + 2))
+    learned_gain = preprocessor.gain
+
+    # Sin supresión de ruido (presupuesto agotado) la ganancia se decide por tramas
+    preprocessor.bypass_remaining = 2
+    noise = hum(WINDOW_SECONDS, seed=10)
+    out = preprocessor.process(noise)
+    assert rms(out) <= rms(noise) * 1.01
+    assert preprocessor.gain == learned_gain
+
+    window = quiet_voice(WINDOW_SECONDS) + hum(WINDOW_SECONDS, seed=11)
+    out = preprocessor.process(window)
+    assert rms(out) > 2.0 * rms(window)
+    assert preprocessor.bypass_remaining == 0